@@ -3,12 +3,10 @@ import os
 import time
 import datetime
 import traceback
-import boto3
+import collections
 import pathlib
-import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
-import requests
 import urllib.parse
 import argparse
 from selenium.webdriver.common.by import By
@@ -17,6 +15,7 @@ from selenium.webdriver.support import expected_conditions as EC
 current_dir = pathlib.Path(__file__).parent
 sys.path.append("../util")
 import util
+import profiler
 import crawler_base as cb
 
 
@@ -28,24 +27,71 @@ class MercariCrawler(cb.SeleniumCralwer):
     platform = "mercari"
     local_output_dir = current_dir / f"../output/crawler/{platform}"
     s3_output_dir = pathlib.Path(f"crawler/{platform}")
+    output_schema = {
+        "item_id": "string",
+        "crawl_date": "datetime",
+        "price": "Int64",
+        "thumbnail": "string",
+    }
+    # 商品一覧から[href, 価格, サムネイル]の配列だけをブラウザ側で取り出す
+    extract_items_script = """
+        var grid = document.querySelector("#item-grid");
+        if (!grid) return [];
+
+        var withDetails = arguments[0];
+        var items = [];
+        grid.querySelectorAll("li").forEach(function(li) {
+            var a = li.querySelector("a");
+            if (!a) return;
+
+            if (!withDetails) {
+                items.push([a.getAttribute("href")]);
+                return;
+            }
+
+            var thumbnail = li.querySelector("mer-item-thumbnail");
+            items.push([
+                a.getAttribute("href"),
+                thumbnail ? thumbnail.getAttribute("price") : null,
+                thumbnail ? thumbnail.getAttribute("src") : null
+            ]);
+        });
+        return items;
+    """
 
 
-    def __init__(self, is_test=False, wait_sec=1.0, headless=True, save_to_s3=False):
+    def __init__(
+        self, 
+        is_test=False, 
+        wait_sec=1.0, 
+        headless=True, 
+        save_to_s3=False, 
+        output_format="csv",
+        extract_mode="js",
+        with_details=False,
+        prefetch_depth=0
+        ):
         super().__init__(
             is_test=is_test, 
             wait_sec=wait_sec,
             headless=headless,
             save_to_s3=save_to_s3,
+            output_format=output_format,
         )
         self.max_wait_sec = 20
+        # "js": execute_scriptで必要な値だけ取得 / "soup": page_sourceをBeautifulSoupでパース
+        self.extract_mode = extract_mode
+        self.with_details = with_details
+        self.prefetch_depth = prefetch_depth
 
         if save_to_s3:
-            bucket_name = os.environ.get("BUCKET_NAME", None)
-            self.s3_session = boto3.Session(profile_name="crawling")
-            self.s3_bucket = s3_session.resource("s3").Bucket(bucket_name)
+            self.s3_bucket = util.get_s3_bucket()
             
 
     def crawl_url(self, start_url):
+        if self.prefetch_depth > 0:
+            return self.crawl_url_prefetch(start_url)
+
         items = []
         next_url = start_url
         current_page = 0
@@ -54,26 +100,14 @@ class MercariCrawler(cb.SeleniumCralwer):
         while True:
             self.get_url(next_url)
 
-            # wait until the item area is loaded
-            try:
-                WebDriverWait(self.driver, self.max_wait_sec).until(
-                    EC.any_of(
-                        EC.presence_of_element_located((By.ID, "item-grid")),
-                        EC.presence_of_element_located((By.CSS_SELECTOR, "p[slot='title']"))
-                    )
-                )
-
-            except Exception as e:
-                self.logger.error("Timeout occurred while loading the page.")
-                self.logger.error(traceback.format_exc())
+            if not self.wait_items():
                 break
 
-            page_source = self.get_page_source()
-            if page_source is None:
+            new_items = self.get_items()
+            if new_items is None:
                 self.logger.error(f"Failed to access the next page: {next_url}")
                 break
 
-            new_items = self.parse_items(page_source)
             if len(new_items) == 0:
                 self.logger.warning(f"No items found: {next_url}")
                 break
@@ -95,6 +129,133 @@ class MercariCrawler(cb.SeleniumCralwer):
         return new_df
 
 
+    def crawl_url_prefetch(self, start_url):
+        """
+        現在のページをパースしている間に、次のprefetch_depthページを別タブで読み込んでおく
+
+        """
+        items = []
+        main_handle = self.driver.current_window_handle
+        max_pages = 3 if self.is_test else None
+
+        self.logger.info(f"Start crawling: {start_url}")
+        self.get_url(start_url)
+        pending = collections.deque([(start_url, main_handle)])
+        next_page = 1
+
+        while len(pending) > 0:
+            # keep the next pages loading in background tabs
+            while len(pending) <= self.prefetch_depth \
+                and (max_pages is None or next_page < max_pages):
+                next_url = self.get_next_url(start_url, next_page - 1)
+                if next_url is None:
+                    break
+
+                pending.append((next_url, self.open_tab(next_url)))
+                next_page += 1
+
+            url, handle = pending.popleft()
+            self.driver.switch_to.window(handle)
+
+            new_items = None
+            if self.wait_items():
+                new_items = self.get_items()
+
+            if handle != main_handle:
+                self.driver.close()
+                # the driver would stay on the closed tab and fail on the next window.open
+                self.driver.switch_to.window(main_handle)
+
+            if new_items is None:
+                self.logger.error(f"Failed to access the next page: {url}")
+                break
+
+            if len(new_items) == 0:
+                self.logger.warning(f"No items found: {url}")
+                break
+
+            items += new_items
+
+        # stop loading the pages after the last one
+        for _, handle in pending:
+            self.driver.switch_to.window(handle)
+            self.driver.close()
+        self.driver.switch_to.window(main_handle)
+
+        self.logger.info(f"Finish crawling: {start_url}")
+        new_df = pd.DataFrame(items)
+
+        return new_df
+
+
+    def wait_items(self):
+        # wait until the item area is loaded
+        try:
+            WebDriverWait(self.driver, self.max_wait_sec).until(
+                EC.any_of(
+                    EC.presence_of_element_located((By.ID, "item-grid")),
+                    EC.presence_of_element_located((By.CSS_SELECTOR, "p[slot='title']"))
+                )
+            )
+
+        except Exception as e:
+            self.logger.error("Timeout occurred while loading the page.")
+            self.logger.error(traceback.format_exc())
+            return False
+
+        return True
+
+
+    def get_items(self):
+        if self.extract_mode == "js":
+            return self.extract_items()
+
+        page_source = self.get_page_source()
+        if page_source is None:
+            return None
+
+        return self.parse_items(page_source)
+
+
+    def extract_items(self):
+        items = []
+        try:
+            rows = self.driver.execute_script(self.extract_items_script, self.with_details)
+        except Exception as e:
+            self.logger.error(f"An error occurred while extracting items.")
+            self.logger.error(traceback.format_exc())
+            return items
+
+        crawl_date = util.get_jst_time()
+        num_skipped = 0
+        for row in rows or []:
+            # placeholders of items that are not rendered yet have no link
+            if not row or not row[0]:
+                num_skipped += 1
+                continue
+
+            try:
+                item_info = {
+                    "item_id": row[0].split("/")[-1],
+                    "crawl_date": crawl_date,
+                }
+                if self.with_details:
+                    item_info["price"] = row[1]
+                    item_info["thumbnail"] = row[2]
+
+                items.append(item_info)
+
+            except Exception as e:
+                num_skipped += 1
+                self.logger.warning(f"Skipped an item that could not be extracted: {row}")
+                self.logger.warning(traceback.format_exc())
+
+        if num_skipped > 0:
+            self.logger.warning(f"Skipped {num_skipped} of {len(rows)} items.")
+
+        return items
+
+
     def parse_items(self, html):
         items = []
         try:
@@ -152,12 +313,28 @@ if __name__ == "__main__":
     parser.add_argument("urls")
     parser.add_argument("--is_test", action="store_true")
     parser.add_argument("--s3", action="store_true")
+    parser.add_argument("--format", default="csv", choices=["csv", "parquet"])
+    parser.add_argument("--extract_mode", default="js", choices=["js", "soup"])
+    parser.add_argument("--with_details", action="store_true")
+    parser.add_argument("--prefetch_depth", type=int, default=0)
+    parser.add_argument("--profile", nargs="?", const="on", default=None, choices=["on", "signal"])
     args, leftovers = parser.parse_known_args()
 
+    if args.profile is not None:
+        profiler.setup(
+            current_dir / "../logs/mercari/crawler", 
+            signal_only=(args.profile == "signal")
+        )
+
     url_df = pd.read_csv(current_dir / args.urls)
     crawler = MercariCrawler(
         is_test=args.is_test, 
         headless=(not args.is_test),
-        save_to_s3=args.s3
+        save_to_s3=args.s3,
+        output_format=args.format,
+        extract_mode=args.extract_mode,
+        with_details=args.with_details,
+        prefetch_depth=args.prefetch_depth
     )
     crawler.run_crawler(url_df["url"])
+    profiler.finish()
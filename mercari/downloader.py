@@ -3,17 +3,17 @@ import os
 import time
 import datetime
 import traceback
-import boto3
 import pathlib
 import pandas as pd
 import urllib.parse
 import argparse
-from selenium.webdriver.common.by import By
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 current_dir = pathlib.Path(__file__).parent
 sys.path.append("../util")
 import util
+import profiler
+import columnar
 import crawler_base as cb
 
 
@@ -27,19 +27,44 @@ class MercariDownloader(cb.SeleniumDownloader):
     local_output_dir = current_dir / f"../output/downloader/{platform}"
     s3_output_dir = pathlib.Path(f"downloader/{platform}")
     max_wait_sec = 10.0
-    """
-    bucket_name = os.environ.get("BUCKET_NAME", None)
-    self.s3_session = boto3.Session(profile_name="crawling")
-    self.s3_bucket = s3_session.resource("s3").Bucket(bucket_name)
-    """
+    item_id_prefix = "m"
+    # MercariParser only reads these nodes
+    keep_selectors = [
+        'meta[property="og:url"]',
+        'script[type="application/json"]',
+        'script[type="application/ld+json"]',
+        "#item-info",
+        'mer-button[data-testid="checkout-button"]',
+    ]
+    # item API called by the item page; its response has the same fields as the embedded JSON
+    capture_url_patterns = [
+        r"^https://api\.mercari\.jp/items/get\?",
+    ]
     logger = util.Logger.setup_logger(
         logger_name=__name__, 
         log_dir=current_dir / f"../logs/{platform}/downloader"
     )
 
 
-    def __init__(self, is_test=False, save_to_s3=False):
-        super().__init__(is_test=is_test, save_to_s3=save_to_s3)
+    def __init__(
+        self, 
+        is_test=False, 
+        save_to_s3=False, 
+        start_method=None, 
+        trim_html=False, 
+        capture=None,
+        autotune=False,
+        memory_limit_mb=None
+        ):
+        super().__init__(
+            is_test=is_test,
+            save_to_s3=save_to_s3,
+            start_method=start_method,
+            trim_html=trim_html,
+            capture=capture,
+            autotune=autotune,
+            memory_limit_mb=memory_limit_mb,
+        )
 
 
     @classmethod
@@ -47,22 +72,49 @@ class MercariDownloader(cb.SeleniumDownloader):
         return urllib.parse.urljoin(cls.base_url, item_id)
 
 
+    # classifies the page in one round trip; null while the page is still loading
+    classify_page_script = """
+        if (document.querySelector("#item-info")) return "loaded";
+        if (document.querySelector("#main-frame-error, .neterror")) return "network_error";
+
+        const title = (document.title || "").toLowerCase();
+        const text = document.body ? document.body.innerText.slice(0, 2000) : "";
+        if (/captcha|access denied|too many requests/i.test(title + " " + text)
+            || document.querySelector("#challenge-form, iframe[src*='captcha']")) {
+            return "blocked";
+        }
+        if (title.includes("404") || title.includes("ページが見つかりません")) return "not_found";
+        if (text.includes("この商品は削除されました") || text.includes("該当する商品は削除されています")) {
+            return "deleted";
+        }
+        return null;
+    """
+
+
+    @classmethod
+    def classify_page(cls, driver):
+        return driver.execute_script(cls.classify_page_script)
+
+
     @classmethod
     def wait_func(cls, driver, max_wait_sec):
-        # wait until the item area is loaded
+        # returns as soon as the page is either loaded or known to be dead/blocked
         try:
-            WebDriverWait(driver, max_wait_sec).until(
-                EC.any_of(
-                    EC.presence_of_element_located((By.ID, "item-info")),
-                )
-            )
+            state = WebDriverWait(driver, max_wait_sec, poll_frequency=0.25).until(cls.classify_page)
 
-        except Exception as e:
+        except TimeoutException:
             cls.logger.error("Timeout occurred while loading the page.")
+            return cb.PageState.TIMEOUT
+
+        except Exception as e:
+            cls.logger.error("Error occurred while loading the page.")
             cls.logger.error(traceback.format_exc())
-            return False
-        
-        return True
+            return cb.PageState.ERROR
+
+        if state != cb.PageState.LOADED:
+            cls.logger.info(f"Page is {state}: {driver.current_url}")
+
+        return state
 
 
     @classmethod
@@ -73,12 +125,14 @@ class MercariDownloader(cb.SeleniumDownloader):
 
         else:
             local_crawler_output_dir = current_dir / f"../output/crawler/{cls.platform}"
-            paths = util.list_all_files(local_crawler_output_dir, ".csv")
+            paths = util.list_all_files(local_crawler_output_dir, ".csv") \
+                + util.list_all_files(local_crawler_output_dir, ".parquet")
 
         if paths is None or len(paths) == 0:
             return None
 
-        return paths[0]
+        # file names are the crawl timestamps
+        return max(paths, key=lambda p: pathlib.Path(p).name)
 
 
 if __name__ == "__main__":
@@ -86,22 +140,49 @@ if __name__ == "__main__":
     parser.add_argument("--items", default=None)
     parser.add_argument("--is_test", action="store_true")
     parser.add_argument("--s3", action="store_true")
+    parser.add_argument("--start_method", default=None, choices=["fork", "spawn", "forkserver"])
+    parser.add_argument("--trim_html", action="store_true")
+    parser.add_argument("--budget", type=int, default=None, help="run parser.py --history to also learn from price changes")
+    parser.add_argument("--new_only", action="store_true")
+    parser.add_argument("--capture", default=None, choices=["json", "both"])
+    parser.add_argument("--autotune", action="store_true")
+    parser.add_argument("--memory_limit_mb", type=float, default=None)
+    parser.add_argument("--profile", nargs="?", const="on", default=None, choices=["on", "signal"])
     args, leftovers = parser.parse_known_args()
 
+    if args.profile is not None:
+        profiler.setup(
+            current_dir / "../logs/mercari/downloader", 
+            signal_only=(args.profile == "signal")
+        )
+
     if args.items is None:
         args.items = MercariDownloader.get_latest_crawler_result(from_s3=args.s3)
 
     if args.s3:
-        bucket_name = os.environ.get("BUCKET_NAME", None)
-        s3_bucket = s3_session.resource("s3").Bucket(bucket_name)
-        _, local_url_path = util.s3_download_file(s3_bucket, args.items)
-        item_id_df = pd.read_csv(local_url_path)
+        s3_bucket = util.get_s3_bucket()
+        _, local_url_path = util.s3_download_file(
+            s3_bucket, 
+            args.items, 
+            util.get_temp_dir() / pathlib.Path(args.items).name
+        )
+        item_id_df = columnar.read_table(local_url_path, columns=["item_id"])
     else:
-        item_id_df = pd.read_csv(args.items)
+        item_id_df = columnar.read_table(args.items, columns=["item_id"])
     
 
     downloader = MercariDownloader(
         is_test=args.is_test,
-        save_to_s3=args.s3
+        save_to_s3=args.s3,
+        start_method=args.start_method,
+        trim_html=args.trim_html,
+        capture=args.capture,
+        autotune=args.autotune,
+        memory_limit_mb=args.memory_limit_mb
     )
-    downloader.run_downloader(item_id_df["item_id"])
+    item_ids = downloader.select_items(item_id_df["item_id"], skip_downloaded=args.new_only)
+    if args.budget is not None:
+        item_ids = downloader.schedule_items(item_ids, args.budget)
+
+    downloader.run_downloader(item_ids)
+    profiler.finish()
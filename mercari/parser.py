@@ -3,21 +3,20 @@ import os
 import time
 import datetime
 import traceback
-import boto3
 import pathlib
-import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
-import requests
 import urllib.parse
 import argparse
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 current_dir = pathlib.Path(__file__).parent
 sys.path.append("../util")
 import util
+import profiler
+import normalize
+import embedded_json
 import crawler_base as cb
+from s3_listing import S3Lister
+from category_codes import CategoryCodes
 
 
 class MercariParser(cb.ParserBase):
@@ -29,91 +28,322 @@ class MercariParser(cb.ParserBase):
     platform = "mercari"
     local_output_dir = current_dir / f"../output/parser/{platform}"
     s3_output_dir = pathlib.Path(f"parser/{platform}")
-    """
-    bucket_name = os.environ.get("BUCKET_NAME", None)
-    self.s3_session = boto3.Session(profile_name="crawling")
-    self.s3_bucket = s3_session.resource("s3").Bucket(bucket_name)
-    """
+    item_base_url = "https://jp.mercari.com/item/"
+    cache_key_attrs = ("parse_mode",)
+    cache_source_modules = ("embedded_json", "normalize")
+    soldout_statuses = ("sold_out", "trading")
+    mp_preload = ("util", "crawler_base", "bs4", "lxml")
+    output_schema = {
+        "html": "string",
+        "item_id": "string",
+        "URL": "string",
+        "item_name": "string",
+        "last_updated": "string",
+        "last_updated_at": "datetime",
+        "fetched_at": "datetime",
+        "price": "Int64",
+        "is_soldout": "boolean",
+        "category_*": "category",
+        "brand": "category",
+        "quality": "category",
+        "shipping_cost": "category",
+        "shipping_pattern": "category",
+        "shipping_from": "category",
+        "shipping_days": "category",
+        "shipping_days_min": "Int64",
+        "shipping_days_max": "Int64",
+        "parse_source": "category",
+        "parse_success": "bool",
+        "parse_error": "category",
+    }
+    # 既知の値の順番がカテゴリのコードになる
+    category_tables = {
+        "quality": [
+            "新品、未使用",
+            "未使用に近い",
+            "目立った傷や汚れなし",
+            "やや傷や汚れあり",
+            "傷や汚れあり",
+            "全体的に状態が悪い",
+        ],
+        "shipping_cost": [
+            "送料込み(出品者負担)",
+            "着払い(購入者負担)",
+        ],
+        "shipping_days": [
+            "1~2日で発送",
+            "2~3日で発送",
+            "4~7日で発送",
+        ],
+    }
     logger = util.Logger.setup_logger(
         logger_name=__name__, 
         log_dir=current_dir / f"../logs/{platform}/parser"
     )
 
 
-    def __init__(self, is_test=False, save_to_s3=False):
+    def __init__(
+        self, 
+        is_test=False, 
+        save_to_s3=False, 
+        start_method=None, 
+        output_format="csv", 
+        use_cache=True,
+        update_history=False,
+        autotune=False,
+        parse_mode="auto"
+        ):
+        # "auto": 埋め込みJSONを優先し、無ければDOMからパースする / "dom": DOMのみ
+        self.parse_mode = parse_mode
         super().__init__(
             is_test=is_test, 
             save_to_s3=save_to_s3,
+            start_method=start_method,
+            output_format=output_format,
+            use_cache=use_cache,
+            update_history=update_history,
+            autotune=autotune,
         )
 
 
     @classmethod
-    def parse_html(cls, html_path):
+    def parse_html(cls, html_path, content=None, encoding=None, parse_mode="auto"):
         html_path = pathlib.Path(html_path)
         result = {
-            "html": html_path.name
+            "html": cls.get_html_name(html_path)
         }
 
         try:
-            content = util.read_html(html_path)
-            all_soup = BeautifulSoup(content, "lxml")
+            if content is None:
+                content, encoding = util.read_html_bytes(html_path)
+
+            # bytes go to the parsers as they are; only other charsets are decoded here
+            if isinstance(content, bytes) and not util.is_utf8(encoding):
+                content = content.decode(encoding, errors="replace")
+
+            item_id = cls.get_item_id(html_path)
+            if html_path.suffix == ".json":
+                cls.parse_captured_json(content, result, item_id)
+                result["parse_source"] = "api"
+            elif parse_mode != "dom" and cls.parse_embedded_json(content, result, item_id):
+                result["parse_source"] = "json"
+            else:
+                cls.parse_dom(content, result)
+                result["parse_source"] = "dom"
+
+            result["parse_success"] = True
+        
+        except Exception as e:
+            cls.logger.warning(f"Failed to parse html: {html_path}")
+            cls.logger.warning(traceback.format_exc())
+            result["parse_success"] = False
+            result["parse_error"] = type(e).__name__
 
-            # item id, URL
-            url = all_soup.select('meta[property="og:url"]')[0].attrs["content"]
-            result["item_id"] = url.split("/")[-1]
-            result["URL"] = url
+        return result
 
-            soup = all_soup.select("#item-info")[0]
 
-            # 商品名
-            result["item_name"] = soup.select("mer-heading")[0].attrs["title-label"]
+    def normalize(self, result_df):
+        """
+        パース結果の文字列を列ごとにまとめて正規化する。
+        相対時刻はHTMLのファイル名にあるダウンロード時刻を基準に絶対時刻へ変換する。
+        カテゴリのコードは実行をまたいで同じになるよう、category_pathに記録する
 
-            # 最終アップデート
-            result["last_updated"] = soup.select('section.aITlH mer-text[color="secondary"]')[0].text
-            
-            # 価格
-            price = soup.select("mer-price")[0].attrs["value"]
-            result["price"] = int(price)
+        """
+        df = result_df.copy()
+        if len(df) == 0:
+            return df
 
-            # 売り切れか
-            button_text = all_soup.select('mer-button[data-testid="checkout-button"]')[0].text
-            result["is_soldout"] = "売り切れ" in button_text
+        df["fetched_at"] = normalize.parse_fetch_time(df["html"])
 
-            # カテゴリ
-            categories = soup.select("mer-breadcrumb-list mer-breadcrumb-item")
-            for i, c in enumerate(categories):
-                result[f"category_{i+1}"] = c.text
+        if "last_updated" in df:
+            df["last_updated_at"] = normalize.relative_time_to_timestamp(
+                df["last_updated"], 
+                df["fetched_at"]
+            )
 
-            # ブランド
-            result["brand"] = soup.select("mer-text-link.jskyke")[0].text
+        if "shipping_days" in df:
+            df["shipping_days_min"], df["shipping_days_max"] = \
+                normalize.range_to_min_max(df["shipping_days"])
 
-            # 商品の状態
-            result["quality"] = soup.select('span[data-testid="商品の状態"]')[0].text
+        category_columns = [c for c in df.columns if c.startswith("category_")] \
+            + ["shipping_pattern", "shipping_from"]
+        codes = CategoryCodes(self.category_path)
+        try:
+            for column in df.columns:
+                if column in self.category_tables or column in category_columns:
+                    df[column] = codes.to_categorical(column, df[column], self.category_tables.get(column, ()))
+        finally:
+            codes.close()
 
-            # 配送料の負担
-            result["shipping_cost"] = soup.select('span[data-testid="配送料の負担"]')[0].text
+        return df
 
-            # 配送の方法
-            result["shipping_pattern"] = soup.select('span[data-testid="配送の方法"]')[0].text
 
-            # 発送元の地域
-            result["shipping_from"] = soup.select('span[data-testid="発送元の地域"]')[0].text
+    @staticmethod
+    def get_item_id(html_path):
+        # ダウンローダーのファイル名は "{item_id}_{取得時刻}.html"
+        return pathlib.Path(html_path).stem.rsplit("_", 1)[0]
 
-            # 発送までの日数
-            result["shipping_days"] = soup.select('span[data-testid="発送までの日数"]')[0].text
 
-            # 説明
-            description = soup.select('section.aITlH mer-text[data-testid="description"]')[0].text
-            #result["description"] = description
+    @classmethod
+    def parse_embedded_json(cls, content, result, item_id):
+        """
+        埋め込まれたJSON(Next.jsのstate等)から商品情報を取り出す。
+        商品データが見つからなければFalseを返す
 
-            result["parse_success"] = True
+        """
+        return cls.parse_item_payloads(embedded_json.find_json_payloads(content), result, item_id)
+
+
+    @classmethod
+    def parse_captured_json(cls, content, result, item_id):
+        """
+        ダウンローダーがCDPで取得したAPIレスポンス('.json')から商品情報を取り出す
+        """
+        capture = embedded_json.loads(content)
+        payloads = [r["body"] for r in capture["responses"] if isinstance(r.get("body"), (dict, list))]
+        if not cls.parse_item_payloads(payloads, result, item_id):
+            raise ValueError(f"No data of item {item_id} in the captured responses")
+
+
+    @classmethod
+    def parse_item_payloads(cls, payloads, result, item_id):
+        """
+        JSONのpayloadから商品データを探して各項目を取り出す。
+        おすすめ商品などの別の商品と取り違えないよう、idがitem_idと一致するものだけを使う。
+        見つからなければFalseを返す
+
+        """
+        def is_target_item(d):
+            return cls.is_item_payload(d) and d["id"] == item_id
+
+        item = None
+        for payload in payloads:
+            for d in embedded_json.find_dicts(payload, is_target_item):
+                item = d
+                break
+
+            if item is not None:
+                break
+
+        if item is None:
+            return False
+
+        def name_of(key):
+            value = item.get(key)
+            if isinstance(value, dict):
+                return value.get("name")
+            return None
+
+        # item id, URL
+        result["item_id"] = item["id"]
+        result["URL"] = urllib.parse.urljoin(cls.item_base_url, item["id"])
+
+        # 商品名
+        result["item_name"] = item["name"]
+
+        # 最終アップデート
+        updated = item.get("updated")
+        if updated is not None:
+            updated = datetime.datetime.fromtimestamp(int(updated), util.JST)
+            result["last_updated"] = updated.strftime("%Y-%m-%d %H:%M:%S")
         
-        except Exception as e:
-            cls.logger.warning(f"Failed to parse html: {html_path}")
-            cls.logger.warning(traceback.format_exc())
-            result["parse_success"] = False
+        # 価格
+        result["price"] = int(item["price"])
 
-        return result
+        # 売り切れか
+        result["is_soldout"] = item["status"] in cls.soldout_statuses
+
+        # カテゴリ
+        categories = [c.get("name") for c in item.get("parent_categories_ntiers") or []]
+        if isinstance(item.get("item_category_ntiers"), dict):
+            categories.append(item["item_category_ntiers"].get("name"))
+        for i, c in enumerate(categories):
+            result[f"category_{i+1}"] = c
+
+        # ブランド
+        result["brand"] = name_of("item_brand")
+
+        # 商品の状態
+        result["quality"] = name_of("item_condition")
+
+        # 配送料の負担
+        result["shipping_cost"] = name_of("shipping_payer")
+
+        # 配送の方法
+        result["shipping_pattern"] = name_of("shipping_method")
+
+        # 発送元の地域
+        result["shipping_from"] = name_of("shipping_from_area")
+
+        # 発送までの日数
+        result["shipping_days"] = name_of("shipping_duration")
+
+        return True
+
+
+    @staticmethod
+    def is_item_payload(d):
+        item_id = d.get("id")
+        return isinstance(item_id, str) and item_id.startswith("m") \
+            and "price" in d and "name" in d and "status" in d
+
+
+    @classmethod
+    def parse_dom(cls, content, result):
+        if isinstance(content, bytes):
+            all_soup = BeautifulSoup(content, "lxml", from_encoding="UTF-8")
+        else:
+            all_soup = BeautifulSoup(content, "lxml")
+
+        # item id, URL
+        url = all_soup.select('meta[property="og:url"]')[0].attrs["content"]
+        result["item_id"] = url.split("/")[-1]
+        result["URL"] = url
+
+        soup = all_soup.select("#item-info")[0]
+
+        # 商品名
+        result["item_name"] = soup.select("mer-heading")[0].attrs["title-label"]
+
+        # 最終アップデート
+        result["last_updated"] = soup.select('section.aITlH mer-text[color="secondary"]')[0].text
+        
+        # 価格
+        price = soup.select("mer-price")[0].attrs["value"]
+        result["price"] = int(price)
+
+        # 売り切れか
+        button_text = all_soup.select('mer-button[data-testid="checkout-button"]')[0].text
+        result["is_soldout"] = "売り切れ" in button_text
+
+        # カテゴリ
+        categories = soup.select("mer-breadcrumb-list mer-breadcrumb-item")
+        for i, c in enumerate(categories):
+            result[f"category_{i+1}"] = c.text
+
+        # ブランド
+        result["brand"] = soup.select("mer-text-link.jskyke")[0].text
+
+        # 商品の状態
+        result["quality"] = soup.select('span[data-testid="商品の状態"]')[0].text
+
+        # 配送料の負担
+        result["shipping_cost"] = soup.select('span[data-testid="配送料の負担"]')[0].text
+
+        # 配送の方法
+        result["shipping_pattern"] = soup.select('span[data-testid="配送の方法"]')[0].text
+
+        # 発送元の地域
+        result["shipping_from"] = soup.select('span[data-testid="発送元の地域"]')[0].text
+
+        # 発送までの日数
+        result["shipping_days"] = soup.select('span[data-testid="発送までの日数"]')[0].text
+
+        # 説明
+        description = soup.select('section.aITlH mer-text[data-testid="description"]')[0].text
+        #result["description"] = description
+
+        return True
 
 
 if __name__ == "__main__":
@@ -121,23 +351,61 @@ if __name__ == "__main__":
     parser.add_argument("--html_dir", default=None)
     parser.add_argument("--is_test", action="store_true")
     parser.add_argument("--s3", action="store_true")
+    parser.add_argument("--start_method", default=None, choices=["fork", "spawn", "forkserver"])
+    parser.add_argument("--format", default="csv", choices=["csv", "parquet"])
+    parser.add_argument("--parse_mode", default="auto", choices=["auto", "dom"])
+    parser.add_argument("--no_cache", action="store_true")
+    parser.add_argument("--history", action="store_true", help="also feeds the results back to downloader.py --budget")
+    parser.add_argument("--new_only", action="store_true")
+    parser.add_argument("--watch", action="store_true")
+    parser.add_argument("--autotune", action="store_true")
+    parser.add_argument("--profile", nargs="?", const="on", default=None, choices=["on", "signal"])
     args, leftovers = parser.parse_known_args()
 
+    if args.profile is not None:
+        profiler.setup(
+            current_dir / "../logs/mercari/parser", 
+            signal_only=(args.profile == "signal")
+        )
+
     if args.html_dir is None:
         args.html_dir = current_dir / f"../output/downloader/mercari"
 
     if args.s3:
-        bucket_name = os.environ.get("BUCKET_NAME", None)
-        s3_bucket = s3_session.resource("s3").Bucket(bucket_name)
+        s3_bucket = util.get_s3_bucket()
+
+    if args.s3 and not args.watch:
         local_dir = current_dir / f"../temp/{util.get_jst_time_str()}"
         local_dir.mkdir(exist_ok=True, parents=True)
-        s3_paths = util.s3_list_all_files(s3_bucket, args.html_dir, extension=".html")
+        lister = S3Lister(s3_bucket, manifest_path=current_dir / "../output/cache/mercari/s3_manifest.sqlite3")
+        # the '.encoding' side files of non-UTF-8 pages are downloaded next to their html
+        s3_paths = util.s3_list_all_files(
+            s3_bucket,
+            args.html_dir,
+            filter_func=lambda path: path.name.endswith((".html", ".html.encoding")),
+            new_only=args.new_only,
+            lister=lister
+        )
         util.s3_download_files(s3_bucket, s3_paths, local_dir)
     else:
         local_dir = args.html_dir
 
     parser = MercariParser(
         is_test=args.is_test, 
-        save_to_s3=args.s3
+        save_to_s3=args.s3,
+        start_method=args.start_method,
+        output_format=args.format,
+        use_cache=(not args.no_cache),
+        update_history=args.history,
+        autotune=args.autotune,
+        parse_mode=args.parse_mode
     )
-    parser.run_parser(local_dir)
+    if args.watch:
+        # the downloader's local output; the results still go to s3 with --s3
+        parser.run_watcher(local_dir)
+    else:
+        parser.run_parser(local_dir)
+        if args.s3:
+            # only the parsed keys are left out of the next --new_only run
+            lister.commit_keys(s3_paths)
+    profiler.finish()
@@ -0,0 +1,29 @@
+#!/bin/bash
+# Measures the import time of each entry point with `python -X importtime`.
+# usage: ./import_time.sh [crawler|downloader|parser ...]
+function import_time () {
+  local module=$1
+  python3 -X importtime -c "import $module" 2>&1 >/dev/null \
+    | python3 -c '
+import sys
+rows = []
+for line in sys.stdin:
+    if not line.startswith("import time:") or "cumulative" in line:
+        continue
+    self_us, cumulative_us, name = [c.strip() for c in line[len("import time:"):].split("|")]
+    rows.append((int(cumulative_us), name))
+total = max(rows)[0] if rows else 0
+print(f"total: {total / 1000:.1f} ms")
+for cumulative_us, name in sorted(rows, reverse=True)[1:11]:
+    print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+'
+}
+
+cd `dirname $0`/../mercari
+source ../venv/bin/activate 2>/dev/null
+
+modules=${@:-crawler downloader parser}
+for module in $modules; do
+  echo "[$module]"
+  import_time $module
+done
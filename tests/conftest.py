@@ -0,0 +1,5 @@
+import sys
+import pathlib
+
+# the modules of util/ are imported by their bare names, as in the scripts
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "util"))
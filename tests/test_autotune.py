@@ -0,0 +1,82 @@
+import time
+import signal
+import multiprocessing as mp
+import pytest
+from autotune import ConcurrencyController, TunedWorkers, TaskQueue
+
+
+def square_worker(conn, fail_on=None):
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+
+        if task == fail_on:
+            raise ValueError(f"bad task {task}")
+        time.sleep(0.01)
+        conn.send(("done", (task * task, False)))
+
+
+def slow_worker(conn):
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+
+        time.sleep(0.5)
+        conn.send(("done", (task, False)))
+
+
+class FailingQueue(TaskQueue):
+    def finish(self, index, task, result):
+        raise KeyError(index)
+
+
+def fixed_controller(num_workers):
+    return ConcurrencyController(
+        min_workers=num_workers, max_workers=num_workers, interval_sec=float("inf")
+    )
+
+
+@pytest.fixture(autouse=True)
+def alarm():
+    # a hang fails the test instead of blocking the run
+    signal.alarm(60)
+    yield
+    signal.alarm(0)
+
+
+def test_results_are_in_task_order():
+    workers = TunedWorkers(mp.get_context("fork"), square_worker, (), fixed_controller(3))
+    assert workers.run(list(range(20))) == [i * i for i in range(20)]
+    assert mp.active_children() == []
+
+
+def test_task_that_kills_its_worker_gets_error_result():
+    workers = TunedWorkers(mp.get_context("fork"), square_worker, (7,), fixed_controller(2))
+    results = workers.run(list(range(20)), error_result="error")
+
+    assert results[7] == "error"
+    assert results[:7] + results[8:] == [i * i for i in range(20) if i != 7]
+    assert mp.active_children() == []
+
+
+def test_exception_in_the_parent_does_not_hang():
+    workers = TunedWorkers(mp.get_context("fork"), slow_worker, (), fixed_controller(2))
+    workers.shutdown_timeout_sec = 2.0
+    start_time = time.time()
+    with pytest.raises(KeyError):
+        workers.run(FailingQueue(enumerate(range(10))))
+
+    assert time.time() - start_time < 5
+    assert mp.active_children() == []
+
+
+def test_memory_limit_requires_psutil(monkeypatch):
+    import autotune
+    monkeypatch.setattr(autotune, "psutil", None)
+    with pytest.raises(ImportError):
+        ConcurrencyController(max_workers=2, memory_limit_mb=1024)
+
+    # without a limit, psutil stays optional
+    ConcurrencyController(max_workers=2)
@@ -0,0 +1,19 @@
+import pandas as pd
+from category_codes import CategoryCodes
+
+
+def test_codes_are_stable_across_runs(tmp_path):
+    table = ["new", "used"]
+    codes = CategoryCodes(tmp_path / "codes.sqlite3")
+    first = codes.to_categorical("quality", pd.Series(["used", "broken", None, "new"]), table)
+    codes.close()
+
+    codes = CategoryCodes(tmp_path / "codes.sqlite3")
+    second = codes.to_categorical("quality", pd.Series(["antique", "broken", "used"]), table)
+    other = codes.to_categorical("shipping_from", pd.Series(["Tokyo"]))
+    codes.close()
+
+    assert first.codes.tolist() == [1, 2, -1, 0]
+    assert second.codes.tolist() == [3, 2, 1]
+    assert list(second.categories) == ["new", "used", "broken", "antique"]
+    assert other.codes.tolist() == [0]
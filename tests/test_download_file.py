@@ -0,0 +1,76 @@
+import os
+import gzip
+import boto3
+import pytest
+import util
+
+
+class FakeStreamResponse(object):
+    def __init__(self, chunks, content_type="text/html", fail_after=None):
+        self.status_code = 200
+        self.headers = {"Content-Type": content_type}
+        self.chunks = chunks
+        self.fail_after = fail_after
+
+    def iter_content(self, chunk_size):
+        for i, chunk in enumerate(self.chunks):
+            if i == self.fail_after:
+                raise ConnectionError("connection reset")
+            yield chunk
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    def __init__(self, response):
+        self.response = response
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def get(self, url, **kwargs):
+        return self.response
+
+
+@pytest.fixture
+def use_response(monkeypatch):
+    def use_response(response):
+        monkeypatch.setitem(util._sessions, (os.getpid(), util.http_config["http2"]), FakeSession(response))
+    return use_response
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_failed_stream_leaves_no_file(use_response, tmp_path, compress):
+    use_response(FakeStreamResponse([b"<html>", b"partial", b"</html>"], "text/html; charset=Shift_JIS", fail_after=2))
+
+    assert util.download_file("http://example.com", tmp_path / "m1.html", compress=compress) is False
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_download_keeps_declared_encoding(use_response, tmp_path):
+    use_response(FakeStreamResponse([b"<html>", b"</html>"], "text/html; charset=Shift_JIS"))
+
+    assert util.download_file("http://example.com", tmp_path / "m1.html", compress=True) is True
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["m1.html.gz", "m1.html.gz.encoding"]
+    assert gzip.decompress((tmp_path / "m1.html.gz").read_bytes()) == b"<html></html>"
+    assert util.read_html_bytes(tmp_path / "m1.html.gz") == (b"<html></html>", "Shift_JIS")
+
+
+def test_s3_save_file_uploads_the_encoding(use_response, tmp_path, monkeypatch):
+    moto = pytest.importorskip("moto")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(util, "temp_dir", tmp_path / "temp")
+    use_response(FakeStreamResponse([b"<html></html>"], "text/html; charset=EUC-JP"))
+
+    with moto.mock_aws():
+        s3_bucket = boto3.resource("s3").create_bucket(Bucket="test-bucket")
+        assert util.s3_save_file("http://example.com", s3_bucket, "downloader/m1_t.html") is True
+        keys = sorted(o.key for o in s3_bucket.objects.all())
+        encoding = s3_bucket.Object("downloader/m1_t.html.encoding").get()["Body"].read()
+
+    assert keys == ["downloader/m1_t.html", "downloader/m1_t.html.encoding"]
+    assert encoding == b"EUC-JP"
+    assert list((tmp_path / "temp").iterdir()) == []
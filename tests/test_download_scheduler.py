@@ -0,0 +1,105 @@
+import sqlite3
+import pandas as pd
+from download_scheduler import DownloadScheduler
+
+
+def test_record_fetches_ignores_fetches_already_recorded(tmp_path):
+    scheduler = DownloadScheduler(tmp_path / "schedule.sqlite3", base_interval_sec=100, backoff=2.0)
+    try:
+        scheduler.add_items(["m1"], now=0)
+        changes = pd.DataFrame({
+            "item_id": ["m1"], "fetched_at": [10.0], "changed": [False], "is_soldout": [False],
+        })
+        scheduler.record_fetches(changes)
+        scheduler.record_fetches(changes)
+        scheduler.record_fetches(changes.assign(fetched_at=5.0))
+        interval, next_due = scheduler.conn.execute(
+            "SELECT interval, next_due FROM schedule WHERE item_id = 'm1'"
+        ).fetchone()
+
+        scheduler.record_fetches(changes.assign(fetched_at=20.0))
+        later_interval = scheduler.conn.execute(
+            "SELECT interval FROM schedule WHERE item_id = 'm1'"
+        ).fetchone()[0]
+    finally:
+        scheduler.close()
+
+    assert interval == 200
+    assert next_due == 210
+    assert later_interval == 400
+
+
+def test_record_downloads_retires_gone_items_and_backs_off_failures(tmp_path):
+    scheduler = DownloadScheduler(tmp_path / "schedule.sqlite3", base_interval_sec=100, backoff=2.0)
+    try:
+        scheduler.add_items(["ok", "gone", "failed"], now=0)
+        assert sorted(scheduler.select(3, now=0)) == ["failed", "gone", "ok"]
+        counts = scheduler.record_downloads(
+            ["ok", "gone", "failed", "unknown"], [True, False, False, False], [False, True, False, False], now=10
+        )
+        rows = {
+            r[0]: r[1:] for r in scheduler.conn.execute(
+                "SELECT item_id, next_due, interval, num_failures, is_retired FROM schedule"
+            )
+        }
+        scheduler.record_downloads(["failed"], [False], [False], now=20)
+        failed_again = scheduler.conn.execute(
+            "SELECT next_due, num_failures FROM schedule WHERE item_id = 'failed'"
+        ).fetchone()
+        # the retired item is never selected again
+        selected = scheduler.select(10, now=10 ** 9)
+    finally:
+        scheduler.close()
+
+    assert counts == {"retired": 1, "failed": 1, "downloaded": 1}
+    assert rows["ok"] == (210, 200, 0, 0)
+    assert rows["gone"][-1] == 1
+    assert rows["failed"] == (210, 100, 1, 0)
+    assert failed_again == (420, 2)
+    assert sorted(selected) == ["failed", "ok"]
+
+
+def test_downloads_and_fetches_back_off_once(tmp_path):
+    scheduler = DownloadScheduler(tmp_path / "schedule.sqlite3", base_interval_sec=100, backoff=2.0)
+    changes = pd.DataFrame({
+        "item_id": ["m1"], "fetched_at": [5.0], "changed": [False], "is_soldout": [False],
+    })
+    try:
+        # downloader first, then the parser
+        scheduler.add_items(["m1"], now=0)
+        scheduler.select(1, now=0)
+        scheduler.record_downloads(["m1"], [True], [False], now=10)
+        scheduler.record_fetches(changes)
+        interval = scheduler.conn.execute("SELECT interval FROM schedule WHERE item_id = 'm1'").fetchone()[0]
+
+        # parser first, then the downloader
+        scheduler.select(1, now=300)
+        scheduler.record_fetches(changes.assign(fetched_at=305.0))
+        scheduler.record_downloads(["m1"], [True], [False], now=310)
+        later_interval, next_due = scheduler.conn.execute(
+            "SELECT interval, next_due FROM schedule WHERE item_id = 'm1'"
+        ).fetchone()
+    finally:
+        scheduler.close()
+
+    assert interval == 200
+    assert later_interval == 400
+    assert next_due == 705
+
+
+def test_old_schedule_is_migrated(tmp_path):
+    path = tmp_path / "schedule.sqlite3"
+    conn = sqlite3.connect(str(path))
+    conn.execute(
+        "CREATE TABLE schedule (item_id TEXT PRIMARY KEY, next_due REAL NOT NULL, interval REAL NOT NULL, "
+        "last_fetched REAL, last_changed REAL, is_soldout INTEGER NOT NULL DEFAULT 0)"
+    )
+    conn.execute("INSERT INTO schedule (item_id, next_due, interval) VALUES ('m1', 0, 100)")
+    conn.commit()
+    conn.close()
+
+    scheduler = DownloadScheduler(path)
+    try:
+        assert scheduler.select(1, now=0) == ["m1"]
+    finally:
+        scheduler.close()
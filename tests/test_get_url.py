@@ -0,0 +1,62 @@
+import os
+import util
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession(object):
+    def __init__(self, status_codes):
+        self.responses = [FakeResponse(c) for c in status_codes]
+        self.num_calls = 0
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def get(self, url, **kwargs):
+        response = self.responses[self.num_calls]
+        self.num_calls += 1
+        return response
+
+
+def use_session(monkeypatch, session):
+    monkeypatch.setitem(util._sessions, (os.getpid(), util.http_config["http2"]), session)
+
+
+def test_get_url_closes_failed_responses(monkeypatch):
+    session = FakeSession([503, 404, 200])
+    use_session(monkeypatch, session)
+
+    response = util.get_url("http://example.com", retry_interval=0, stream=True)
+    assert response is session.responses[2]
+    assert [r.closed for r in session.responses] == [True, True, False]
+
+
+def test_get_url_gives_up_with_every_response_closed(monkeypatch):
+    session = FakeSession([500, 500])
+    use_session(monkeypatch, session)
+
+    assert util.get_url("http://example.com", num_retry=1, retry_interval=0, stream=True) is None
+    assert all(r.closed for r in session.responses)
+
+
+def test_http2_falls_back_to_requests_without_h2(monkeypatch):
+    import builtins
+    real_import = builtins.__import__
+
+    def import_without_httpx(name, *args, **kwargs):
+        if name in ("httpx", "h2"):
+            raise ImportError(f"No module named '{name}'")
+        return real_import(name, *args, **kwargs)
+
+    monkeypatch.setattr(util, "_sessions", {})
+    monkeypatch.setattr(builtins, "__import__", import_without_httpx)
+    session = util.get_session(http2=True)
+    assert hasattr(session, "mount")
+    assert util.get_session(http2=True) is session
@@ -0,0 +1,55 @@
+import pandas as pd
+from item_history import ItemHistory
+
+
+def make_result(rows):
+    return pd.DataFrame([
+        {
+            "item_id": item_id,
+            "fetched_at": pd.Timestamp(fetched_at, tz="Asia/Tokyo"),
+            "price": price,
+            "is_soldout": is_soldout,
+            "parse_success": True,
+        }
+        for item_id, fetched_at, price, is_soldout in rows
+    ])
+
+
+def test_update_is_idempotent(tmp_path):
+    result_df = make_result([
+        ("m1", "2026-01-01 10:00", 1000, False),
+        ("m1", "2026-01-02 10:00", 900, False),
+    ])
+    history = ItemHistory(tmp_path / "history.sqlite3")
+    try:
+        first = history.update(result_df)
+        second = history.update(result_df)
+        third = history.update(result_df)
+        num_deltas = history.conn.execute("SELECT COUNT(*) FROM item_delta").fetchone()[0]
+        state = history.get_current(["m1"])
+    finally:
+        history.close()
+
+    assert first["changed"].tolist() == [True]
+    assert len(second) == 0 and len(third) == 0
+    assert num_deltas == 2
+    assert state["price"].tolist() == [900]
+    assert state["last_seen"].tolist() == [first["fetched_at"].iloc[0]]
+
+
+def test_old_fetches_do_not_move_the_state_back(tmp_path):
+    history = ItemHistory(tmp_path / "history.sqlite3")
+    try:
+        history.update(make_result([("m1", "2026-01-02 10:00", 900, False)]))
+        changes = history.update(make_result([
+            ("m1", "2026-01-01 10:00", 1000, False),
+            ("m1", "2026-01-03 10:00", 900, True),
+        ]))
+        state = history.get_current(["m1"])
+        series = history.get_price_series("m1")
+    finally:
+        history.close()
+
+    assert changes["changed"].tolist() == [True]
+    assert state["is_soldout"].tolist() == [1]
+    assert series["price"].tolist() == [900, 900]
@@ -0,0 +1,42 @@
+import os
+import multiprocessing as mp
+import pytest
+import util
+import profiler
+
+
+def log_in_worker(log_dir, message):
+    logger = util.Logger.setup_logger("worker_test", log_dir=log_dir)
+    logger.info(message)
+    return os.getpid()
+
+
+def read_logs(log_dir):
+    return "".join(p.read_text(encoding="UTF-8") for p in log_dir.glob("*.log"))
+
+
+@pytest.mark.parametrize("start_method", ["fork", "forkserver"])
+def test_worker_records_reach_the_log_file(tmp_path, start_method):
+    log_dir = tmp_path / start_method
+    messages = [f"{start_method} worker message {i}" for i in range(4)]
+    with mp.get_context(start_method).Pool(2, **profiler.get_pool_kwargs()) as p:
+        pids = p.starmap(log_in_worker, [(str(log_dir), m) for m in messages])
+        p.close()
+        p.join()
+
+    util.Logger.flush()
+    text = read_logs(log_dir)
+    assert os.getpid() not in pids
+    for message in messages:
+        assert message in text
+    assert "[INFO/" in text
+
+
+def test_setup_logger_does_not_stack_handlers(tmp_path):
+    logger = util.Logger.setup_logger("stack_test", log_dir=tmp_path)
+    logger = util.Logger.setup_logger("stack_test", log_dir=tmp_path)
+    logger.info("only once")
+
+    util.Logger.flush()
+    assert len(logger.handlers) == 1
+    assert read_logs(tmp_path).count("only once") == 1
@@ -0,0 +1,96 @@
+import sys
+import pathlib
+import urllib.parse
+import pytest
+pytest.importorskip("selenium")
+from selenium.common.exceptions import NoSuchWindowException
+
+import util
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+from mercari.crawler import MercariCrawler
+
+
+class FakeSwitchTo(object):
+    def __init__(self, driver):
+        self.driver = driver
+
+    def window(self, handle):
+        if handle not in self.driver.urls:
+            raise NoSuchWindowException(handle)
+        self.driver.current = handle
+
+
+class FakeDriver(object):
+    """
+    Tabs of a browser: a closed tab cannot be used until the driver switches to another one
+    """
+    def __init__(self, num_pages):
+        self.num_pages = num_pages
+        self.urls = {"main": None}
+        self.current = "main"
+        self.next_id = 0
+        self.switch_to = FakeSwitchTo(self)
+        self.num_opened = 0
+
+    def check_window(self):
+        if self.current not in self.urls:
+            raise NoSuchWindowException(self.current)
+
+    @property
+    def current_window_handle(self):
+        self.check_window()
+        return self.current
+
+    @property
+    def window_handles(self):
+        return list(self.urls)
+
+    def get(self, url):
+        self.check_window()
+        self.urls[self.current] = url
+
+    def close(self):
+        self.check_window()
+        del self.urls[self.current]
+
+    def execute_script(self, script, *args):
+        self.check_window()
+        if script.startswith("window.open"):
+            self.next_id += 1
+            self.num_opened += 1
+            self.urls[f"tab{self.next_id}"] = args[0]
+            return None
+
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.urls[self.current]).query)
+        page = int(query["page_token"][0].split(":")[1]) if "page_token" in query else 0
+        if page >= self.num_pages:
+            return []
+        return [[f"/item/m{page}{i}"] for i in range(2)]
+
+
+def make_crawler(driver, prefetch_depth):
+    crawler = MercariCrawler.__new__(MercariCrawler)
+    crawler.logger = util.Logger.setup_logger(logger_name=__name__)
+    crawler.is_test = False
+    crawler.wait_sec = 0
+    crawler.extract_mode = "js"
+    crawler.with_details = False
+    crawler.prefetch_depth = prefetch_depth
+    crawler.driver = driver
+    crawler.wait_items = lambda: True
+    return crawler
+
+
+@pytest.mark.parametrize("prefetch_depth", [1, 2])
+def test_prefetch_crawl_opens_and_closes_tabs(prefetch_depth):
+    driver = FakeDriver(num_pages=4)
+    crawler = make_crawler(driver, prefetch_depth)
+
+    df = crawler.crawl_url("https://jp.mercari.com/search?keyword=PS5")
+
+    assert df["item_id"].tolist() == [f"m{p}{i}" for p in range(4) for i in range(2)]
+    # only the main tab is left, and the driver is back on it
+    assert driver.window_handles == ["main"]
+    assert driver.current == "main"
+    assert driver.num_opened >= 4
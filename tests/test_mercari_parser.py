@@ -0,0 +1,75 @@
+import sys
+import pathlib
+import pytest
+pytest.importorskip("bs4")
+pytest.importorskip("lxml")
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+from mercari.parser import MercariParser
+
+fixture_dir = pathlib.Path(__file__).parent / "fixtures/mercari"
+
+
+def test_next_data_picks_the_item_of_the_page():
+    result = MercariParser.parse_html(fixture_dir / "m123_2024-01-01-00-00-00.html")
+
+    assert result["parse_success"], result
+    assert result["parse_source"] == "json"
+    # the recommended item m999 comes first in the payload
+    assert result["item_id"] == "m123"
+    assert result["item_name"] == "テスト商品"
+    assert result["URL"] == "https://jp.mercari.com/item/m123"
+    assert result["price"] == 1500
+    assert result["is_soldout"] is False
+    assert [result["category_1"], result["category_2"], result["category_3"]] == ["本・雑誌・漫画", "本", "文学/小説"]
+    # the epoch seconds are converted to JST
+    assert result["last_updated"] == "2023-11-15 07:13:20"
+    assert result["brand"] is None
+    assert result["quality"] == "未使用に近い"
+    assert result["shipping_days"] == "2~3日で発送"
+
+
+def test_captured_api_response():
+    result = MercariParser.parse_html(fixture_dir / "m456_2024-01-01-00-00-00.json")
+
+    assert result["parse_success"], result
+    assert result["parse_source"] == "api"
+    assert result["item_id"] == "m456"
+    assert result["price"] == 3000
+    assert result["is_soldout"] is True
+    assert result["last_updated"] == "2023-11-15 08:13:20"
+
+
+def test_captured_response_without_the_item_fails(tmp_path):
+    path = tmp_path / "m000_2024-01-01-00-00-00.json"
+    path.write_bytes((fixture_dir / "m456_2024-01-01-00-00-00.json").read_bytes())
+    result = MercariParser.parse_html(path)
+
+    assert result["parse_success"] is False
+    assert result["parse_error"] == "ValueError"
+
+
+@pytest.mark.parametrize("parse_mode", ["auto", "dom"])
+def test_dom_fallback(parse_mode):
+    path = fixture_dir / "m789_2024-01-01-00-00-00.html"
+    result = MercariParser.parse_html(path, parse_mode=parse_mode)
+
+    assert result["parse_success"], result
+    assert result["parse_source"] == "dom"
+    assert result["item_id"] == "m789"
+    assert result["item_name"] == "DOMの商品"
+    assert result["price"] == 2800
+    assert result["is_soldout"] is False
+    assert [result["category_1"], result["category_2"]] == ["家電・スマホ・カメラ", "スマートフォン/携帯電話"]
+    assert result["brand"] == "Apple"
+    assert result["last_updated"] == "3日前"
+    assert result["shipping_from"] == "大阪府"
+
+
+def test_decoded_content_parses_like_bytes():
+    path = fixture_dir / "m123_2024-01-01-00-00-00.html"
+    content = path.read_bytes()
+    from_bytes = MercariParser.parse_html(path, content)
+    from_str = MercariParser.parse_html(path, content.decode())
+
+    assert from_bytes == from_str
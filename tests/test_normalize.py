@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import util
+import normalize
+
+
+def jst(text):
+    return pd.Timestamp(text, tz=util.JST)
+
+
+def test_parse_fetch_time_keeps_the_index_and_coerces_bad_names():
+    names = pd.Series(
+        ["m1_2024-01-02-03-04-05.html", "m2_2024-01-02-03-04-05.json", "bad.html", None, "m3_2024-13-02-03-04-05.html"],
+        index=[5, 6, 7, 8, 9]
+    )
+    fetched_at = normalize.parse_fetch_time(names)
+
+    assert fetched_at.index.tolist() == [5, 6, 7, 8, 9]
+    assert fetched_at[5] == jst("2024-01-02 03:04:05")
+    assert fetched_at[6] == jst("2024-01-02 03:04:05")
+    assert fetched_at[[7, 8, 9]].isna().all()
+
+
+def test_relative_time_to_timestamp():
+    texts = pd.Series(["3日前", "1時間前", "12 分前", "0秒前", "2ヶ月前", "1年前", "2022-07-04 11:09:07", "たった今", np.nan])
+    anchors = pd.Series([jst("2024-01-10 00:00:00")] * (len(texts) - 1) + [jst("2024-01-11 00:00:00")])
+    timestamps = normalize.relative_time_to_timestamp(texts, anchors)
+
+    assert timestamps.tolist()[:7] == [
+        jst("2024-01-07 00:00:00"),
+        jst("2024-01-09 23:00:00"),
+        jst("2024-01-09 23:48:00"),
+        jst("2024-01-10 00:00:00"),
+        jst("2023-11-11 00:00:00"),
+        jst("2023-01-10 00:00:00"),
+        jst("2022-07-04 11:09:07"),
+    ]
+    # unparseable and missing texts become NaT
+    assert timestamps[7:].isna().all()
+
+
+def test_relative_time_uses_the_anchor_of_each_row():
+    texts = pd.Series(["1日前", "1日前"])
+    anchors = pd.Series([jst("2024-01-10 00:00:00"), pd.NaT])
+    timestamps = normalize.relative_time_to_timestamp(texts, anchors)
+
+    assert timestamps[0] == jst("2024-01-09 00:00:00")
+    assert pd.isna(timestamps[1])
+
+
+def test_range_to_min_max():
+    texts = pd.Series(["2~3日で発送", "1〜2日", "4-7日", "4日", "未定", None], index=list("abcdef"))
+    days_min, days_max = normalize.range_to_min_max(texts)
+
+    assert str(days_min.dtype) == "Int64"
+    assert days_min.index.tolist() == list("abcdef")
+    assert days_min.tolist()[:4] == [2, 1, 4, 4]
+    assert days_max.tolist()[:4] == [3, 2, 7, 4]
+    assert days_min[["e", "f"]].isna().all()
+    assert days_max[["e", "f"]].isna().all()
+
+
+def test_empty_input():
+    days_min, days_max = normalize.range_to_min_max(pd.Series([], dtype=object))
+    assert len(days_min) == len(days_max) == 0
+    assert len(normalize.parse_fetch_time(pd.Series([], dtype=object))) == 0
@@ -0,0 +1,46 @@
+import sys
+import importlib
+from parse_cache import ParseCache
+
+
+parser_source = '''
+class BaseParser(object):
+    def parse(self, content):
+        return {"length": len(content)}
+
+
+class Parser(BaseParser):
+    pass
+'''
+
+
+def load_parser(tmp_path, source):
+    (tmp_path / "fake_parser.py").write_text(source)
+    sys.modules.pop("fake_parser", None)
+    return importlib.import_module("fake_parser").Parser
+
+
+def test_version_follows_base_classes_and_modules(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / "fake_helper.py").write_text("def helper():\n    return 1\n")
+    parser_cls = load_parser(tmp_path, parser_source)
+    version = ParseCache.get_version(parser_cls, "auto")
+
+    assert ParseCache.get_version(parser_cls, "auto") == version
+    assert ParseCache.get_version(parser_cls, "dom") != version
+    assert ParseCache.get_version(parser_cls, "auto", modules=("fake_helper",)) != version
+
+    parser_cls = load_parser(tmp_path, parser_source.replace("len(content)", "len(content) + 1"))
+    assert ParseCache.get_version(parser_cls, "auto") != version
+    sys.modules.pop("fake_parser", None)
+
+
+def test_purge_old_versions(tmp_path):
+    old = ParseCache(tmp_path / "cache.sqlite3", "old")
+    old.put_many([(b"a", {"price": 1})])
+    new = ParseCache(tmp_path / "cache.sqlite3", "new")
+    new.put_many([(b"a", {"price": 2})])
+
+    new.purge_old_versions()
+    assert old.get(b"a") is None
+    assert new.get(b"a") == {"price": 2}
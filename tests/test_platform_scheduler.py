@@ -0,0 +1,121 @@
+import collections
+import pytest
+import crawler_base as cb
+import platform_scheduler
+from platform_scheduler import TokenBucket, FairQueue, DownloadQueue
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class FakeDownloader(object):
+    max_retry = 1
+
+    @staticmethod
+    def get_blocked_wait_sec(num_blocked):
+        return 30.0 * num_blocked
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(platform_scheduler, "time", clock)
+    return clock
+
+
+def pop_platforms(task_queue, n):
+    popped = [task_queue.pop() for _ in range(n)]
+    return collections.Counter(task_queue.get_platform(item[0]) for item in popped if item is not None)
+
+
+def test_token_bucket_limits_the_rate(clock):
+    bucket = TokenBucket(rate_per_sec=10, burst=2)
+    assert bucket.get_wait_sec() == 0
+    bucket.take()
+    bucket.take()
+    assert bucket.get_wait_sec() == pytest.approx(0.1)
+
+    clock.now += 0.05
+    assert bucket.get_wait_sec() == pytest.approx(0.05)
+    # the tokens saved up while idle never exceed the burst
+    clock.now += 60
+    bucket.take()
+    bucket.take()
+    assert bucket.get_wait_sec() == pytest.approx(0.1)
+
+
+def test_fair_queue_shares_by_weight(clock):
+    task_queue = FairQueue({"a": 1, "b": 3})
+    for i in range(100):
+        task_queue.add("a", i)
+        task_queue.add("b", i)
+
+    assert pop_platforms(task_queue, 40) == {"a": 10, "b": 30}
+
+
+def test_fair_queue_returning_platform_does_not_catch_up(clock):
+    task_queue = FairQueue({"a": 1, "b": 1})
+    for i in range(20):
+        task_queue.add("a", i)
+    pop_platforms(task_queue, 10)
+
+    for i in range(20):
+        task_queue.add("b", i)
+    assert pop_platforms(task_queue, 10) == {"a": 5, "b": 5}
+
+
+def test_fair_queue_skips_paused_and_rate_limited_platforms(clock):
+    task_queue = FairQueue({"a": 1, "b": 1}, buckets={"b": TokenBucket(rate_per_sec=1, burst=1)})
+    for i in range(10):
+        task_queue.add("a", i)
+        task_queue.add("b", i)
+
+    # b gets one task from its bucket, then only a until the bucket refills
+    assert pop_platforms(task_queue, 4) == {"a": 3, "b": 1}
+    task_queue.pause("a", 5.0)
+    assert task_queue.pop() is None
+    assert task_queue.get_wait_sec() == pytest.approx(1.0)
+
+    clock.now += 1.0
+    assert pop_platforms(task_queue, 2) == {"b": 1}
+    clock.now += 4.0
+    assert pop_platforms(task_queue, 3) == {"a": 2, "b": 1}
+
+
+def test_download_queue_retries_blocked_pages_after_a_pause(clock):
+    task_queue = DownloadQueue({"a": 1, "b": 1})
+    index_a = task_queue.add("a", (FakeDownloader, "a1", 0, ()))
+    task_queue.add("b", (FakeDownloader, "b1", 0, ()))
+
+    index, task = task_queue.pop()
+    assert index == index_a
+    assert task_queue.finish(index, task, cb.PageState.BLOCKED) is False
+
+    # a is paused, so the other platform goes on
+    index, task = task_queue.pop()
+    assert task[1] == "b1"
+    assert task_queue.finish(index, task, cb.PageState.LOADED) is True
+    assert task_queue.pop() is None
+    assert task_queue.get_wait_sec() == pytest.approx(30.0)
+
+    clock.now += 30.0
+    index, task = task_queue.pop()
+    assert (index, task[1], task[2]) == (index_a, "a1", 1)
+    # no tries left: the page is done, and the next block waits longer
+    assert task_queue.finish(index, task, cb.PageState.BLOCKED) is True
+    assert len(task_queue) == 0
+    assert task_queue.paused_until["a"] == pytest.approx(clock.now + 60.0)
+    assert "a" in task_queue.finished_at
+
+
+def test_download_queue_does_not_retry_deleted_pages(clock):
+    task_queue = DownloadQueue({"a": 1})
+    task_queue.add("a", (FakeDownloader, "a1", 0, ()))
+    index, task = task_queue.pop()
+    assert task_queue.finish(index, task, cb.PageState.DELETED) is True
+    assert len(task_queue) == 0
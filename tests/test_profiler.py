@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+import signal
+import threading
+import multiprocessing as mp
+import pytest
+import profiler
+
+
+def wait_for_event(event):
+    event.wait()
+
+
+def busy(sec):
+    deadline = time.time() + sec
+    while time.time() < deadline:
+        pass
+    return sec
+
+
+def test_sample_covers_all_threads():
+    event = threading.Event()
+    thread = threading.Thread(target=wait_for_event, args=(event,), name="waiter")
+    thread.start()
+    try:
+        sampler = profiler.SamplingProfiler(interval=0.001)
+        sampler.start()
+        busy(0.1)
+        sampler.stop()
+    finally:
+        event.set()
+        thread.join()
+
+    collapsed = sampler.get_collapsed(root="main")
+    assert any(s.startswith("main;waiter;") and "test_profiler:wait_for_event" in s for s in collapsed)
+    assert any(s.startswith("main;MainThread;") and "test_profiler:busy" in s for s in collapsed)
+    # the sampling thread does not sample itself
+    assert not any(s.startswith("main;SamplingProfiler;") for s in collapsed)
+
+
+def test_merge_waits_for_the_workers_to_flush(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiler, "_config", (str(tmp_path), 0.005, True))
+    old_path = tmp_path / "worker_1.collapsed"
+    old_path.write_text("worker;MainThread;old 1\n")
+    previous = {1: profiler.get_mtime_ns(old_path), 2: None}
+
+    merge = threading.Thread(target=profiler.merge_after_flush, args=(previous, 5.0))
+    merge.start()
+    time.sleep(0.2)
+    assert not (tmp_path / "profile.collapsed").exists()
+
+    profiler.write_collapsed({"worker;MainThread;new": 2}, tmp_path / "worker_2.collapsed")
+    # a rewrite replaces the file, as SamplingProfiler.dump does
+    new_path = tmp_path / "worker_1.tmp"
+    profiler.write_collapsed({"worker;MainThread;new": 1}, new_path)
+    os.utime(new_path, ns=(previous[1] + 10 ** 9, previous[1] + 10 ** 9))
+    os.replace(new_path, old_path)
+    merge.join(timeout=5.0)
+
+    assert not merge.is_alive()
+    assert profiler.read_collapsed(tmp_path / "profile.collapsed") == {"worker;MainThread;new": 3}
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGUSR1") or sys.platform != "linux", reason="needs SIGUSR1 and fork")
+def test_sigusr1_stop_merges_the_worker_profiles(tmp_path, monkeypatch):
+    for name in ["_config", "_profiler", "_merge_thread"]:
+        monkeypatch.setattr(profiler, name, getattr(profiler, name))
+    previous_handler = signal.getsignal(signal.SIGUSR1)
+    try:
+        output_dir = profiler.setup(tmp_path, interval=0.001, signal_only=True)
+        with mp.get_context("fork").Pool(2, **profiler.get_pool_kwargs()) as pool:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            result = pool.map_async(busy, [0.3, 0.3])
+            time.sleep(0.2)
+            os.kill(os.getpid(), signal.SIGUSR1)
+            profiler._merge_thread.join(timeout=10.0)
+            result.wait()
+
+        collapsed = profiler.read_collapsed(output_dir / "profile.collapsed")
+    finally:
+        if profiler._profiler is not None:
+            profiler._profiler.stop()
+        signal.signal(signal.SIGUSR1, previous_handler)
+
+    assert any(s.startswith("worker;") and "test_profiler:busy" in s for s in collapsed)
+    assert any(s.startswith("main;") for s in collapsed)
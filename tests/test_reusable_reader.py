@@ -0,0 +1,39 @@
+import gzip
+import util
+
+
+def test_reads_plain_files_and_grows_the_buffer(tmp_path):
+    small = tmp_path / "small.html"
+    large = tmp_path / "large.html"
+    small.write_bytes(b"<p>small</p>")
+    large.write_bytes(b"x" * 100)
+
+    reader = util.ReusableReader(initial_size=16)
+    content, encoding = reader.read(small)
+    assert bytes(content) == b"<p>small</p>"
+    assert encoding is None
+
+    content, encoding = reader.read(large)
+    assert bytes(content) == b"x" * 100
+    assert len(reader.buffer) >= 100
+
+    # a smaller file afterwards only returns its own bytes
+    content, _ = reader.read(small)
+    assert bytes(content) == b"<p>small</p>"
+
+
+def test_reads_gzipped_files_and_encoding_side_files(tmp_path):
+    html = "<p>価格</p>"
+    path = tmp_path / "item.html.gz"
+    with gzip.open(path, "wb") as f:
+        f.write(html.encode("shift_jis"))
+    (tmp_path / "item.html.gz.encoding").write_text("shift_jis\n")
+
+    content, encoding = util.ReusableReader().read(path)
+    assert encoding == "shift_jis"
+    assert util.decode_html(content, encoding) == html
+
+
+def test_missing_files_and_unknown_encodings(tmp_path):
+    assert util.ReusableReader().read(tmp_path / "missing.html") == (None, None)
+    assert util.decode_html(memoryview("価格".encode()), "no-such-codec") == "価格"
@@ -0,0 +1,33 @@
+import pathlib
+import pandas as pd
+from run_summary import RunSummary, RunReport
+
+
+def test_outcomes_are_spooled_and_combined(tmp_path, monkeypatch):
+    monkeypatch.setattr(RunSummary, "chunk_rows", 3)
+    summary = RunSummary("mercari", "downloader", num_samples=2)
+    summary.extend(["m1", "m2", "m3"], [True, False, False], [None, "timeout", None])
+    summary.extend(["m4", "m5"], [False, True], ["timeout", "ignored"])
+    summary.add("m6", True)
+
+    assert len(summary.part_paths) == 2
+    assert (summary.num_items, summary.num_success) == (6, 3)
+    assert summary.failure_reasons == {"timeout": 2, "failed": 1}
+    assert len(summary.failed_samples) == 2
+    assert set(summary.failed_samples) <= {"m2", "m3", "m4"}
+
+    spool_dir = pathlib.Path(summary.spool_dir)
+    output_path = summary.save(tmp_path)
+    assert not spool_dir.exists()
+
+    df = pd.read_parquet(output_path)
+    assert df["item_id"].tolist() == ["m1", "m2", "m3", "m4", "m5", "m6"]
+    assert df["reason"].fillna("").tolist() == ["", "timeout", "failed", "timeout", "", ""]
+    assert summary.to_df()["success"].tolist() == df["success"].tolist()
+
+    report = RunReport()
+    report.add(summary)
+    report.add(RunSummary("mercari", "parser"))
+    report_df = pd.read_parquet(report.save(tmp_path))
+    assert len(report_df) == 6
+    assert set(report_df["stage"]) == {"downloader"}
@@ -0,0 +1,93 @@
+import boto3
+import pytest
+moto = pytest.importorskip("moto")
+import util
+from s3_listing import S3Lister, ListingManifest
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        s3_bucket = boto3.resource("s3").create_bucket(Bucket="test-bucket")
+        yield s3_bucket
+
+
+def put_keys(s3_bucket, keys):
+    for key in keys:
+        s3_bucket.put_object(Key=key, Body=b"")
+
+
+def make_lister(s3_bucket, manifest_path=None):
+    lister = S3Lister(s3_bucket, num_threads=4, manifest_path=manifest_path)
+    # small pages so that the ranges are split over the threads
+    lister.page_size = 7
+    return lister
+
+
+def test_sharded_listing_yields_every_key_once(s3_bucket):
+    keys = [f"html/{i:04d}_item.html" for i in range(150)] + ["other/0001.html"]
+    put_keys(s3_bucket, keys)
+
+    listed = [k for batch in make_lister(s3_bucket).iter_keys("html/") for k in batch]
+    assert sorted(listed) == keys[:-1]
+
+
+def test_partitioned_listing_reads_closed_partitions_from_manifest(s3_bucket, tmp_path):
+    keys = [f"out/date=2020-01-0{d}/{i:03d}.parquet" for d in (1, 2) for i in range(20)]
+    put_keys(s3_bucket, keys)
+    manifest_path = tmp_path / "manifest.sqlite3"
+
+    lister = make_lister(s3_bucket, manifest_path)
+    listed = [k for batch in lister.iter_keys("out/") for k in batch]
+    assert sorted(listed) == keys
+    lister.commit_keys(listed)
+
+    manifest = ListingManifest(manifest_path)
+    assert manifest.get_closed_partitions("out/") == {"out/date=2020-01-01/", "out/date=2020-01-02/"}
+    manifest.close()
+
+    listed = [k for batch in make_lister(s3_bucket, manifest_path).iter_keys("out/") for k in batch]
+    assert sorted(listed) == keys
+
+
+def test_partition_is_not_closed_before_its_keys_are_committed(s3_bucket, tmp_path):
+    keys = [f"out/date=2020-01-01/{i:03d}.parquet" for i in range(20)]
+    put_keys(s3_bucket, keys)
+    manifest_path = tmp_path / "manifest.sqlite3"
+
+    lister = make_lister(s3_bucket, manifest_path)
+    listed = [k for batch in lister.iter_keys("out/", new_only=True) for k in batch]
+    lister.commit_keys(listed[:5])
+
+    lister = make_lister(s3_bucket, manifest_path)
+    listed = [k for batch in lister.iter_keys("out/", new_only=True) for k in batch]
+    assert len(listed) == 15
+
+
+def test_new_only_skips_committed_keys_only(s3_bucket, tmp_path):
+    keys = [f"html/{i:04d}_item.html" for i in range(40)]
+    put_keys(s3_bucket, keys)
+    manifest_path = tmp_path / "manifest.sqlite3"
+
+    # stops in the middle of a batch, and only the keys returned are committed
+    lister = make_lister(s3_bucket, manifest_path)
+    first = util.s3_list_all_files(s3_bucket, "html/", size=10, new_only=True, lister=lister)
+    assert len(first) == 10
+    lister.commit_keys(first)
+
+    # keys listed by a run that is not committed, e.g. a failed parse, stay new
+    lister = make_lister(s3_bucket, manifest_path)
+    util.s3_list_all_files(s3_bucket, "html/", new_only=True, lister=lister)
+
+    put_keys(s3_bucket, ["html/9999_item.html"])
+    lister = make_lister(s3_bucket, manifest_path)
+    second = util.s3_list_all_files(s3_bucket, "html/", new_only=True, lister=lister)
+    assert sorted(second) == sorted(set(keys + ["html/9999_item.html"]) - set(first))
+
+
+def test_new_only_requires_manifest(s3_bucket):
+    with pytest.raises(ValueError):
+        list(make_lister(s3_bucket).iter_keys("html/", new_only=True))
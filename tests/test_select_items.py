@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+import id_codec
+import crawler_base as cb
+
+
+@pytest.fixture
+def downloader(tmp_path, monkeypatch):
+    class Downloader(cb.DownloaderBase):
+        platform = "test"
+        local_output_dir = tmp_path / "downloader"
+        item_id_prefix = "m"
+
+    monkeypatch.setattr(cb, "current_dir", tmp_path / "util")
+    return Downloader()
+
+
+def test_difference_keeps_the_input_order():
+    codes = np.array([30, 10, 30, 20, 10, 40], dtype=np.int64)
+    assert id_codec.difference(codes, np.array([20], dtype=np.int64)).tolist() == [30, 10, 40]
+
+
+def test_select_items_keeps_the_input_order(downloader):
+    selected = downloader.select_items(["m3", "m1", "m3", "m2"])
+    assert downloader.decode_item_ids(selected) == ["m3", "m1", "m2"]
+
+
+def test_select_items_skips_html_and_json_downloads(downloader):
+    for name in ("m1_2024-01-01-00-00-00.html", "m2_2024-01-01-00-00-00.html.gz", "m3_2024-01-01-00-00-00.json"):
+        (downloader.local_output_dir / name).write_text("")
+
+    selected = downloader.select_items(["m4", "m3", "m2", "m1", "m5"], skip_downloaded=True)
+    assert downloader.decode_item_ids(selected) == ["m4", "m5"]
@@ -0,0 +1,64 @@
+import os
+import collections
+import signal
+import threading
+import pytest
+import util
+import crawler_base as cb
+
+
+class Parser(cb.ParserBase):
+    platform = "test"
+    logger = util.Logger.setup_logger(logger_name=__name__)
+
+    @classmethod
+    def parse_html(cls, html_path, content=None, encoding=None):
+        return {"html": cls.get_html_name(html_path), "parse_success": content is not None}
+
+
+@pytest.fixture
+def parser(tmp_path, monkeypatch):
+    monkeypatch.setattr(cb, "current_dir", tmp_path / "util")
+    monkeypatch.setattr(Parser, "local_output_dir", tmp_path / "parser")
+    return Parser(num_threads=1, start_method="fork", use_cache=False)
+
+
+def test_drop_captured_htmls():
+    paths = ["d/m1_t.html", "d/m2_t.html.gz", "d/m1_t.json", "d/m3_t.json"]
+    assert cb.ParserBase.drop_captured_htmls(paths) == ["d/m2_t.html.gz", "d/m1_t.json", "d/m3_t.json"]
+
+
+def test_watcher_parses_each_download_once_and_summarizes(parser, tmp_path, monkeypatch):
+    html_dir = tmp_path / "html"
+    html_dir.mkdir()
+    summaries = []
+    monkeypatch.setattr(parser, "finish_parser", lambda summary: summaries.append(summary))
+
+    def download():
+        for name in ("m1_t.html", "m1_t.json", "m2_t.html"):
+            (html_dir / name).write_text("{}")
+        # a file reported again, e.g. rewritten in place
+        (html_dir / "m2_t.html").write_text("{}")
+        threading.Timer(3.0, os.kill, (os.getpid(), signal.SIGTERM)).start()
+
+    threading.Timer(1.0, download).start()
+    parser.run_watcher(html_dir, batch_wait_sec=10.0)
+
+    assert len(summaries) == 1
+    assert sorted(summaries[0].to_df()["item_id"]) == ["m1_t.json", "m2_t.html"]
+    assert summaries[0].num_success == 2
+
+
+def test_download_is_parsed_once_across_batches(parser, tmp_path):
+    html_dir = tmp_path / "html"
+    html_dir.mkdir()
+    for name in ("m1_t.html", "m1_t.json", "m2_t.json", "m2_t.html.gz"):
+        (html_dir / name).write_text("{}")
+
+    recent_downloads = collections.OrderedDict()
+    parser.max_recent_downloads = 2
+    first = parser.parse_micro_batch([str(html_dir / "m1_t.html"), str(html_dir / "m2_t.json")], None, 0, recent_downloads)
+    second = parser.parse_micro_batch([str(html_dir / "m1_t.json"), str(html_dir / "m2_t.html.gz")], None, 1, recent_downloads)
+
+    assert first["html"].tolist() == ["m1_t.html", "m2_t.json"]
+    assert len(second) == 0
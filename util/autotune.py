@@ -0,0 +1,464 @@
+import os
+import time
+import json
+import pathlib
+import collections
+import multiprocessing as mp
+import multiprocessing.connection
+import util
+import profiler
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+logger = util.logger
+
+
+def get_tree_rss_mb(pid=None):
+    """
+    RSS of the process and all its descendants (browsers included). None without psutil.
+    """
+    if psutil is None:
+        return None
+
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return None
+
+    rss = 0
+    for p in processes:
+        try:
+            rss += p.memory_info().rss
+        except psutil.Error:
+            continue
+
+    return rss / 1024 / 1024
+
+
+def get_cpu_percent():
+    if psutil is not None:
+        return psutil.cpu_percent(interval=None)
+
+    # the load average is the closest thing without psutil
+    return 100.0 * os.getloadavg()[0] / mp.cpu_count()
+
+
+def get_available_memory_mb():
+    if psutil is None:
+        return None
+
+    return psutil.virtual_memory().available / 1024 / 1024
+
+
+class ConcurrencyController(object):
+    """
+    Hill-climbs the number of workers toward the highest throughput.
+    Every interval_sec the throughput of the last interval is compared with the previous one:
+    the controller keeps moving in the same direction while it improves and turns back
+    when it does not. It shrinks when the error rate is too high or memory runs short,
+    and does not grow while the CPU is saturated or one more worker would not fit in memory.
+
+    """
+    def __init__(
+        self,
+        min_workers=1,
+        max_workers=None,
+        initial_workers=None,
+        interval_sec=30.0,
+        memory_limit_mb=None,
+        min_available_mb=1024,
+        max_cpu_percent=90.0,
+        max_error_rate=0.2,
+        tolerance=0.05
+        ):
+        self.min_workers = min_workers
+        self.max_workers = mp.cpu_count() if max_workers is None else max_workers
+        if initial_workers is None:
+            initial_workers = min_workers
+        self.num_workers = min(max(initial_workers, self.min_workers), self.max_workers)
+        self.interval_sec = interval_sec
+        # the memory of the worker tree is only measured with psutil
+        if memory_limit_mb is not None and psutil is None:
+            raise ImportError("memory_limit_mb requires psutil (pip install psutil)")
+        self.memory_limit_mb = memory_limit_mb
+        self.min_available_mb = min_available_mb
+        self.max_cpu_percent = max_cpu_percent
+        self.max_error_rate = max_error_rate
+        self.tolerance = tolerance
+
+        self.direction = 1
+        self.last_throughput = None
+        self.history = []
+        self.reset_window()
+        get_cpu_percent()
+
+
+    def reset_window(self):
+        self.window_start = time.time()
+        self.num_done = 0
+        self.num_errors = 0
+
+
+    def record(self, num_done=1, num_errors=0):
+        self.num_done += num_done
+        self.num_errors += num_errors
+
+
+    def update(self, get_rss_mb=get_tree_rss_mb):
+        """
+        Returns the number of workers to run. It only changes once per interval.
+        """
+        elapsed = time.time() - self.window_start
+        if elapsed < self.interval_sec or self.num_done == 0:
+            return self.num_workers
+
+        rss_mb = get_rss_mb()
+        throughput = self.num_done / elapsed
+        error_rate = self.num_errors / self.num_done
+        cpu_percent = get_cpu_percent()
+        available_mb = get_available_memory_mb()
+        rss_per_worker_mb = None if rss_mb is None else rss_mb / max(self.num_workers, 1)
+
+        decision, reason = self.decide(throughput, error_rate, cpu_percent, rss_mb, rss_per_worker_mb, available_mb)
+        self.history.append({
+            "time": util.get_jst_time_str(),
+            "num_workers": self.num_workers,
+            "throughput": throughput,
+            "error_rate": error_rate,
+            "cpu_percent": cpu_percent,
+            "rss_mb": rss_mb,
+            "available_mb": available_mb,
+            "decision": decision,
+            "reason": reason,
+        })
+        logger.info(
+            f"Autotune: {self.num_workers} workers, {throughput:.2f} items/sec, "
+            f"error rate {error_rate:.2f}, cpu {cpu_percent:.0f}% -> {decision:+d} ({reason})"
+        )
+
+        if decision != 0:
+            self.direction = decision
+        self.num_workers = min(max(self.num_workers + decision, self.min_workers), self.max_workers)
+        self.last_throughput = throughput
+        self.reset_window()
+
+        return self.num_workers
+
+
+    def decide(self, throughput, error_rate, cpu_percent, rss_mb, rss_per_worker_mb, available_mb):
+        if error_rate > self.max_error_rate:
+            return -1, "errors"
+
+        if available_mb is not None and available_mb < self.min_available_mb:
+            return -1, "memory"
+        if self.memory_limit_mb is not None and rss_mb is not None and rss_mb > self.memory_limit_mb:
+            return -1, "memory"
+
+        if self.last_throughput is None:
+            direction = 1
+            reason = "start"
+        elif throughput > self.last_throughput * (1 + self.tolerance):
+            direction = self.direction
+            reason = "improved"
+        else:
+            direction = -self.direction
+            reason = "not improved"
+
+        if direction > 0:
+            if cpu_percent > self.max_cpu_percent:
+                return 0, "cpu saturated"
+            if self.memory_limit_mb is not None and rss_per_worker_mb is not None \
+                and rss_mb + rss_per_worker_mb > self.memory_limit_mb:
+                return 0, "memory limit"
+
+        return direction, reason
+
+
+    def get_best_setting(self):
+        if len(self.history) == 0:
+            return None
+
+        best = max(self.history, key=lambda h: h["throughput"])
+        return best["num_workers"]
+
+
+    def save(self, path):
+        path = pathlib.Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with open(path, "w", encoding="UTF-8") as f:
+            json.dump({
+                "best_num_workers": self.get_best_setting(),
+                "final_num_workers": self.num_workers,
+                "history": self.history,
+            }, f, ensure_ascii=False, indent=2)
+
+        return path
+
+
+    @staticmethod
+    def load_best_setting(path):
+        """
+        The best number of workers of an earlier run, to start from
+        """
+        try:
+            with open(path, encoding="UTF-8") as f:
+                return json.load(f).get("best_num_workers")
+        except (OSError, ValueError):
+            return None
+
+
+class TaskQueue(object):
+    """
+    The tasks (index, task) waiting for a worker of TunedWorkers, first in first out
+    """
+    def __init__(self, tasks=()):
+        self.tasks = collections.deque(tasks)
+
+
+    def __len__(self):
+        return len(self.tasks)
+
+
+    def pop(self):
+        """
+        Returns the next task, or None if no task may start now
+        """
+        if len(self.tasks) == 0:
+            return None
+
+        return self.tasks.popleft()
+
+
+    def push(self, item):
+        self.tasks.append(item)
+
+
+    def push_front(self, item):
+        self.tasks.appendleft(item)
+
+
+    def get_wait_sec(self):
+        """
+        Seconds until a task that pop() holds back may start, or None if it holds none back
+        """
+        return None
+
+
+    def finish(self, index, task, result):
+        """
+        Called with the result of every task. Returns False if the task was queued again.
+        """
+        return True
+
+
+class TunedWorkers(object):
+    """
+    Worker processes, as many as the controller asks for, each fed one task at a time
+    over its own pipe. The parent knows which task every worker holds, so shrinking
+    only stops idle workers, and the task of a worker that dies gets error_result.
+
+    worker_func(conn, *worker_args) runs in each worker: it receives tasks with conn.recv()
+    until None, and answers each with ("done", (result, is_error)) or ("requeue", new_task).
+
+    """
+    # workers that die before finishing a single task, e.g. because the browser does not start
+    max_failed_starts = 3
+    # how long busy workers get to finish their task when the run ends early
+    shutdown_timeout_sec = 10.0
+
+
+    def __init__(self, mp_context, worker_func, worker_args, controller):
+        self.mp_context = mp_context
+        self.worker_func = worker_func
+        self.worker_args = tuple(worker_args)
+        self.controller = controller
+        self.workers = {}
+        self.next_worker_id = 0
+        self.num_failed_starts = 0
+        self.num_lost = collections.Counter()
+
+
+    def start_worker(self):
+        worker_id = self.next_worker_id
+        self.next_worker_id += 1
+        conn, child_conn = self.mp_context.Pipe()
+        process = self.mp_context.Process(
+            target=run_worker,
+            args=(self.worker_func, profiler.get_pool_kwargs(), child_conn) + self.worker_args,
+            daemon=True
+        )
+        process.start()
+        # the pipe reads EOF once the worker is gone
+        child_conn.close()
+        self.workers[worker_id] = {
+            "process": process, "conn": conn, "task": None, "stopping": False, "num_done": 0
+        }
+
+
+    def stop_worker(self, worker_id):
+        w = self.workers[worker_id]
+        w["stopping"] = True
+        if w["task"] is None:
+            try:
+                w["conn"].send(None)
+            except OSError:
+                pass
+
+
+    def resize(self, num_workers):
+        running = [w for w in self.workers if not self.workers[w]["stopping"]]
+        for _ in range(num_workers - len(running)):
+            self.start_worker()
+
+        # the newest workers are stopped first, after their current task
+        for worker_id in sorted(running, reverse=True)[:max(len(running) - num_workers, 0)]:
+            self.stop_worker(worker_id)
+
+
+    def run(self, tasks, error_result=None):
+        """
+        Runs the tasks and returns their results in order.
+        tasks is a list, or a TaskQueue of (index, task) that decides which task goes next.
+        """
+        pending = tasks if isinstance(tasks, TaskQueue) else TaskQueue(enumerate(tasks))
+        results = [None] * len(pending)
+        num_left = len(pending)
+
+        self.resize(self.controller.num_workers)
+        try:
+            while num_left > 0:
+                self.assign_tasks(pending)
+                conns = [w["conn"] for w in self.workers.values()]
+                wait_sec = pending.get_wait_sec()
+                timeout = 1.0 if wait_sec is None else min(max(wait_sec, 0.01), 1.0)
+                ready = mp.connection.wait(conns, timeout=timeout)
+                for worker_id in list(self.workers):
+                    if self.workers[worker_id]["conn"] in ready:
+                        num_left -= self.receive(worker_id, results, pending, error_result)
+
+                self.resize(self.controller.update())
+
+        finally:
+            self.shutdown()
+
+        return results
+
+
+    def shutdown(self):
+        # busy workers read the None after their current task; the ones that
+        # do not finish in time, e.g. after an exception here, are terminated
+        for w in self.workers.values():
+            w["stopping"] = True
+            try:
+                w["conn"].send(None)
+            except OSError:
+                pass
+
+        deadline = time.time() + self.shutdown_timeout_sec
+        for w in self.workers.values():
+            self.join_worker(w, max(deadline - time.time(), 0))
+        self.workers = {}
+
+
+    @staticmethod
+    def join_worker(w, timeout):
+        w["process"].join(timeout)
+        if w["process"].is_alive():
+            w["process"].terminate()
+            w["process"].join()
+        w["conn"].close()
+
+
+    def assign_tasks(self, pending):
+        for w in self.workers.values():
+            if w["stopping"] or w["task"] is not None:
+                continue
+
+            item = pending.pop()
+            if item is None:
+                return
+
+            index, task = item
+            w["task"] = (index, task)
+            try:
+                w["conn"].send(task)
+            except OSError:
+                # the worker is gone; receive() puts the task back
+                pass
+
+
+    def receive(self, worker_id, results, pending, error_result):
+        """
+        Handles the messages of a worker and returns the number of tasks it finished
+        """
+        w = self.workers[worker_id]
+        try:
+            kind, payload = w["conn"].recv()
+        except (EOFError, OSError):
+            return self.remove_worker(worker_id, results, pending, error_result)
+
+        index, task = w["task"]
+        w["task"] = None
+        if w["stopping"]:
+            self.stop_worker(worker_id)
+
+        if kind == "requeue":
+            pending.push((index, payload))
+            return 0
+
+        result, is_error = payload
+        w["num_done"] += 1
+        self.controller.record(1, int(is_error))
+        if not pending.finish(index, task, result):
+            return 0
+
+        results[index] = result
+        return 1
+
+
+    def remove_worker(self, worker_id, results, pending, error_result):
+        w = self.workers.pop(worker_id)
+        self.join_worker(w, self.shutdown_timeout_sec)
+        if w["stopping"] and w["task"] is None:
+            return 0
+
+        # a worker that exited without being stopped, e.g. taken down by its browser or its task
+        logger.warning(f"Worker {worker_id} exited (code {w['process'].exitcode}) with task {w['task']}.")
+        num_lost = 0
+        if w["task"] is not None:
+            index, task = w["task"]
+            # tried once more, in case the worker died of something else than its task
+            if self.num_lost[index] == 0:
+                self.num_lost[index] += 1
+                pending.push_front((index, task))
+            else:
+                results[index] = error_result
+                num_lost = 1
+                self.controller.record(1, 1)
+        if w["num_done"] == 0:
+            self.num_failed_starts += 1
+            if self.num_failed_starts > self.max_failed_starts:
+                raise RuntimeError(f"{self.num_failed_starts} workers exited before finishing a task.")
+        else:
+            self.num_failed_starts = 0
+
+        return num_lost
+
+
+def run_worker(worker_func, pool_kwargs, conn, *args):
+    # the same initializer as pool workers get, e.g. for the profiler
+    if "initializer" in pool_kwargs:
+        pool_kwargs["initializer"](*pool_kwargs["initargs"])
+
+    try:
+        worker_func(conn, *args)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    pass
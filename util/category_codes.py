@@ -0,0 +1,71 @@
+import sqlite3
+import pathlib
+import pandas as pd
+
+
+class CategoryCodes(object):
+    """
+    Categories of the categorical columns, kept in sqlite so that a value gets the same
+    code in every run and every output file. A column starts with the values of its fixed
+    table, in order; values seen later are appended, sorted within the run that first sees them.
+
+    """
+    def __init__(self, db_path):
+        self.db_path = pathlib.Path(db_path)
+        self.db_path.parent.mkdir(exist_ok=True, parents=True)
+        self.conn = sqlite3.connect(str(self.db_path), timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS category_code ("
+            "column_name TEXT NOT NULL, "
+            "value TEXT NOT NULL, "
+            "code INTEGER NOT NULL, "
+            "PRIMARY KEY (column_name, value))"
+        )
+        self.conn.commit()
+
+
+    def close(self):
+        self.conn.close()
+
+
+    def get_categories(self, column):
+        rows = self.conn.execute(
+            "SELECT value FROM category_code WHERE column_name = ? ORDER BY code", (column,)
+        )
+        return [r[0] for r in rows]
+
+
+    def add_values(self, column, values):
+        """
+        Gives the next codes to the values the column does not have yet
+        """
+        # one writer at a time, so that concurrent runs never hand out a code twice
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            known = set(self.get_categories(column))
+            new_values = [v for v in dict.fromkeys(values) if v not in known]
+            next_code = len(known)
+            self.conn.executemany(
+                "INSERT INTO category_code (column_name, value, code) VALUES (?, ?, ?)",
+                [(column, v, next_code + i) for i, v in enumerate(new_values)]
+            )
+            self.conn.commit()
+
+        except Exception:
+            self.conn.rollback()
+            raise
+
+
+    def to_categorical(self, column, texts, table=()):
+        """
+        Converts the column to a categorical with all the categories recorded for it
+        """
+        values = sorted(str(v) for v in pd.unique(texts.dropna()))
+        self.add_values(column, list(table) + values)
+
+        return pd.Categorical(texts.astype("string"), categories=self.get_categories(column))
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,91 @@
+import pathlib
+import fnmatch
+import pandas as pd
+import util
+
+
+def get_column_dtype(column, schema):
+    """
+    Returns the dtype for the column. Keys of the schema may be glob patterns
+    such as "category_*" for the dynamically numbered columns.
+    """
+    if column in schema:
+        return schema[column]
+
+    for pattern, dtype in schema.items():
+        if fnmatch.fnmatchcase(column, pattern):
+            return dtype
+
+    return None
+
+
+def apply_schema(df, schema):
+    df = df.copy()
+    for column in df.columns:
+        dtype = get_column_dtype(column, schema)
+        if dtype is None:
+            continue
+
+        if dtype == "datetime":
+            df[column] = pd.to_datetime(df[column])
+        else:
+            df[column] = df[column].astype(dtype)
+
+    return df
+
+
+def get_partition_dir(root_dir, date=None):
+    if date is None:
+        date = util.get_jst_time()
+
+    return pathlib.Path(root_dir) / f"date={date.strftime('%Y-%m-%d')}"
+
+
+def write_parquet(df, root_dir, filename, schema=None, date=None):
+    """
+    Writes the dataframe to '{root_dir}/date=YYYY-MM-DD/{filename}.parquet'.
+    Categorical columns are stored dictionary-encoded.
+    """
+    if schema is not None:
+        df = apply_schema(df, schema)
+
+    output_dir = get_partition_dir(root_dir, date)
+    output_dir.mkdir(exist_ok=True, parents=True)
+    output_path = output_dir / f"{filename}.parquet"
+    df.to_parquet(output_path, index=False)
+
+    return output_path
+
+
+def write_table(df, root_dir, filename, output_format="csv", schema=None, date=None):
+    if output_format == "parquet":
+        return write_parquet(df, root_dir, filename, schema=schema, date=date)
+
+    elif output_format == "csv":
+        pathlib.Path(root_dir).mkdir(exist_ok=True, parents=True)
+        output_path = pathlib.Path(root_dir) / f"{filename}.csv"
+        df.to_csv(output_path, index=False)
+        return output_path
+
+    raise ValueError(f"Unknown output format: {output_format}")
+
+
+def read_table(path, columns=None, schema=None):
+    """
+    Reads a csv file, a parquet file or a partitioned parquet directory.
+    Only the given columns are read.
+    """
+    path = pathlib.Path(path)
+
+    if path.is_dir() or path.suffix == ".parquet":
+        return pd.read_parquet(path, columns=columns)
+
+    df = pd.read_csv(path, usecols=columns)
+    if schema is not None:
+        df = apply_schema(df, schema)
+
+    return df
+
+
+if __name__ == "__main__":
+    pass
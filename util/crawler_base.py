@@ -1,28 +1,71 @@
+import os
 import sys
 import time
 import datetime
+import re
+import queue
+import functools
+import signal
+import json
+import base64
 import traceback
+import collections
 import pathlib
 import numpy as np
 import pandas as pd
-from bs4 import BeautifulSoup
 import multiprocessing as mp
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
 current_dir = pathlib.Path(__file__).parent
 import util
+import columnar
+import profiler
+import id_codec
+import embedded_json
+from run_summary import RunSummary
+from parse_cache import ParseCache
+from item_history import ItemHistory
+from download_scheduler import DownloadScheduler
+from file_watcher import FileWatcher
+from autotune import ConcurrencyController, TunedWorkers
+
+
+class PageState(object):
+    """
+    Outcomes of loading a page, returned by the wait functions of the downloaders
+    """
+    LOADED = "loaded"
+    DELETED = "deleted"
+    NOT_FOUND = "not_found"
+    BLOCKED = "blocked"
+    NETWORK_ERROR = "network_error"
+    TIMEOUT = "timeout"
+    ERROR = "error"
+
+    # states that are worth another try later in the run
+    RETRY_LATER = (BLOCKED, NETWORK_ERROR, TIMEOUT)
+
+
+    @classmethod
+    def from_wait_result(cls, result):
+        # wait functions that only return True/False
+        if result is True:
+            return cls.LOADED
+        if result is False or result is None:
+            return cls.TIMEOUT
+        return result
 
 
 class CrawlerBase(object):
     platform = None
     local_output_dir = None
     s3_output_dir = None
+    output_schema = None
 
 
-    def __init__(self, is_test=False, wait_sec=1.0, save_to_s3=False):
+    def __init__(self, is_test=False, wait_sec=1.0, save_to_s3=False, output_format="csv"):
         self.is_test = is_test
         self.wait_sec = wait_sec
         self.save_to_s3 = save_to_s3
+        self.output_format = output_format
         if self.local_output_dir is not None:
             self.local_output_dir = pathlib.Path(self.local_output_dir)
             self.local_output_dir.mkdir(exist_ok=True, parents=True)
@@ -45,12 +88,16 @@ class CrawlerBase(object):
             else:
                 df = pd.concat([df, new_df])
 
-        filename = f"{util.get_jst_time_str()}.csv"
-        local_output_path = self.local_output_dir / filename
-        df.to_csv(local_output_path, index=False)
+        local_output_path = columnar.write_table(
+            df,
+            self.local_output_dir,
+            util.get_jst_time_str(),
+            output_format=self.output_format,
+            schema=self.output_schema
+        )
 
         if self.save_to_s3:
-            s3_output_path = self.s3_output_dir / filename
+            s3_output_path = self.s3_output_dir / local_output_path.relative_to(self.local_output_dir)
             upload_success = util.s3_upload_file(
                 self.s3_bucket, 
                 local_output_path, 
@@ -84,8 +131,52 @@ class SeleniumCralwer(CrawlerBase):
     """
     Crawler for the pages that depend on javascript
     """
-    def __init__(self, is_test=False, wait_sec=1.0, chromedriver_path=None, headless=True, save_to_s3=False):
-        super().__init__(is_test=is_test, wait_sec=wait_sec)
+    # collects the outerHTML of the matched nodes in the browser, so that
+    # the full DOM is never sent over the WebDriver connection
+    trim_html_script = """
+        var selectors = arguments[0];
+        var kept = [];
+        selectors.forEach(function(selector) {
+            document.querySelectorAll(selector).forEach(function(node) {
+                for (var i = 0; i < kept.length; i++) {
+                    if (kept[i].contains(node)) return;
+                }
+                kept.push(node);
+            });
+        });
+
+        var head = [], body = [];
+        kept.forEach(function(node) {
+            if (node.closest("head")) head.push(node.outerHTML);
+            else body.push(node.outerHTML);
+        });
+
+        return {
+            "original_size": document.documentElement.outerHTML.length,
+            "html": '<html><head><meta charset="UTF-8">' + head.join("")
+                + "</head><body>" + body.join("") + "</body></html>"
+        };
+    """
+    num_original_chars = 0
+    num_stored_chars = 0
+    capture_poll_sec = 0.1
+
+    def __init__(
+        self, 
+        is_test=False, 
+        wait_sec=1.0, 
+        chromedriver_path=None, 
+        headless=True, 
+        save_to_s3=False,
+        output_format="csv",
+        capture_url_patterns=None
+        ):
+        super().__init__(
+            is_test=is_test, 
+            wait_sec=wait_sec, 
+            save_to_s3=save_to_s3, 
+            output_format=output_format
+        )
 
         if chromedriver_path is None:
             self.chromedriver_path = current_dir / "webdriver/chromedriver"
@@ -93,9 +184,16 @@ class SeleniumCralwer(CrawlerBase):
             self.chromedriver_path = chromedriver_path
 
         self.headless = headless
+        # regexes of the API urls whose responses are captured over CDP
+        self.capture_url_patterns = None
+        if capture_url_patterns is not None:
+            self.capture_url_patterns = [re.compile(p) for p in capture_url_patterns]
 
     
     def get_session_selenium(self):
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+
         # open chrome
         desired_capabilities = \
             webdriver.common.desired_capabilities.DesiredCapabilities.CHROME.copy()
@@ -103,6 +201,14 @@ class SeleniumCralwer(CrawlerBase):
 
         if self.headless:
             options.add_argument("--headless")
+
+        if self.capture_url_patterns is not None:
+            # network events only, read back with get_log("performance")
+            desired_capabilities["goog:loggingPrefs"] = {"performance": "ALL"}
+            options.add_experimental_option(
+                "perfLoggingPrefs", 
+                {"enableNetwork": True, "enablePage": False}
+            )
         
         driver = webdriver.Chrome(
             executable_path=str(self.chromedriver_path),
@@ -124,27 +230,169 @@ class SeleniumCralwer(CrawlerBase):
                 self.logger.error(e)
                 return None
         
-        return self.driver.page_source
+        # the page source is not fetched here; it is the largest transfer over the driver
+        return True
 
 
     def get_page_source(self):
         return self.driver.page_source
 
 
-    def save_response_html(self, url, html_path, wait_func=None):
+    def open_tab(self, url):
+        """
+        Starts loading the url in a new background tab and returns its window handle
+        """
+        handles = set(self.driver.window_handles)
+        self.driver.execute_script("window.open(arguments[0], '_blank');", str(url))
+        new_handles = [h for h in self.driver.window_handles if h not in handles]
+
+        return new_handles[0]
+
+
+    def get_trimmed_page_source(self, keep_selectors):
+        """
+        Returns a document that only contains the nodes matched by keep_selectors
+        """
+        trimmed = self.driver.execute_script(self.trim_html_script, list(keep_selectors))
+        page_source = trimmed["html"]
+
+        self.num_original_chars += trimmed["original_size"]
+        self.num_stored_chars += len(page_source)
+        self.logger.debug(
+            f"Trimmed html: {trimmed['original_size']} -> {len(page_source)} chars"
+        )
+
+        return page_source
+
+
+    def get_reduction_ratio(self):
+        if self.num_original_chars == 0:
+            return None
+
+        return self.num_stored_chars / self.num_original_chars
+
+
+    def clear_captured_responses(self):
+        # the performance log is drained on every read
+        self.driver.get_log("performance")
+
+
+    def get_captured_responses(self, timeout=None, min_count=1):
+        """
+        Returns the responses whose url matches capture_url_patterns as
+        [{"url", "status", "body"}, ...], as soon as min_count of them have
+        finished loading and no other matching request is pending.
+        JSON bodies are decoded.
+        """
+        deadline = time.time() + (self.wait_sec if timeout is None else timeout)
+        pending = {}
+        responses = []
+        while True:
+            for entry in self.driver.get_log("performance"):
+                message = json.loads(entry["message"])["message"]
+                method = message.get("method")
+                params = message.get("params", {})
+                request_id = params.get("requestId")
+
+                if method == "Network.responseReceived":
+                    response = params["response"]
+                    if any(p.search(response["url"]) for p in self.capture_url_patterns):
+                        pending[request_id] = {"url": response["url"], "status": response["status"]}
+
+                elif method == "Network.loadingFinished" and request_id in pending:
+                    response = pending.pop(request_id)
+                    response["body"] = self.get_response_body(request_id)
+                    responses.append(response)
+
+                elif method == "Network.loadingFailed" and request_id in pending:
+                    pending.pop(request_id)
+
+            if (len(responses) >= min_count and len(pending) == 0) or time.time() > deadline:
+                return responses
+
+            time.sleep(self.capture_poll_sec)
+
+
+    def get_response_body(self, request_id):
         try:
+            body = self.driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": request_id})
+        except Exception as e:
+            # chrome may have evicted the body already
+            self.logger.warning(f"Failed to get the response body: {e}")
+            return None
+
+        content = body["body"]
+        if body.get("base64Encoded"):
+            content = base64.b64decode(content)
+
+        try:
+            return embedded_json.loads(content)
+        except ValueError:
+            return content if isinstance(content, str) else content.decode("UTF-8", errors="replace")
+
+
+    @staticmethod
+    def get_capture_state(responses):
+        if len(responses) == 0:
+            return PageState.TIMEOUT
+
+        statuses = [r["status"] for r in responses]
+        if any(s < 400 for s in statuses):
+            return PageState.LOADED
+        if any(s in (403, 429) for s in statuses):
+            return PageState.BLOCKED
+        if any(s in (404, 410) for s in statuses):
+            return PageState.NOT_FOUND
+        return PageState.ERROR
+
+
+    def save_captured_responses(self, url, responses, capture_path):
+        capture_path = pathlib.Path(capture_path)
+        capture_path.parent.mkdir(exist_ok=True, parents=True)
+        with open(capture_path, "w", encoding="UTF-8") as f:
+            json.dump({"url": str(url), "responses": responses}, f, ensure_ascii=False)
+
+
+    def save_response_html(self, url, html_path, wait_func=None, keep_selectors=None, capture_path=None):
+        """
+        Returns whether the page was saved. The state of the page is kept in self.last_page_state.
+        With capture_path, the API responses matching capture_url_patterns are stored there,
+        and the html is only saved as well if html_path is not None.
+        """
+        self.last_page_state = PageState.ERROR
+        try:
+            if capture_path is not None:
+                self.clear_captured_responses()
+
             self.get_url(url)
 
+            if capture_path is not None:
+                responses = self.get_captured_responses()
+                self.last_page_state = self.get_capture_state(responses)
+                if self.last_page_state != PageState.LOADED:
+                    return False
+
+                self.save_captured_responses(url, responses, capture_path)
+                if html_path is None:
+                    return True
+
             if wait_func is not None:
-                wait_success = wait_func(self.driver, self.wait_sec)
-                if not wait_success:
+                self.last_page_state = PageState.from_wait_result(
+                    wait_func(self.driver, self.wait_sec)
+                )
+                if self.last_page_state != PageState.LOADED:
                     return False
 
-            page_source = self.get_page_source()
+            if keep_selectors is None:
+                page_source = self.get_page_source()
+            else:
+                page_source = self.get_trimmed_page_source(keep_selectors)
+
             pathlib.Path(html_path).parent.mkdir(exist_ok=True, parents=True)
             with open(html_path, "w", encoding="UTF-8") as f:
                 f.write(page_source)
 
+            self.last_page_state = PageState.LOADED
             return True
 
         except Exception as e:
@@ -205,14 +453,19 @@ class DownloaderBase(object):
     local_output_dir = None
     s3_output_dir = None
     wait_sec = 1.0
+    # gzip the downloaded html on the fly
+    compress_html = False
+    # ids of the form item_id_prefix + digits are handled as int64 codes (see id_codec)
+    item_id_prefix = None
+    mp_preload = ("util", "crawler_base")
 
 
-    def __init__(self, is_test=False, num_threads=None, save_to_s3=False):
+    def __init__(self, is_test=False, num_threads=None, save_to_s3=False, start_method=None):
         self.is_test = is_test
-        log_dir = current_dir / f"../logs/{self.platform}/downloader/"
+        self.log_dir = current_dir / f"../logs/{self.platform}/downloader/"
         self.logger = util.Logger.setup_logger(
             logger_name=__name__, 
-            log_dir=log_dir
+            log_dir=self.log_dir
         )
 
         if num_threads is None:
@@ -225,40 +478,141 @@ class DownloaderBase(object):
             self.num_threads = int(num_threads)
 
         self.save_to_s3 = save_to_s3
+        if save_to_s3:
+            self.s3_bucket = util.get_s3_bucket()
+        self.mp_context = util.get_mp_context(start_method, self.mp_preload)
+        self.controller = None
+        self.schedule_path = current_dir / f"../output/scheduler/{self.platform}/schedule.sqlite3"
         self.local_output_dir.mkdir(exist_ok=True, parents=True)
 
 
+    def encode_item_ids(self, item_ids):
+        """
+        Returns the ids as an int64 code array if they all have the form
+        item_id_prefix + digits, and as an object array otherwise
+        """
+        # arrays returned by this method are passed through as they are
+        if isinstance(item_ids, np.ndarray) and item_ids.dtype in (np.int64, object):
+            return item_ids
+
+        item_ids = np.asarray(item_ids)
+        if self.item_id_prefix is not None:
+            codes = id_codec.encode(item_ids, self.item_id_prefix)
+            if id_codec.is_valid(codes).all():
+                return codes
+
+            self.logger.warning(
+                f"Some item ids are not '{self.item_id_prefix}' + digits. They are kept as strings."
+            )
+
+        return item_ids.astype(object)
+
+
+    @classmethod
+    def decode_item_ids(cls, item_ids):
+        item_ids = np.asarray(item_ids)
+        if item_ids.dtype == np.int64:
+            return id_codec.decode(item_ids, cls.item_id_prefix).tolist()
+
+        return item_ids.tolist()
+
+
+    def list_downloaded_item_ids(self):
+        if self.save_to_s3:
+            paths = util.s3_list_all_files(self.s3_bucket, self.s3_output_dir)
+        else:
+            paths = util.list_all_files(self.local_output_dir)
+
+        # '{item_id}_{%Y-%m-%d-%H-%M-%S}.html[.gz]', or '.json' for the captured API responses
+        names = pd.Series(paths, dtype="string").str.rsplit("/", n=1).str[-1]
+        names = names[names.str.contains(r"\.(?:html(?:\.gz)?|json)$")]
+        return names.str.rsplit("_", n=1).str[0].dropna().unique()
+
+
+    def select_items(self, item_ids, skip_downloaded=False):
+        """
+        Deduplicates the item ids, keeping their order, and with skip_downloaded drops
+        the ones downloaded before. Returns the ids encoded by encode_item_ids.
+        """
+        item_ids = self.encode_item_ids(item_ids)
+        num_items = len(item_ids)
+        downloaded = self.encode_item_ids(self.list_downloaded_item_ids()) if skip_downloaded \
+            else item_ids[:0]
+
+        if item_ids.dtype == np.int64 and downloaded.dtype == np.int64:
+            selected = id_codec.difference(item_ids, downloaded)
+        else:
+            downloaded = set(self.decode_item_ids(downloaded))
+            selected = np.array(
+                [i for i in dict.fromkeys(self.decode_item_ids(item_ids)) if i not in downloaded],
+                dtype=object
+            )
+
+        self.logger.info(f"Selected {len(selected)} of {num_items} items.")
+        return selected
+
+
+    def schedule_items(self, item_ids, budget):
+        """
+        Registers the crawled item ids and returns the budget items to download now.
+        finish_downloader records the outcomes; price changes are only learned when the
+        parser runs with update_history.
+        """
+        scheduler = DownloadScheduler(self.schedule_path)
+        try:
+            scheduler.add_items(self.decode_item_ids(item_ids))
+            selected = scheduler.select(budget)
+        finally:
+            scheduler.close()
+
+        self.logger.info(f"Scheduled {len(selected)} items within the budget {budget}.")
+        return selected
+
+
     def run_downloader(self, item_ids):
         self.start_downloader()
         
         if self.is_test and len(item_ids) > 5:
             item_ids = item_ids[:5]
 
-        if self.save_to_s3:
-            with mp.Pool(self.num_threads) as p:
-                result = p.map(self.download_html_s3, item_ids)
-        else:
-            with mp.Pool(self.num_threads) as p:
-                result = p.map(self.download_html_local, item_ids)
+        # a few chunks per worker, each pickled as one array
+        chunks = id_codec.split(self.encode_item_ids(item_ids), self.num_threads * 4)
+        # the workers open the bucket themselves; class attributes set here do not reach spawned workers
+        s3_bucket_name = self.s3_bucket.name if self.save_to_s3 else None
+        args = [(c, s3_bucket_name) for c in chunks]
+        with self.mp_context.Pool(self.num_threads, **profiler.get_pool_kwargs()) as p:
+            result = p.starmap(self.download_html_chunk, args)
+            p.close()
+            p.join()
+
+        item_ids = [item_id for c in chunks for item_id in self.decode_item_ids(c)]
+        self.finish_downloader(item_ids, [r for rs in result for r in rs])
+
 
-        self.finish_downloader(item_ids, result)
+    @classmethod
+    def download_html_chunk(cls, item_ids, s3_bucket_name=None):
+        if s3_bucket_name is None:
+            return [cls.download_html_local(item_id) for item_id in cls.decode_item_ids(item_ids)]
+
+        s3_bucket = util.get_s3_bucket(s3_bucket_name)
+        return [cls.download_html_s3(item_id, s3_bucket) for item_id in cls.decode_item_ids(item_ids)]
 
 
     @classmethod
     def download_html_local(cls, item_id):
         url = cls.get_item_url(item_id)
         local_path = cls.local_output_dir / f"{item_id}_{util.get_jst_time_str()}.html"
-        upload_success = util.download_file(url, local_path)
+        upload_success = util.download_file(url, local_path, compress=cls.compress_html)
         time.sleep(cls.wait_sec)
         
         return upload_success
 
 
     @classmethod
-    def download_html_s3(cls, item_id):
+    def download_html_s3(cls, item_id, s3_bucket):
         url = cls.get_item_url(item_id)
         s3_path = cls.s3_output_dir / f"{item_id}_{util.get_jst_time_str()}.html"
-        upload_success = util.s3_save_file(url, cls.s3_bucket, s3_path)
+        upload_success = util.s3_save_file(url, s3_bucket, s3_path)
         time.sleep(cls.wait_sec)
         
         return upload_success
@@ -273,15 +627,48 @@ class DownloaderBase(object):
         self.logger.info(f"Start downloading htmls: {self.platform}.")
 
 
+    def get_autotune_path(self):
+        return self.log_dir / "autotune_settings.json"
+
+
     def finish_downloader(self, item_ids, result):
-        download_results = []
-        for item_id, r in zip(item_ids, result):
-            download_results.append(f"{item_id}: {r}")
+        # result: download successes or PageState outcomes
+        successes = [r is True or r == PageState.LOADED for r in result]
+        reasons = [r if isinstance(r, str) else None for r in result]
 
-        text = "\n".join(download_results)
+        summary = RunSummary(self.platform, "downloader")
+        summary.extend(item_ids, successes, reasons)
+        outcome_path = summary.save(self.log_dir)
+
+        if self.schedule_path.exists():
+            self.record_downloads(item_ids, successes, reasons)
+
+        if self.controller is not None:
+            autotune_path = self.controller.save(self.get_autotune_path())
+            self.logger.info(
+                f"Autotuned workers: best {self.controller.get_best_setting()}, saved to '{autotune_path}'"
+            )
 
         self.logger.info(f"Finish downloading htmls: {self.platform}.")
-        self.logger.info(f"Download success: \n{text}")
+        self.logger.info(f"Download summary: \n{summary.to_text()}")
+        if outcome_path is not None:
+            self.logger.info(f"Download outcomes: '{outcome_path}'")
+
+        return summary
+
+
+    def record_downloads(self, item_ids, successes, reasons):
+        is_gone = [r in (PageState.DELETED, PageState.NOT_FOUND) for r in reasons]
+        scheduler = DownloadScheduler(self.schedule_path)
+        try:
+            counts = scheduler.record_downloads(self.decode_item_ids(item_ids), successes, is_gone)
+        finally:
+            scheduler.close()
+
+        self.logger.info(
+            f"Download schedule: {counts['downloaded']} backed off, "
+            f"{counts['failed']} to retry, {counts['retired']} retired."
+        )
 
 
 class SeleniumDownloader(DownloaderBase):
@@ -290,6 +677,13 @@ class SeleniumDownloader(DownloaderBase):
     local_output_dir = None
     s3_output_dir = None
     max_wait_sec = 10.0
+    # CSS selectors of the nodes to keep when trim_html is enabled
+    keep_selectors = None
+    # retries of items that were blocked, timed out or hit a network error
+    max_retry = 1
+    blocked_wait_sec = 30.0
+    # regexes of the API urls captured with the capture option
+    capture_url_patterns = None
 
 
     def __init__(
@@ -299,9 +693,24 @@ class SeleniumDownloader(DownloaderBase):
         save_to_s3=False,
         max_wait_sec=1.0, 
         chromedriver_path=None, 
-        headless=True
+        headless=True,
+        start_method=None,
+        trim_html=False,
+        capture=None,
+        autotune=False,
+        memory_limit_mb=None
         ):
-        super().__init__(is_test, num_threads, save_to_s3)
+        super().__init__(is_test, num_threads, save_to_s3, start_method)
+        self.trim_html = trim_html
+        # None: html only / "json": captured API responses only / "both"
+        self.capture = capture
+        # the number of browsers follows the throughput, within num_threads and memory_limit_mb
+        if autotune:
+            self.controller = ConcurrencyController(
+                max_workers=self.num_threads,
+                initial_workers=ConcurrencyController.load_best_setting(self.get_autotune_path()),
+                memory_limit_mb=memory_limit_mb,
+            )
 
         if chromedriver_path is None:
             self.chromedriver_path = current_dir / "webdriver/chromedriver"
@@ -317,17 +726,31 @@ class SeleniumDownloader(DownloaderBase):
         if self.is_test and len(item_ids) > 5:
             item_ids = item_ids[:5]
 
-        chunks = util.split_list(item_ids, self.num_threads)
-        args = [(
-            c, 
+        browser_args = (
             self.save_to_s3,
             self.max_wait_sec,
             self.chromedriver_path,
             self.headless,
-        ) for c in chunks]
-        with mp.Pool(self.num_threads) as p:
+            self.keep_selectors if self.trim_html else None,
+            self.capture,
+        )
+        if self.controller is not None:
+            item_ids = self.decode_item_ids(self.encode_item_ids(item_ids))
+            workers = TunedWorkers(self.mp_context, self.download_worker, browser_args, self.controller)
+            result = workers.run([(item_id, 0) for item_id in item_ids], error_result=PageState.ERROR)
+            self.finish_downloader(item_ids, result)
+            return
+
+        chunks = id_codec.split(self.encode_item_ids(item_ids), self.num_threads)
+        args = [(c,) + browser_args for c in chunks]
+        with self.mp_context.Pool(self.num_threads, **profiler.get_pool_kwargs()) as p:
             result = p.starmap(self.download_html, args)
-            
+            # let the workers exit normally so that they flush their profiles
+            p.close()
+            p.join()
+
+        # results are in chunk order
+        item_ids = [item_id for c in chunks for item_id in self.decode_item_ids(c)]
         self.finish_downloader(item_ids, np.concatenate(result))
 
 
@@ -338,26 +761,122 @@ class SeleniumDownloader(DownloaderBase):
         save_to_s3=False,
         max_wait_sec=10.0, 
         chromedriver_path=None, 
-        headless=True
+        headless=True,
+        keep_selectors=None,
+        capture=None
         ):
-        download_successes = []
+        downloader = cls.open_browser(save_to_s3, max_wait_sec, chromedriver_path, headless, capture)
+
+        item_ids = cls.decode_item_ids(item_ids)
+        outcomes = {}
+        num_tries = collections.Counter()
+        num_blocked = 0
+        pending = collections.deque(item_ids)
+        while len(pending) > 0:
+            item_id = pending.popleft()
+            state, num_blocked = cls.download_item(downloader, item_id, keep_selectors, capture, num_blocked)
+            outcomes[item_id] = state
+            num_tries[item_id] += 1
+
+            # deleted or missing items are skipped; transient failures go to the back
+            if state in PageState.RETRY_LATER and num_tries[item_id] <= cls.max_retry:
+                pending.append(item_id)
+
+        download_outcomes = [outcomes[item_id] for item_id in item_ids]
+        cls.close_browser(downloader)
+        return download_outcomes
+
+
+    @classmethod
+    def download_worker(
+        cls, 
+        conn, 
+        save_to_s3=False,
+        max_wait_sec=10.0, 
+        chromedriver_path=None, 
+        headless=True,
+        keep_selectors=None,
+        capture=None
+        ):
+        """
+        Worker of the autotuned run: one browser for the tasks (item_id, num_tries) sent over conn
+        """
+        downloader = cls.open_browser(save_to_s3, max_wait_sec, chromedriver_path, headless, capture)
+        num_blocked = 0
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+
+            item_id, num_tries = task
+            state, num_blocked = cls.download_item(downloader, item_id, keep_selectors, capture, num_blocked)
+            if state in PageState.RETRY_LATER and num_tries < cls.max_retry:
+                conn.send(("requeue", (item_id, num_tries + 1)))
+            else:
+                is_error = state in PageState.RETRY_LATER or state == PageState.ERROR
+                conn.send(("done", (state, is_error)))
+
+        cls.close_browser(downloader)
+
+
+    @classmethod
+    def open_browser(cls, save_to_s3, max_wait_sec, chromedriver_path, headless, capture):
         downloader = SeleniumCralwer(
             is_test=False,
             wait_sec=max_wait_sec,
             chromedriver_path=chromedriver_path,
             headless=headless,
-            save_to_s3=save_to_s3
+            save_to_s3=save_to_s3,
+            capture_url_patterns=cls.capture_url_patterns if capture else None
         )
         downloader.driver = downloader.get_session_selenium()
         downloader.get_url(cls.base_url)
-        for item_id in item_ids:
-            url = cls.get_item_url(item_id)
-            html_path = cls.local_output_dir / f"{item_id}_{util.get_jst_time_str()}.html"
-            download_success = downloader.save_response_html(url, html_path, cls.wait_func)
-            download_successes.append(download_success)
+
+        return downloader
+
+
+    @staticmethod
+    def close_browser(downloader):
+        reduction_ratio = downloader.get_reduction_ratio()
+        if reduction_ratio is not None:
+            downloader.logger.info(f"Stored html size ratio: {reduction_ratio:.3f}")
 
         downloader.close()
-        return download_successes
+
+
+    @classmethod
+    def download_item(cls, downloader, item_id, keep_selectors=None, capture=None, num_blocked=0, wait_on_block=True):
+        """
+        Returns the PageState of the item and the updated count of consecutive blocks.
+        Without wait_on_block, backing off after a block is left to the caller.
+        """
+        url = cls.get_item_url(item_id)
+        html_path = cls.local_output_dir / f"{item_id}_{util.get_jst_time_str()}.html"
+        downloader.save_response_html(
+            url, 
+            None if capture == "json" else html_path, 
+            cls.wait_func, 
+            keep_selectors,
+            html_path.with_suffix(".json") if capture else None
+        )
+        state = downloader.last_page_state
+
+        if state == PageState.BLOCKED:
+            # slow down exponentially while the site keeps blocking us
+            num_blocked += 1
+            wait_sec = cls.get_blocked_wait_sec(num_blocked)
+            downloader.logger.warning(f"Blocked while loading '{url}'. Waiting {wait_sec} sec.")
+            if wait_on_block:
+                time.sleep(wait_sec)
+        elif state == PageState.LOADED:
+            num_blocked = 0
+
+        return state, num_blocked
+
+
+    @classmethod
+    def get_blocked_wait_sec(cls, num_blocked):
+        return cls.blocked_wait_sec * 2 ** min(num_blocked - 1, 5)
 
 
 class ParserBase(object):
@@ -365,10 +884,47 @@ class ParserBase(object):
     s3_bucket = None
     local_output_dir = None
     s3_output_dir = None
+    output_schema = None
+    mp_preload = ("util", "crawler_base")
+    # options of parse_html, set on the instance; they are sent to the workers with
+    # each batch and included in the cache version
+    cache_key_attrs = ()
+    # modules used by parse_html, whose sources are included in the cache version
+    cache_source_modules = ()
+    parse_batch_size = 64
+    # downloads the watcher remembers, so that the html and the '.json' of one download
+    # are not both parsed when they arrive in different micro-batches
+    max_recent_downloads = 100000
+    _reader = None
 
 
-    def __init__(self, is_test=False, num_threads=None, save_to_s3=False):
+    def __init__(
+        self, 
+        is_test=False, 
+        num_threads=None, 
+        save_to_s3=False, 
+        start_method=None, 
+        output_format="csv",
+        use_cache=True,
+        update_history=False,
+        autotune=False
+        ):
         self.is_test = is_test
+        self.output_format = output_format
+        self.log_dir = current_dir / f"../logs/{self.platform}/parser/"
+        self.cache_path = current_dir / f"../output/cache/{self.platform}/parse_cache.sqlite3"
+        self.category_path = current_dir / f"../output/cache/{self.platform}/category_codes.sqlite3"
+        self.cache_version = None
+        if use_cache:
+            options = [getattr(self, a) for a in self.cache_key_attrs]
+            self.cache_version = ParseCache.get_version(
+                type(self), *options, modules=self.cache_source_modules
+            )
+
+        self.history_path = None
+        if update_history:
+            self.history_path = current_dir / f"../output/history/{self.platform}/item_history.sqlite3"
+        self.schedule_path = current_dir / f"../output/scheduler/{self.platform}/schedule.sqlite3"
 
         if num_threads is None:
             if is_test:
@@ -380,43 +936,387 @@ class ParserBase(object):
             self.num_threads = int(num_threads)
 
         self.save_to_s3 = save_to_s3
+        if save_to_s3:
+            self.s3_bucket = util.get_s3_bucket()
+        self.mp_context = util.get_mp_context(start_method, self.mp_preload)
         self.local_output_dir.mkdir(exist_ok=True, parents=True)
 
+        # the number of batches in flight follows the throughput, within num_threads
+        self.controller = None
+        if autotune:
+            self.controller = ConcurrencyController(
+                max_workers=self.num_threads,
+                initial_workers=ConcurrencyController.load_best_setting(self.get_autotune_path()) \
+                    or self.num_threads,
+                interval_sec=10.0,
+            )
+
 
     def run_parser(self, local_html_dir):
         self.start_parser()
         
-        html_list = util.list_all_files(local_html_dir, ".html")
+        html_list = self.list_html_files(local_html_dir)
         if self.is_test and len(html_list) > 5:
             html_list = html_list[:5]
 
-        with mp.Pool(self.num_threads) as p:
-            result_df = p.map(self.parse_html, html_list)
+        result_df = self.normalize(self.parse_html_files(html_list))
+        self.purge_cache()
+        self.save_result(result_df, f"output_{util.get_jst_time_str()}")
+        self.finish_parser(result_df)
+
+
+    def purge_cache(self):
+        """
+        Drops the cache entries of the other parser versions
+        """
+        if self.cache_version is not None:
+            ParseCache.open(self.cache_path, self.cache_version).purge_old_versions()
 
-        result_df = pd.DataFrame(result_df)
-        local_path = self.local_output_dir / f"output_{util.get_jst_time_str()}.csv"
-        result_df.to_csv(local_path, index=False)
+
+    def save_result(self, result_df, filename):
+        local_path = columnar.write_table(
+            result_df,
+            self.local_output_dir,
+            filename,
+            output_format=self.output_format,
+            schema=self.output_schema
+        )
         if self.save_to_s3:
-            s3_path = self.local_output_dir / local_path.name
+            s3_path = self.s3_output_dir / local_path.relative_to(self.local_output_dir)
             util.s3_upload_file(self.s3_bucket, local_path, s3_path)
             local_path.unlink()
 
-        self.finish_parser(result_df)
+        if self.history_path is not None:
+            self.update_history(result_df)
+
+
+    def run_watcher(self, local_html_dir, batch_wait_sec=2.0, max_batch_size=None):
+        """
+        Parses the files written to local_html_dir from now on, as they appear, until
+        SIGINT or SIGTERM. One pool is kept for the whole run, and each micro-batch
+        (max_batch_size files, or what arrived within batch_wait_sec) is saved as a new output file.
+        The outcomes are added to the run summary batch by batch, and it is written on stop.
+        """
+        self.start_parser()
+        if max_batch_size is None:
+            max_batch_size = self.parse_batch_size * self.num_threads
+
+        # stop after the current batch; forked workers inherit this handler and keep running
+        stop_requested = []
+        previous_handlers = {
+            signum: signal.signal(signum, lambda signum, frame: stop_requested.append(signum))
+            for signum in (signal.SIGINT, signal.SIGTERM)
+        }
+
+        watcher = FileWatcher(local_html_dir, suffixes=(".html", ".html.gz", ".json"))
+        self.logger.info(f"Watching '{local_html_dir}' ({watcher.mode}).")
+
+        pending = []
+        first_pending_at = None
+        num_batches = 0
+        summary = RunSummary(self.platform, "parser")
+        recent_downloads = collections.OrderedDict()
+        with self.mp_context.Pool(self.num_threads, **profiler.get_pool_kwargs()) as pool:
+            try:
+                while len(stop_requested) == 0:
+                    new_paths = watcher.poll()
+                    if len(pending) == 0 and len(new_paths) > 0:
+                        first_pending_at = time.time()
+                    pending += new_paths
+
+                    while len(pending) > 0 and (
+                        len(pending) >= max_batch_size or time.time() - first_pending_at >= batch_wait_sec
+                        ):
+                        result_df = self.parse_micro_batch(pending[:max_batch_size], pool, num_batches, recent_downloads)
+                        self.add_outcomes(summary, result_df)
+                        pending = pending[max_batch_size:]
+                        num_batches += 1
+
+            finally:
+                if len(pending) > 0:
+                    self.add_outcomes(summary, self.parse_micro_batch(pending, pool, num_batches, recent_downloads))
+                    num_batches += 1
+                watcher.close()
+                pool.close()
+                pool.join()
+                for signum, handler in previous_handlers.items():
+                    signal.signal(signum, handler)
+
+        self.logger.info(f"Stopped watching '{local_html_dir}' after {num_batches} batches.")
+        self.finish_parser(summary=summary)
+
+
+    def parse_micro_batch(self, html_list, pool, batch_no, recent_downloads):
+        """
+        Parses and saves one micro-batch of the watcher and returns the result.
+        recent_downloads: OrderedDict of the download stems parsed by the earlier batches
+        """
+        # the html and the captured '.json' of a download may arrive together, and a file may be reported twice
+        html_list = self.drop_captured_htmls(list(dict.fromkeys(html_list)))
+        html_list = [p for p in html_list if self.get_download_stem(p) not in recent_downloads]
+        for p in html_list:
+            recent_downloads[self.get_download_stem(p)] = None
+        while len(recent_downloads) > self.max_recent_downloads:
+            recent_downloads.popitem(last=False)
+
+        if len(html_list) == 0:
+            return pd.DataFrame(columns=["html", "parse_success"])
+
+        # the oldest file tells how far parsing lags behind the downloads
+        mtimes = [os.path.getmtime(p) for p in html_list if os.path.exists(p)]
+        result_df = self.normalize(self.parse_html_files(html_list, pool=pool))
+        self.save_result(result_df, f"output_{util.get_jst_time_str()}_{batch_no:06d}")
+
+        num_success = int(result_df["parse_success"].sum()) if len(result_df) > 0 else 0
+        lag_sec = time.time() - min(mtimes) if len(mtimes) > 0 else 0.0
+        self.logger.info(
+            f"Parsed {len(html_list)} files ({len(html_list) - num_success} failed), "
+            f"{lag_sec:.1f} sec after download."
+        )
+        return result_df
+
+
+    @classmethod
+    def parse_html(cls, html_path, content=None, encoding=None, **options):
+        raise NotImplementedError("This method should be overridden.")
+
+
+    @staticmethod
+    def get_html_name(html_path):
+        # gzipped downloads are reported under the name of the page
+        name = pathlib.Path(html_path).name
+        if name.endswith(".gz"):
+            name = name[:-len(".gz")]
+
+        return name
+
+
+    @classmethod
+    def list_html_files(cls, local_html_dir):
+        html_list = util.list_all_files(local_html_dir, ".html")
+        html_list += [p for p in util.list_all_files(local_html_dir, ".gz") if p.endswith(".html.gz")]
+        capture_list = util.list_all_files(local_html_dir, ".json")
+
+        return cls.drop_captured_htmls(html_list + capture_list)
+
+
+    @staticmethod
+    def get_download_stem(path):
+        # '{item_id}_{time}' of the html, the gzipped html and the captured '.json' of a download
+        path = str(path)
+        for suffix in (".html.gz", ".html", ".json"):
+            if path.endswith(suffix):
+                return path[:-len(suffix)]
+
+        return path
+
+
+    @classmethod
+    def drop_captured_htmls(cls, paths):
+        """
+        Captured API responses ('.json') replace the html of the same download
+        """
+        captured = {cls.get_download_stem(p) for p in paths if p.endswith(".json")}
+        return [p for p in paths if p.endswith(".json") or cls.get_download_stem(p) not in captured]
+
+
+    def normalize(self, result_df):
+        """
+        Post-parse normalization applied to the whole result at once, in the main process
+        """
+        return result_df
+
+
+    def parse_html_files(self, html_list, pool=None):
+        """
+        Parses the files in batches of parse_batch_size and returns one dataframe
+        """
+        args = self.get_batch_args(html_list)
+        if pool is None:
+            with self.mp_context.Pool(self.num_threads, **profiler.get_pool_kwargs()) as p:
+                result = self.map_batches(p, args)
+                p.close()
+                p.join()
+        else:
+            result = self.map_batches(pool, args)
+
+        return self.merge_batches(html_list, result)
+
+
+    def get_batch_args(self, html_list, num_workers=None):
+        """
+        Arguments of parse_html_batch for each batch of the files
+        """
+        # small inputs still get spread over all the workers
+        num_workers = self.num_threads if num_workers is None else num_workers
+        batch_size = max(1, min(self.parse_batch_size, -(-len(html_list) // num_workers)))
+        batches = [
+            html_list[i:i+batch_size] 
+            for i in range(0, len(html_list), batch_size)
+        ]
+        options = {a: getattr(self, a) for a in self.cache_key_attrs}
+        return [(b, self.cache_path, self.cache_version, options) for b in batches]
+
+
+    def merge_batches(self, html_list, result):
+        """
+        One dataframe from the results of parse_html_batch, with the new entries put in the cache
+        """
+        if len(result) == 0:
+            return pd.DataFrame(columns=["html", "parse_success"])
+
+        new_entries = [e for _, entries in result for e in entries]
+        if self.cache_version is not None:
+            ParseCache.open(self.cache_path, self.cache_version).put_many(new_entries)
+            self.logger.info(
+                f"Parse cache: {len(html_list) - len(new_entries)} hits, {len(new_entries)} parsed."
+            )
+
+        return pd.concat([df for df, _ in result], ignore_index=True)
+
+
+    def map_batches(self, pool, args):
+        if self.controller is None:
+            return pool.starmap(self.parse_html_batch, args)
+
+        # keeps controller.num_workers batches in flight; the other pool workers stay idle
+        result = [None] * len(args)
+        done = queue.Queue()
+        num_running = 0
+        next_index = 0
+        while next_index < len(args) or num_running > 0:
+            while next_index < len(args) and num_running < self.controller.num_workers:
+                pool.apply_async(
+                    self.parse_html_batch, 
+                    args[next_index],
+                    callback=functools.partial(self.put_batch_result, done, next_index),
+                    error_callback=functools.partial(self.put_batch_result, done, next_index)
+                )
+                num_running += 1
+                next_index += 1
+
+            index, batch_result = done.get()
+            if isinstance(batch_result, Exception):
+                raise batch_result
+
+            result[index] = batch_result
+            num_running -= 1
+            self.controller.record(len(args[index][0]))
+            self.controller.update()
+
+        return result
+
+
+    @staticmethod
+    def put_batch_result(done, index, batch_result):
+        done.put((index, batch_result))
+
+
+    @classmethod
+    def parse_html_batch(cls, html_paths, cache_path=None, cache_version=None, options=None):
+        """
+        Parses a batch of files in a worker. Files are read into a buffer reused
+        across the batch, and the results come back as one dataframe together with
+        the new cache entries [(content hash, result), ...].
+        """
+        options = {} if options is None else options
+        if cls._reader is None:
+            cls._reader = util.ReusableReader()
+
+        cache = None
+        if cache_version is not None:
+            cache = ParseCache.open(cache_path, cache_version)
+
+        results = []
+        new_entries = []
+        for html_path in html_paths:
+            html_path = pathlib.Path(html_path)
+            content, encoding = cls._reader.read(html_path)
+            if content is None:
+                results.append(cls.parse_html(html_path, **options))
+                continue
+
+            content_hash = None
+            if cache is not None:
+                content_hash = ParseCache.hash_content(content)
+                result = cache.get(content_hash)
+                if result is not None:
+                    results.append({"html": cls.get_html_name(html_path), **result})
+                    continue
+
+            # pages that are actually parsed are decoded once, straight from the buffer
+            result = cls.parse_html(html_path, util.decode_html(content, encoding), encoding, **options)
+            results.append(result)
+            if content_hash is not None:
+                new_entries.append((content_hash, {k: v for k, v in result.items() if k != "html"}))
+
+        return pd.DataFrame(results), new_entries
+
+
+    def update_history(self, result_df):
+        history = ItemHistory(self.history_path)
+        try:
+            changes = history.update(result_df)
+        finally:
+            history.close()
+
+        # feed the changes back to the download scheduler, if it is used
+        if self.schedule_path.exists():
+            scheduler = DownloadScheduler(self.schedule_path)
+            try:
+                scheduler.record_fetches(changes)
+            finally:
+                scheduler.close()
+
+        self.logger.info(
+            f"Item history: {len(changes)} items, {int(changes['changed'].sum())} changed."
+        )
+        return changes
 
 
     def start_parser(self):
         self.logger.info(f"Start parsing htmls: {self.platform}.")
+        if self.history_path is None and self.schedule_path.exists():
+            self.logger.warning(
+                "Price changes are only fed to the download schedule with update_history (--history). "
+                "Without it, changed items are backed off like unchanged ones."
+            )
+
 
+    def get_autotune_path(self):
+        return self.log_dir / "autotune_settings.json"
 
-    def finish_parser(self, result_df):
-        parse_results = []
-        for i, line in result_df.iterrows():
-            html = line["html"]
-            r = line["parse_success"]
-            parse_results.append(f"{html}: {r}")
 
-        text = "\n".join(parse_results)
+    @staticmethod
+    def add_outcomes(summary, result_df):
+        if len(result_df) == 0:
+            return
+
+        reasons = result_df["parse_error"] if "parse_error" in result_df else None
+        summary.extend(result_df["html"], result_df["parse_success"], reasons)
+
+
+    def finish_parser(self, result_df=None, summary=None):
+        """
+        Logs and saves the summary of the run, made from result_df unless it is given
+        """
+        if summary is None:
+            summary = RunSummary(self.platform, "parser")
+            self.add_outcomes(summary, result_df)
+        outcome_path = summary.save(self.log_dir)
+
+        if self.controller is not None:
+            autotune_path = self.controller.save(self.get_autotune_path())
+            self.logger.info(
+                f"Autotuned workers: best {self.controller.get_best_setting()}, saved to '{autotune_path}'"
+            )
+
         self.logger.info(f"Finish parsing htmls: {self.platform}.")
+        self.logger.info(f"Parse summary: \n{summary.to_text()}")
+        if outcome_path is not None:
+            self.logger.info(f"Parse outcomes: '{outcome_path}'")
+
+        return summary
 
 
 if __name__ == "__main__":
@@ -0,0 +1,249 @@
+import time
+import heapq
+import sqlite3
+import pathlib
+import pandas as pd
+
+
+class DownloadScheduler(object):
+    """
+    Decides which items to (re-)download within a fixed request budget.
+    New items and items whose price recently changed come first; unchanged
+    and sold-out items are backed off exponentially.
+    The downloader records its outcomes with record_downloads: deleted items
+    are retired, failed downloads are retried later and the others are backed off.
+    Price changes are only detected by record_fetches, which the parser calls
+    when it runs with update_history (--history).
+
+    """
+    # weight of each item class when sharing the budget
+    weights = {
+        "new": 8.0,
+        "changed": 4.0,
+        "on_sale": 1.0,
+        "soldout": 0.25,
+    }
+    chunk_size = 900
+    # columns added after the first version of the schema
+    added_columns = {
+        "last_downloaded": "REAL",
+        "leased_at": "REAL",
+        "num_failures": "INTEGER NOT NULL DEFAULT 0",
+        "is_retired": "INTEGER NOT NULL DEFAULT 0",
+    }
+
+
+    def __init__(
+        self,
+        db_path,
+        base_interval_sec=6 * 60 * 60,
+        max_interval_sec=30 * 24 * 60 * 60,
+        backoff=2.0,
+        soldout_backoff=4.0
+        ):
+        self.db_path = pathlib.Path(db_path)
+        self.db_path.parent.mkdir(exist_ok=True, parents=True)
+        self.base_interval_sec = base_interval_sec
+        self.max_interval_sec = max_interval_sec
+        self.backoff = backoff
+        self.soldout_backoff = soldout_backoff
+        self.conn = sqlite3.connect(str(self.db_path), timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS schedule ("
+            "item_id TEXT PRIMARY KEY, "
+            "next_due REAL NOT NULL, "
+            "interval REAL NOT NULL, "
+            "last_fetched REAL, "
+            "last_changed REAL, "
+            "is_soldout INTEGER NOT NULL DEFAULT 0);"
+            "CREATE INDEX IF NOT EXISTS schedule_next_due ON schedule (next_due);"
+        )
+        columns = {r[1] for r in self.conn.execute("PRAGMA table_info(schedule)")}
+        for name, column_type in self.added_columns.items():
+            if name not in columns:
+                self.conn.execute(f"ALTER TABLE schedule ADD COLUMN {name} {column_type}")
+        self.conn.commit()
+
+
+    def close(self):
+        self.conn.close()
+
+
+    def add_items(self, item_ids, now=None):
+        """
+        Registers newly crawled items. Known items keep their schedule.
+        """
+        if now is None:
+            now = time.time()
+
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO schedule (item_id, next_due, interval) VALUES (?, ?, ?)",
+            [(str(item_id), now, self.base_interval_sec) for item_id in item_ids]
+        )
+        self.conn.commit()
+
+
+    def get_item_class(self, last_fetched, last_downloaded, last_changed, is_soldout, now):
+        if last_fetched is None and last_downloaded is None:
+            return "new"
+        if is_soldout:
+            return "soldout"
+        if last_changed is not None and now - last_changed <= 2 * self.base_interval_sec:
+            return "changed"
+        return "on_sale"
+
+
+    def select(self, budget, now=None):
+        """
+        Returns up to budget due item ids in priority order.
+        The selected items are leased until their next interval, so that
+        they are not selected again before their result is recorded.
+        """
+        if now is None:
+            now = time.time()
+
+        heap = []
+        cursor = self.conn.execute(
+            "SELECT item_id, next_due, interval, last_fetched, last_downloaded, last_changed, is_soldout "
+            "FROM schedule WHERE next_due <= ? AND is_retired = 0",
+            (now,)
+        )
+        for item_id, next_due, interval, last_fetched, last_downloaded, last_changed, is_soldout in cursor:
+            item_class = self.get_item_class(last_fetched, last_downloaded, last_changed, is_soldout, now)
+            # the longer an item is overdue relative to its interval, the higher its score
+            score = self.weights[item_class] * (now - next_due + interval) / interval
+            entry = (score, item_id, interval)
+            if len(heap) < budget:
+                heapq.heappush(heap, entry)
+            elif score > heap[0][0]:
+                heapq.heappushpop(heap, entry)
+
+        selected = sorted(heap, reverse=True)
+        self.conn.executemany(
+            "UPDATE schedule SET next_due = ?, leased_at = ? WHERE item_id = ?",
+            [(now + interval, now, item_id) for _, item_id, interval in selected]
+        )
+        self.conn.commit()
+
+        return [item_id for _, item_id, _ in selected]
+
+
+    def get_rows(self, item_ids, columns):
+        rows = {}
+        for i in range(0, len(item_ids), self.chunk_size):
+            chunk = item_ids[i:i+self.chunk_size]
+            placeholders = ",".join("?" * len(chunk))
+            cursor = self.conn.execute(
+                f"SELECT item_id, {', '.join(columns)} FROM schedule WHERE item_id IN ({placeholders})",
+                chunk
+            )
+            rows.update({r[0]: r[1:] for r in cursor})
+        return rows
+
+
+    def record_downloads(self, item_ids, successes, is_gone, now=None):
+        """
+        Records the outcomes of a download run.
+        successes: whether each item was downloaded.
+        is_gone: whether each item was deleted or not found; these are retired.
+        Failed downloads are retried after an exponentially growing delay.
+        Downloaded items are backed off as unchanged, unless the parser already
+        recorded their fetch; record_fetches resets the changed ones.
+        Items that are not in the schedule are ignored.
+        """
+        if now is None:
+            now = time.time()
+
+        item_ids = [str(item_id) for item_id in item_ids]
+        current = self.get_rows(item_ids, ["interval", "last_fetched", "leased_at", "num_failures"])
+
+        retired, failed, downloaded = [], [], []
+        for item_id, success, gone in zip(item_ids, successes, is_gone):
+            if item_id not in current:
+                continue
+            interval, last_fetched, leased_at, num_failures = current[item_id]
+
+            if gone:
+                retired.append((item_id,))
+            elif not success:
+                num_failures = num_failures + 1
+                delay = min(self.base_interval_sec * self.backoff ** num_failures, self.max_interval_sec)
+                failed.append((now + delay, num_failures, item_id))
+            else:
+                fetch_recorded = last_fetched is not None and leased_at is not None and last_fetched >= leased_at
+                if not fetch_recorded:
+                    interval = min(interval * self.backoff, self.max_interval_sec)
+                    downloaded.append((now + interval, interval, now, item_id))
+                else:
+                    downloaded.append((last_fetched + interval, interval, now, item_id))
+
+        self.conn.executemany("UPDATE schedule SET is_retired = 1 WHERE item_id = ?", retired)
+        self.conn.executemany(
+            "UPDATE schedule SET next_due = ?, num_failures = ? WHERE item_id = ?", failed
+        )
+        self.conn.executemany(
+            "UPDATE schedule SET next_due = ?, interval = ?, last_downloaded = ?, num_failures = 0 "
+            "WHERE item_id = ?",
+            downloaded
+        )
+        self.conn.commit()
+
+        return {"retired": len(retired), "failed": len(failed), "downloaded": len(downloaded)}
+
+
+    def record_fetches(self, changes):
+        """
+        changes: DataFrame with item_id, fetched_at, changed and is_soldout,
+        as returned by ItemHistory.update. Fetches that are not newer than
+        the last recorded fetch of their item are ignored.
+        """
+        if len(changes) == 0:
+            return
+
+        item_ids = changes["item_id"].astype(str).tolist()
+        current = self.get_rows(item_ids, ["interval", "last_fetched", "last_changed", "last_downloaded"])
+
+        updates = []
+        for item_id, fetched_at, changed, is_soldout in zip(
+            item_ids, changes["fetched_at"], changes["changed"], changes["is_soldout"]
+            ):
+            interval, last_fetched, last_changed, last_downloaded = current.get(
+                item_id, (self.base_interval_sec, None, None, None)
+            )
+            if last_fetched is not None and fetched_at <= last_fetched:
+                continue
+
+            is_soldout = bool(is_soldout) if pd.notna(is_soldout) else False
+
+            if changed:
+                interval = self.base_interval_sec
+                last_changed = fetched_at
+            elif last_downloaded is None or last_downloaded < fetched_at:
+                interval = interval * self.backoff
+            # otherwise record_downloads already backed off this unchanged fetch
+
+            if is_soldout:
+                interval = interval * self.soldout_backoff
+
+            interval = min(interval, self.max_interval_sec)
+            updates.append((
+                item_id, fetched_at + interval, interval, fetched_at, last_changed, int(is_soldout)
+            ))
+
+        self.conn.executemany(
+            "INSERT INTO schedule (item_id, next_due, interval, last_fetched, last_changed, is_soldout) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(item_id) DO UPDATE SET "
+            "next_due = excluded.next_due, "
+            "interval = excluded.interval, "
+            "last_fetched = excluded.last_fetched, "
+            "last_changed = excluded.last_changed, "
+            "is_soldout = excluded.is_soldout",
+            updates
+        )
+        self.conn.commit()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,66 @@
+import re
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    import json
+    loads = json.loads
+
+
+script_pattern = r"<script\b([^>]*)>(.*?)</script\s*>"
+json_attr_pattern = r"""type\s*=\s*["']application/(?:ld\+)?json["']|id\s*=\s*["']__NEXT_DATA__["']"""
+# compiled for both str and UTF-8 bytes content
+patterns = {
+    str: (
+        re.compile(script_pattern, re.S | re.I),
+        re.compile(json_attr_pattern, re.I),
+    ),
+    bytes: (
+        re.compile(script_pattern.encode(), re.S | re.I),
+        re.compile(json_attr_pattern.encode(), re.I),
+    ),
+}
+
+
+def find_json_payloads(content):
+    """
+    Decodes the JSON embedded in <script> tags of the html, such as
+    the Next.js hydration state or JSON-LD, without building a DOM.
+    content may be str or UTF-8 bytes.
+    """
+    payloads = []
+    if content is None:
+        return payloads
+
+    script_re, json_attr_re = patterns[bytes if isinstance(content, (bytes, bytearray)) else str]
+    for m in script_re.finditer(content):
+        attrs, body = m.group(1), m.group(2).strip()
+        if len(body) == 0 or json_attr_re.search(attrs) is None:
+            continue
+
+        try:
+            payloads.append(loads(body))
+        except ValueError:
+            continue
+
+    return payloads
+
+
+def find_dicts(payload, predicate):
+    """
+    Yields the dicts nested in the payload that satisfy the predicate
+    """
+    stack = [payload]
+    while len(stack) > 0:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            if predicate(obj):
+                yield obj
+            stack.extend(obj.values())
+
+        elif isinstance(obj, list):
+            stack.extend(obj)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,95 @@
+import os
+import time
+import pathlib
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+class FileWatcher(object):
+    """
+    Reports the files that appear in a directory (not recursive) after the watcher starts.
+    Uses inotify when inotify_simple is installed; otherwise the directory is only
+    rescanned when its mtime changes, and a file is reported once it has not been
+    modified for settle_sec, so that files still being written are not picked up.
+
+    """
+    def __init__(self, directory, suffixes=(".html",), poll_sec=1.0, settle_sec=1.0, use_inotify=True):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(exist_ok=True, parents=True)
+        self.suffixes = tuple(suffixes)
+        self.poll_sec = poll_sec
+        self.settle_sec = settle_sec
+
+        self.inotify = None
+        if use_inotify and inotify_simple is not None:
+            flags = inotify_simple.flags
+            self.inotify = inotify_simple.INotify()
+            # files are complete once closed after writing, or renamed into place
+            self.inotify.add_watch(str(self.directory), flags.CLOSE_WRITE | flags.MOVED_TO)
+        else:
+            self.dir_mtime = None
+            self.seen = set(self.scan())
+            self.unsettled = {}
+
+
+    @property
+    def mode(self):
+        return "inotify" if self.inotify is not None else "polling"
+
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+
+    def is_target(self, name):
+        return name.endswith(self.suffixes)
+
+
+    def scan(self):
+        # one directory read; only stat()s the new files
+        with os.scandir(self.directory) as entries:
+            return [e.name for e in entries if self.is_target(e.name) and e.is_file()]
+
+
+    def poll(self, timeout=None):
+        """
+        Waits up to timeout seconds (default poll_sec) and returns the paths of the new files
+        """
+        if timeout is None:
+            timeout = self.poll_sec
+
+        if self.inotify is not None:
+            events = self.inotify.read(timeout=int(timeout * 1000))
+            return [str(self.directory / e.name) for e in events if self.is_target(e.name)]
+
+        time.sleep(timeout)
+        dir_mtime = os.stat(self.directory).st_mtime_ns
+        if dir_mtime != self.dir_mtime:
+            self.dir_mtime = dir_mtime
+            for name in self.scan():
+                if name not in self.seen:
+                    self.seen.add(name)
+                    self.unsettled[name] = None
+
+        new_paths = []
+        now = time.time()
+        for name in list(self.unsettled):
+            path = self.directory / name
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                del self.unsettled[name]
+                continue
+
+            if now - mtime >= self.settle_sec:
+                del self.unsettled[name]
+                new_paths.append(str(path))
+
+        return new_paths
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,126 @@
+import numpy as np
+
+
+# "1" + 18 digits still fits in int64
+max_digits = 18
+invalid_code = -1
+block_size = 1 << 18
+
+
+def encode(item_ids, prefix="m"):
+    """
+    Encodes ids of the form prefix + digits (e.g. "m12345678901") to int64 as int("1" + digits),
+    so that leading zeros survive. Ids of any other form become invalid_code.
+    prefix is a single character.
+    """
+    # one spare byte to tell ids that are too long
+    width = max_digits + 2
+    try:
+        ids = np.asarray(item_ids, dtype=f"S{width}")
+    except UnicodeEncodeError:
+        ids = np.asarray([i if str(i).isascii() else "" for i in item_ids], dtype=f"S{width}")
+
+    codes = np.empty(len(ids), dtype=np.int64)
+    # blocks keep the per-character intermediates small
+    for start in range(0, len(ids), block_size):
+        codes[start:start+block_size] = encode_block(ids[start:start+block_size], prefix, width)
+
+    return codes
+
+
+def encode_block(ids, prefix, width):
+    # one row of bytes per id, padded with zeros on the right
+    chars = ids.view(np.uint8).reshape(len(ids), width)
+    lengths = (chars != 0).sum(axis=1)
+    is_valid = (chars[:, 0] == ord(prefix)) & (lengths >= 2) & (lengths < width)
+
+    # Horner's method over the digit columns, starting from the leading "1"
+    codes = np.ones(len(ids), dtype=np.int64)
+    for j in range(1, width - 1):
+        column = chars[:, j]
+        is_active = j < lengths
+        is_valid &= ~is_active | ((column >= ord("0")) & (column <= ord("9")))
+        codes = np.where(is_active, codes * 10 + (column.astype(np.int64) - ord("0")), codes)
+
+    return np.where(is_valid, codes, invalid_code)
+
+
+def decode(codes, prefix="m"):
+    """
+    Inverse of encode. Returns a numpy str array.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    if len(codes) == 0:
+        return np.empty(0, dtype=f"U{max_digits + 1}")
+
+    # "1" + digits, with the leading "1" swapped for the prefix
+    text = codes.astype(f"U{max_digits + 1}")
+    chars = text.view(np.uint32).reshape(len(codes), -1).copy()
+    chars[:, 0] = ord(prefix)
+
+    return chars.view(f"U{max_digits + 1}").ravel()
+
+
+def is_valid(codes):
+    return np.asarray(codes) != invalid_code
+
+
+def unique(codes):
+    """
+    Sorted distinct codes. Sorting int64 is cheaper than np.unique's generic path.
+    """
+    codes = np.sort(np.asarray(codes, dtype=np.int64))
+    if len(codes) == 0:
+        return codes
+
+    is_first = np.empty(len(codes), dtype=bool)
+    is_first[0] = True
+    np.not_equal(codes[1:], codes[:-1], out=is_first[1:])
+    return codes[is_first]
+
+
+def unique_in_order(codes):
+    """
+    Distinct codes in the order they first appear
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    if len(codes) == 0:
+        return codes
+
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    is_first = np.empty(len(codes), dtype=bool)
+    is_first[0] = True
+    np.not_equal(sorted_codes[1:], sorted_codes[:-1], out=is_first[1:])
+    return codes[np.sort(order[is_first])]
+
+
+def contains(sorted_codes, codes):
+    """
+    Whether each of codes is in sorted_codes (as returned by unique)
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    if len(sorted_codes) == 0:
+        return np.zeros(len(codes), dtype=bool)
+
+    positions = np.minimum(np.searchsorted(sorted_codes, codes), len(sorted_codes) - 1)
+    return sorted_codes[positions] == codes
+
+
+def difference(codes, other_codes):
+    """
+    Codes not in other_codes, deduplicated and in the order they first appear
+    """
+    codes = unique_in_order(codes)
+    return codes[~contains(unique(other_codes), codes)]
+
+
+def split(codes, num_chunks):
+    """
+    Splits into num_chunks contiguous views. They are pickled as one buffer each.
+    """
+    return [c for c in np.array_split(codes, num_chunks) if len(c) > 0]
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,206 @@
+import sqlite3
+import pathlib
+import numpy as np
+import pandas as pd
+
+
+def to_epoch(timestamps):
+    """
+    Converts tz-aware timestamps to float epoch seconds (NaT -> NaN)
+    """
+    return (pd.to_datetime(timestamps, utc=True) - pd.Timestamp(0, tz="UTC")) / pd.Timedelta(seconds=1)
+
+
+class ItemHistory(object):
+    """
+    Incremental history of items keyed by item_id.
+    item_state holds the latest observation of each item, and item_delta only
+    gets a row when the price, the sold-out state or last_updated changes.
+
+    """
+    tracked_columns = ["price", "is_soldout", "last_updated_at"]
+    chunk_size = 900
+
+
+    def __init__(self, db_path, last_updated_tolerance_sec=24 * 60 * 60):
+        self.db_path = pathlib.Path(db_path)
+        self.db_path.parent.mkdir(exist_ok=True, parents=True)
+        # relative times like "3日前" drift between fetches without a real update
+        self.last_updated_tolerance_sec = last_updated_tolerance_sec
+        self.conn = sqlite3.connect(str(self.db_path), timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS item_state ("
+            "item_id TEXT PRIMARY KEY, "
+            "price INTEGER, "
+            "is_soldout INTEGER, "
+            "last_updated_at REAL, "
+            "first_seen REAL, "
+            "last_seen REAL, "
+            "last_changed REAL);"
+            "CREATE TABLE IF NOT EXISTS item_delta ("
+            "item_id TEXT NOT NULL, "
+            "fetched_at REAL NOT NULL, "
+            "price INTEGER, "
+            "is_soldout INTEGER, "
+            "last_updated_at REAL);"
+        )
+        self.create_delta_index()
+        self.conn.commit()
+
+
+    def create_delta_index(self):
+        # one delta per fetch; databases of earlier versions may hold duplicates from re-parses
+        if self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'item_delta_fetch'"
+            ).fetchone() is not None:
+            return
+
+        self.conn.executescript(
+            "DELETE FROM item_delta WHERE rowid NOT IN "
+            "(SELECT MIN(rowid) FROM item_delta GROUP BY item_id, fetched_at);"
+            "DROP INDEX IF EXISTS item_delta_item_id;"
+            "CREATE UNIQUE INDEX item_delta_fetch ON item_delta (item_id, fetched_at);"
+        )
+
+
+    def close(self):
+        self.conn.close()
+
+
+    def load_state(self, item_ids):
+        """
+        Loads the current state of the given items only
+        """
+        item_ids = list(item_ids)
+        frames = []
+        for i in range(0, len(item_ids), self.chunk_size):
+            chunk = item_ids[i:i+self.chunk_size]
+            placeholders = ",".join("?" * len(chunk))
+            frames.append(pd.read_sql_query(
+                f"SELECT * FROM item_state WHERE item_id IN ({placeholders})",
+                self.conn,
+                params=chunk
+            ))
+
+        if len(frames) == 0:
+            return pd.read_sql_query("SELECT * FROM item_state LIMIT 0", self.conn)
+
+        return pd.concat(frames, ignore_index=True)
+
+
+    def update(self, result_df):
+        """
+        Records the parser result. Fetches that are not newer than the stored last_seen
+        of their item are skipped, so parsing the same files again changes nothing.
+        Returns one row per item with a new fetch: item_id, fetched_at,
+        changed (whether any delta was recorded) and is_soldout.
+        """
+        columns = ["item_id", "fetched_at"] + self.tracked_columns
+        df = result_df
+        if "parse_success" in df:
+            df = df[df["parse_success"].astype(bool)]
+
+        df = pd.DataFrame({
+            "item_id": df["item_id"].astype(str),
+            "fetched_at": to_epoch(df["fetched_at"]),
+            "price": pd.to_numeric(df["price"], errors="coerce"),
+            "is_soldout": df["is_soldout"].astype(float),
+            "last_updated_at": to_epoch(df["last_updated_at"]) if "last_updated_at" in df else np.nan,
+        })
+        df = df.dropna(subset=["fetched_at"]) \
+            .drop_duplicates(subset=["item_id", "fetched_at"]) \
+            .sort_values(["item_id", "fetched_at"], ignore_index=True)
+
+        state = self.load_state(df["item_id"].unique()).set_index("item_id")
+        last_seen = state["last_seen"].reindex(df["item_id"]).to_numpy(dtype=float)
+        df = df[~(df["fetched_at"].to_numpy() <= last_seen)].reset_index(drop=True)
+
+        if len(df) == 0:
+            return pd.DataFrame(columns=["item_id", "fetched_at", "changed", "is_soldout"])
+
+        # previous observation: the preceding row of the same item in this batch,
+        # or the stored state for the first row of each item
+        is_first = df["item_id"].ne(df["item_id"].shift())
+        prev = df[self.tracked_columns].shift()
+        stored = state.reindex(df["item_id"])[self.tracked_columns] \
+            .astype(float).set_axis(df.index)
+        prev = prev.mask(is_first, stored)
+        is_new = is_first & ~df["item_id"].isin(state.index)
+
+        changed = is_new \
+            | self.differs(df["price"], prev["price"]) \
+            | self.differs(df["is_soldout"], prev["is_soldout"]) \
+            | (df["last_updated_at"] - prev["last_updated_at"] > self.last_updated_tolerance_sec)
+
+        deltas = df[changed]
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO item_delta (item_id, fetched_at, price, is_soldout, last_updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            self.to_rows(deltas[columns])
+        )
+
+        # latest row of each item goes to item_state
+        df["last_changed"] = df["fetched_at"].where(changed)
+        df["last_changed"] = df.groupby("item_id")["last_changed"].ffill()
+        df["first_seen"] = df.groupby("item_id")["fetched_at"].transform("first")
+        latest = df.groupby("item_id", sort=False).tail(1)
+        self.conn.executemany(
+            "INSERT INTO item_state "
+            "(item_id, price, is_soldout, last_updated_at, first_seen, last_seen, last_changed) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(item_id) DO UPDATE SET "
+            "price = excluded.price, "
+            "is_soldout = excluded.is_soldout, "
+            "last_updated_at = excluded.last_updated_at, "
+            "last_seen = MAX(excluded.last_seen, item_state.last_seen), "
+            "last_changed = COALESCE(excluded.last_changed, item_state.last_changed)",
+            self.to_rows(latest[[
+                "item_id", "price", "is_soldout", "last_updated_at",
+                "first_seen", "fetched_at", "last_changed"
+            ]])
+        )
+        self.conn.commit()
+
+        summary = df.assign(changed=changed).groupby("item_id", sort=False).agg(
+            fetched_at=("fetched_at", "last"),
+            changed=("changed", "any"),
+            is_soldout=("is_soldout", "last"),
+        ).reset_index()
+
+        return summary
+
+
+    @staticmethod
+    def differs(current, previous):
+        return (current != previous) & ~(current.isna() & previous.isna())
+
+
+    @staticmethod
+    def to_rows(df):
+        df = df.astype({c: "Int64" for c in ["price", "is_soldout"] if c in df})
+        df = df.astype(object).where(df.notna(), None)
+        return list(df.itertuples(index=False, name=None))
+
+
+    def get_current(self, item_ids=None):
+        """
+        Returns the current state of the items (all items if item_ids is None)
+        """
+        if item_ids is None:
+            return pd.read_sql_query("SELECT * FROM item_state", self.conn)
+
+        return self.load_state(item_ids)
+
+
+    def get_price_series(self, item_id):
+        return pd.read_sql_query(
+            "SELECT fetched_at, price, is_soldout, last_updated_at FROM item_delta "
+            "WHERE item_id = ? ORDER BY fetched_at",
+            self.conn,
+            params=[str(item_id)]
+        )
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,81 @@
+import pandas as pd
+import util
+
+
+# seconds of each unit in relative times such as "3日前" or "1時間前"
+relative_time_units = {
+    "秒": 1,
+    "分": 60,
+    "時間": 60 * 60,
+    "日": 24 * 60 * 60,
+    "週間": 7 * 24 * 60 * 60,
+    "か月": 30 * 24 * 60 * 60,
+    "ヶ月": 30 * 24 * 60 * 60,
+    "ヵ月": 30 * 24 * 60 * 60,
+    "年": 365 * 24 * 60 * 60,
+}
+relative_time_pattern = r"(\d+)\s*(" + "|".join(relative_time_units.keys()) + r")前"
+range_pattern = r"(\d+)(?:\s*[~〜～\-]\s*(\d+))?"
+
+
+def map_unique(series, func):
+    """
+    Applies func to the distinct values only and broadcasts the result back.
+    The columns here have few distinct values, so this avoids per-row work.
+    """
+    codes, uniques = pd.factorize(series)
+    mapped = func(pd.Series(uniques, dtype=object))
+
+    # code -1 (missing value) is not in the index and becomes NA
+    return mapped.reindex(codes).set_axis(series.index)
+
+
+def parse_fetch_time(html_names):
+    """
+    Returns the fetch time embedded in '{item_id}_{%Y-%m-%d-%H-%M-%S}.html'
+    """
+    def to_datetime(uniques):
+        fetched_at = pd.to_datetime(uniques, format="%Y-%m-%d-%H-%M-%S", errors="coerce")
+        return fetched_at.dt.tz_localize(util.JST)
+
+    # the timestamp has a fixed width, so slicing is enough; other names become NaT
+    timestamps = html_names.astype("string").str.slice(-24, -5)
+    return map_unique(timestamps, to_datetime)
+
+
+def relative_time_to_timestamp(texts, anchors):
+    """
+    Converts relative times ("3日前") to timestamps anchored at anchors.
+    Absolute times ("2022-07-04 11:09:07", JST) are parsed as is.
+    """
+    def to_seconds(uniques):
+        parts = uniques.astype("string").str.extract(relative_time_pattern)
+        units = parts[1].map(relative_time_units)
+        return pd.to_numeric(parts[0], errors="coerce") * units
+
+    def to_absolute(uniques):
+        absolute = pd.to_datetime(uniques, format="%Y-%m-%d %H:%M:%S", errors="coerce")
+        return absolute.dt.tz_localize(util.JST)
+
+    seconds = map_unique(texts, to_seconds)
+    relative = anchors - pd.to_timedelta(seconds, unit="s")
+    absolute = map_unique(texts, to_absolute)
+
+    return relative.fillna(absolute)
+
+
+def range_to_min_max(texts):
+    """
+    Converts ranges such as "2~3日で発送" to (min, max) integer columns
+    """
+    def to_min_max(uniques):
+        parts = uniques.astype("string").str.extract(range_pattern)
+        parts[1] = parts[1].fillna(parts[0])
+        return parts.apply(pd.to_numeric, errors="coerce").astype("Int64")
+
+    result = map_unique(texts, to_min_max)
+    return result[0], result[1]
+
+
+if __name__ == "__main__":
+    pass
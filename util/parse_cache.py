@@ -0,0 +1,106 @@
+import os
+import zlib
+import sqlite3
+import hashlib
+import inspect
+import pathlib
+import importlib
+try:
+    import orjson
+    dumps, loads = orjson.dumps, orjson.loads
+except ImportError:
+    import json
+    dumps = lambda obj: json.dumps(obj, ensure_ascii=False).encode("UTF-8")
+    loads = json.loads
+
+
+class ParseCache(object):
+    """
+    Persistent cache of parse results keyed by (content hash, parser version).
+    Results are stored as zlib-compressed JSON in sqlite.
+
+    """
+    _instances = {}
+
+
+    def __init__(self, cache_path, version):
+        self.cache_path = pathlib.Path(cache_path)
+        self.cache_path.parent.mkdir(exist_ok=True, parents=True)
+        self.version = version
+        self.conn = sqlite3.connect(str(self.cache_path), timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS parse_cache ("
+            "content_hash BLOB NOT NULL, "
+            "version TEXT NOT NULL, "
+            "result BLOB NOT NULL, "
+            "PRIMARY KEY (content_hash, version))"
+        )
+        self.conn.commit()
+
+
+    @classmethod
+    def open(cls, cache_path, version):
+        """
+        Returns a cache instance shared within the current process
+        """
+        key = (os.getpid(), str(cache_path), version)
+        if key not in cls._instances:
+            cls._instances[key] = cls(cache_path, version)
+
+        return cls._instances[key]
+
+
+    @staticmethod
+    def hash_content(content):
+        return hashlib.blake2b(content, digest_size=16).digest()
+
+
+    @staticmethod
+    def get_version(parser_cls, *options, modules=()):
+        """
+        Derives the version from the source of the parser class and its base classes,
+        the modules (names) its parse logic calls and the options that change its output,
+        so that changing the parse logic invalidates the cache.
+        Returns None if a source is not available.
+        """
+        try:
+            sources = [inspect.getsource(c) for c in parser_cls.__mro__ if c is not object]
+            sources += [inspect.getsource(importlib.import_module(m)) for m in modules]
+        except (OSError, TypeError):
+            return None
+
+        key = "\n".join(sources + [repr(o) for o in options])
+        return hashlib.blake2b(key.encode("UTF-8"), digest_size=8).hexdigest()
+
+
+    def get(self, content_hash):
+        row = self.conn.execute(
+            "SELECT result FROM parse_cache WHERE content_hash = ? AND version = ?",
+            (content_hash, self.version)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return loads(zlib.decompress(row[0]))
+
+
+    def put_many(self, entries):
+        """
+        entries: list of (content_hash, result dict)
+        """
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO parse_cache (content_hash, version, result) VALUES (?, ?, ?)",
+            [(h, self.version, zlib.compress(dumps(r))) for h, r in entries]
+        )
+        self.conn.commit()
+
+
+    def purge_old_versions(self):
+        self.conn.execute("DELETE FROM parse_cache WHERE version != ?", (self.version,))
+        self.conn.commit()
+
+
+if __name__ == "__main__":
+    pass
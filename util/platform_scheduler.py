@@ -0,0 +1,629 @@
+import re
+import sys
+import time
+import pathlib
+import argparse
+import importlib
+import threading
+import collections
+import pandas as pd
+import multiprocessing as mp
+current_dir = pathlib.Path(__file__).parent
+import util
+import columnar
+import profiler
+import crawler_base as cb
+from run_summary import RunReport
+from autotune import ConcurrencyController, TunedWorkers, TaskQueue
+
+# the platform directories (e.g. mercari/) are imported as packages from the repository root
+repo_dir = str(current_dir.parent.resolve())
+if repo_dir not in sys.path:
+    sys.path.append(repo_dir)
+
+
+# platform -> its classes and how it shares the pools, see register_platform
+registry = {}
+
+
+def register_platform(
+    platform,
+    downloader=None,
+    parser=None,
+    weight=1.0,
+    rate_per_sec=None,
+    burst=1,
+    html_dir=None,
+    downloader_kwargs=None,
+    parser_kwargs=None
+    ):
+    """
+    Registers the downloader and parser of a platform as "module:Class" paths, imported
+    only when the platform runs. weight is its share of each pool against the other
+    platforms, and rate_per_sec caps how many pages per second it requests (None = no cap).
+    The parser reads html_dir, by default the local output of the downloader.
+    """
+    registry[platform] = {
+        "downloader": downloader,
+        "parser": parser,
+        "html_dir": html_dir,
+        "weight": weight,
+        "rate_per_sec": rate_per_sec,
+        "burst": burst,
+        "downloader_kwargs": {} if downloader_kwargs is None else downloader_kwargs,
+        "parser_kwargs": {} if parser_kwargs is None else parser_kwargs,
+    }
+
+
+def load_class(class_path):
+    module_name, _, class_name = class_path.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+register_platform(
+    "mercari",
+    downloader="mercari.downloader:MercariDownloader",
+    parser="mercari.parser:MercariParser",
+)
+
+
+class TokenBucket(object):
+    """
+    Lets rate_per_sec tasks start per second on average, in bursts of up to burst tasks
+    """
+    def __init__(self, rate_per_sec, burst=1):
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_time = time.time()
+        self.lock = threading.Lock()
+
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate_per_sec)
+        self.last_time = now
+
+
+    def get_wait_sec(self):
+        with self.lock:
+            self.refill()
+            return max(0.0, (1 - self.tokens) / self.rate_per_sec)
+
+
+    def take(self):
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+
+
+class FairQueue(TaskQueue):
+    """
+    Tasks of several platforms waiting for one pool. The next task comes from the platform
+    that has used the least of the pool relative to its weight (stride scheduling), among
+    the platforms that neither their rate limit nor a back-off holds back.
+
+    """
+    def __init__(self, weights, buckets=None):
+        self.weights = dict(weights)
+        self.buckets = {} if buckets is None else buckets
+        self.queues = {p: collections.deque() for p in self.weights}
+        self.passes = {p: 0.0 for p in self.weights}
+        self.paused_until = {p: 0.0 for p in self.weights}
+        # index -> (platform, cost)
+        self.owners = {}
+        self.finished_at = {}
+
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues.values())
+
+
+    def add(self, platform, task, cost=1.0):
+        """
+        Adds a task and returns its index in the results
+        """
+        index = len(self.owners)
+        self.owners[index] = (platform, cost)
+        self.push((index, task))
+        return index
+
+
+    def get_platform(self, index):
+        return self.owners[index][0]
+
+
+    def push(self, item):
+        platform = self.get_platform(item[0])
+        if len(self.queues[platform]) == 0:
+            # a platform that comes back does not get to catch up on the share it left unused
+            self.passes[platform] = max(self.passes[platform], self.get_virtual_time())
+        self.queues[platform].append(item)
+
+
+    def push_front(self, item):
+        self.queues[self.get_platform(item[0])].appendleft(item)
+
+
+    def get_virtual_time(self):
+        passes = [self.passes[p] for p, q in self.queues.items() if len(q) > 0]
+        return min(passes) if len(passes) > 0 else 0.0
+
+
+    def get_platform_wait_sec(self, platform):
+        wait_sec = self.paused_until[platform] - time.time()
+        if platform in self.buckets:
+            wait_sec = max(wait_sec, self.buckets[platform].get_wait_sec())
+
+        return max(wait_sec, 0.0)
+
+
+    def pop(self):
+        ready = [p for p, q in self.queues.items() if len(q) > 0 and self.get_platform_wait_sec(p) == 0]
+        if len(ready) == 0:
+            return None
+
+        platform = min(ready, key=lambda p: self.passes[p])
+        item = self.queues[platform].popleft()
+        if platform in self.buckets:
+            self.buckets[platform].take()
+        self.passes[platform] += self.owners[item[0]][1] / self.weights[platform]
+
+        return item
+
+
+    def get_wait_sec(self):
+        waits = [self.get_platform_wait_sec(p) for p, q in self.queues.items() if len(q) > 0]
+        waits = [w for w in waits if w > 0]
+        return min(waits) if len(waits) > 0 else None
+
+
+    def pause(self, platform, wait_sec):
+        self.paused_until[platform] = max(self.paused_until[platform], time.time() + wait_sec)
+
+
+    def finish(self, index, task, result):
+        self.finished_at[self.get_platform(index)] = time.time()
+        return True
+
+
+class DownloadQueue(FairQueue):
+    """
+    FairQueue of the page downloads (downloader_cls, item_id, num_tries, options).
+    A blocked platform is paused here rather than in its browser, so that the shared
+    browsers keep working for the other platforms, and transient failures are tried again later.
+
+    """
+    def __init__(self, weights, buckets=None):
+        super().__init__(weights, buckets)
+        self.num_blocked = collections.Counter()
+
+
+    def finish(self, index, task, result):
+        platform = self.get_platform(index)
+        downloader_cls, item_id, num_tries, options = task
+        if result == cb.PageState.BLOCKED:
+            self.num_blocked[platform] += 1
+            self.pause(platform, downloader_cls.get_blocked_wait_sec(self.num_blocked[platform]))
+        elif result == cb.PageState.LOADED:
+            self.num_blocked[platform] = 0
+
+        if result in cb.PageState.RETRY_LATER and num_tries < downloader_cls.max_retry:
+            self.push((index, (downloader_cls, item_id, num_tries + 1, options)))
+            return False
+
+        return super().finish(index, task, result)
+
+
+def browser_worker(conn, chromedriver_path=None, headless=True, capture_url_patterns=None):
+    """
+    One browser for the pages of every platform. The network log is on if any platform captures,
+    and each task only captures the API responses of its own platform.
+    """
+    browser = cb.SeleniumCralwer(
+        is_test=False,
+        chromedriver_path=chromedriver_path,
+        headless=headless,
+        capture_url_patterns=capture_url_patterns or None
+    )
+    browser.driver = browser.get_session_selenium()
+    patterns = {}
+    try:
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+
+            downloader_cls, item_id, num_tries, (keep_selectors, capture) = task
+            if downloader_cls not in patterns:
+                browser.get_url(downloader_cls.base_url)
+                patterns[downloader_cls] = [re.compile(p) for p in downloader_cls.capture_url_patterns or []]
+
+            browser.wait_sec = downloader_cls.max_wait_sec
+            browser.capture_url_patterns = patterns[downloader_cls] if capture else None
+            state, _ = downloader_cls.download_item(
+                browser, item_id, keep_selectors, capture, wait_on_block=False
+            )
+            is_error = state in cb.PageState.RETRY_LATER or state == cb.PageState.ERROR
+            conn.send(("done", (state, is_error)))
+
+    finally:
+        cb.SeleniumDownloader.close_browser(browser)
+
+
+def http_worker(conn, s3_bucket_name=None):
+    s3_bucket = None if s3_bucket_name is None else util.get_s3_bucket(s3_bucket_name)
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+
+        downloader_cls, item_id, num_tries, _ = task
+        if s3_bucket is None:
+            success = bool(downloader_cls.download_html_local(item_id))
+        else:
+            success = bool(downloader_cls.download_html_s3(item_id, s3_bucket))
+        conn.send(("done", (success, not success)))
+
+
+def parse_worker(conn):
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+
+        parser_cls, args = task[0], task[1:]
+        conn.send(("done", (parser_cls.parse_html_batch(*args), False)))
+
+
+class PlatformScheduler(object):
+    """
+    Runs the downloads and then the parsing of several registered platforms in one process tree.
+    The platforms share one pool of browsers, one of HTTP workers and one of parser workers:
+    each pool hands its free workers to the platforms in proportion to their weights, within
+    their rate limits, and the outcomes of all the platforms go into one RunReport.
+
+    """
+    log_dir = current_dir / "../logs/scheduler"
+    logger = util.Logger.setup_logger(
+        logger_name=__name__,
+        log_dir=log_dir
+    )
+
+
+    def __init__(
+        self,
+        platforms=None,
+        is_test=False,
+        save_to_s3=False,
+        num_browsers=None,
+        num_http_workers=None,
+        num_parsers=None,
+        weights=None,
+        rate_limits=None,
+        start_method=None,
+        headless=True,
+        autotune=False,
+        memory_limit_mb=None
+        ):
+        self.platforms = list(registry) if platforms is None else list(platforms)
+        unknown = [p for p in self.platforms if p not in registry]
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown platforms: {unknown}. Registered: {list(registry)}")
+
+        self.specs = {p: dict(registry[p]) for p in self.platforms}
+        for platform, weight in ({} if weights is None else weights).items():
+            self.specs[platform]["weight"] = weight
+        for platform, rate_per_sec in ({} if rate_limits is None else rate_limits).items():
+            self.specs[platform]["rate_per_sec"] = rate_per_sec
+
+        self.is_test = is_test
+        self.save_to_s3 = save_to_s3
+        self.s3_bucket = util.get_s3_bucket() if save_to_s3 else None
+        self.headless = headless
+        self.autotune = autotune
+        self.memory_limit_mb = memory_limit_mb
+
+        num_cpus = 1 if is_test else mp.cpu_count()
+        self.num_workers = {
+            "browser": num_cpus if num_browsers is None else int(num_browsers),
+            "http": num_cpus if num_http_workers is None else int(num_http_workers),
+            "parser": num_cpus if num_parsers is None else int(num_parsers),
+        }
+        self.controllers = {}
+        # the pools start their workers from several threads, which fork does not go well with
+        self.mp_context = util.get_mp_context(
+            "forkserver" if start_method is None else start_method,
+            cb.ParserBase.mp_preload
+        )
+        # one bucket per platform, whichever pool its pages go through
+        self.buckets = {
+            p: TokenBucket(s["rate_per_sec"], s["burst"])
+            for p, s in self.specs.items() if s["rate_per_sec"] is not None
+        }
+        self.report = RunReport()
+
+
+    def create(self, platform, role):
+        # the instances open the bucket themselves; the workers get its name as an argument
+        cls = load_class(self.specs[platform][role])
+        return cls(is_test=self.is_test, save_to_s3=self.save_to_s3, **self.specs[platform][f"{role}_kwargs"])
+
+
+    def get_weights(self):
+        return {p: s["weight"] for p, s in self.specs.items()}
+
+
+    def get_autotune_path(self, pool_name):
+        return self.log_dir / f"autotune_{pool_name}.json"
+
+
+    def get_controller(self, pool_name):
+        num_workers = self.num_workers[pool_name]
+        if not self.autotune:
+            return ConcurrencyController(
+                min_workers=num_workers,
+                max_workers=num_workers,
+                interval_sec=float("inf")
+            )
+
+        return ConcurrencyController(
+            max_workers=num_workers,
+            initial_workers=ConcurrencyController.load_best_setting(self.get_autotune_path(pool_name)),
+            memory_limit_mb=self.memory_limit_mb if pool_name == "browser" else None,
+            interval_sec=10.0 if pool_name == "parser" else 30.0,
+        )
+
+
+    def run(self, items=None, new_only=False, budget=None):
+        """
+        Downloads and parses the items of all the platforms and returns the RunReport.
+        items: {platform: crawler output with an item_id column}, the latest crawler output by default.
+        """
+        items = {} if items is None else items
+        self.logger.info(f"Start the scheduler: {', '.join(self.platforms)}. Workers: {self.num_workers}")
+
+        downloaders = {}
+        item_ids = {}
+        for platform in self.platforms:
+            if self.specs[platform]["downloader"] is None:
+                continue
+
+            downloader = self.create(platform, "downloader")
+            ids = self.load_item_ids(downloader, items.get(platform))
+            if ids is None:
+                continue
+
+            ids = downloader.select_items(ids, skip_downloaded=new_only)
+            if budget is not None:
+                ids = downloader.schedule_items(ids, budget)
+
+            downloaders[platform] = downloader
+            item_ids[platform] = ids
+
+        if len(downloaders) > 0:
+            self.run_downloads(downloaders, item_ids)
+
+        parsers = {}
+        html_dirs = {}
+        for platform in self.platforms:
+            spec = self.specs[platform]
+            if spec["parser"] is None:
+                continue
+
+            parsers[platform] = self.create(platform, "parser")
+            html_dirs[platform] = spec["html_dir"]
+            if html_dirs[platform] is None:
+                html_dirs[platform] = load_class(spec["downloader"]).local_output_dir
+
+        if len(parsers) > 0:
+            self.run_parsers(parsers, html_dirs)
+
+        if self.autotune:
+            for pool_name, controller in self.controllers.items():
+                controller.save(self.get_autotune_path(pool_name))
+
+        output_path = self.report.save(self.log_dir)
+        self.logger.info(f"Finish the scheduler: {', '.join(self.platforms)}.")
+        self.logger.info(f"Run report: \n{self.report.to_text()}")
+        if output_path is not None:
+            self.logger.info(f"Run outcomes: '{output_path}'")
+
+        return self.report
+
+
+    def load_item_ids(self, downloader, items_path=None):
+        if items_path is None and hasattr(downloader, "get_latest_crawler_result"):
+            items_path = downloader.get_latest_crawler_result(from_s3=self.save_to_s3)
+
+        if items_path is None:
+            self.logger.warning(f"No crawler output to download: {downloader.platform}")
+            return None
+
+        if self.save_to_s3:
+            _, items_path = util.s3_download_file(
+                self.s3_bucket,
+                items_path,
+                util.get_temp_dir() / pathlib.Path(items_path).name
+            )
+
+        return columnar.read_table(items_path, columns=["item_id"])["item_id"]
+
+
+    def run_downloads(self, downloaders, item_ids):
+        browser_queue = DownloadQueue(self.get_weights(), self.buckets)
+        http_queue = DownloadQueue(self.get_weights(), self.buckets)
+        indices = {}
+        capture_url_patterns = []
+        for platform, downloader in downloaders.items():
+            ids = downloader.decode_item_ids(downloader.encode_item_ids(item_ids[platform]))
+            if self.is_test and len(ids) > 5:
+                ids = ids[:5]
+            item_ids[platform] = ids
+
+            downloader.start_downloader()
+            if isinstance(downloader, cb.SeleniumDownloader):
+                download_queue = browser_queue
+                options = (downloader.keep_selectors if downloader.trim_html else None, downloader.capture)
+                if downloader.capture:
+                    capture_url_patterns += downloader.capture_url_patterns
+            else:
+                download_queue = http_queue
+                options = ()
+
+            indices[platform] = [
+                download_queue.add(platform, (type(downloader), item_id, 0, options))
+                for item_id in ids
+            ]
+
+        start_time = time.time()
+        browser_args = (None, self.headless, capture_url_patterns)
+        http_args = (self.s3_bucket.name if self.save_to_s3 else None,)
+        results = self.run_pools([
+            ("browser", browser_queue, browser_worker, browser_args, cb.PageState.ERROR),
+            ("http", http_queue, http_worker, http_args, False),
+        ])
+
+        for platform, downloader in downloaders.items():
+            download_queue = browser_queue if isinstance(downloader, cb.SeleniumDownloader) else http_queue
+            pool_name = "browser" if download_queue is browser_queue else "http"
+            outcomes = [results[pool_name][i] for i in indices[platform]]
+            summary = downloader.finish_downloader(item_ids[platform], outcomes)
+            self.report.add(summary, download_queue.finished_at.get(platform, start_time) - start_time)
+
+
+    def run_parsers(self, parsers, html_dirs):
+        parse_queue = FairQueue(self.get_weights())
+        html_lists = {}
+        batch_args = {}
+        indices = {}
+        for platform, parser in parsers.items():
+            parser.start_parser()
+            html_list = parser.list_html_files(html_dirs[platform])
+            if self.is_test and len(html_list) > 5:
+                html_list = html_list[:5]
+
+            html_lists[platform] = html_list
+            # batches are weighed by their number of files
+            batch_args[platform] = parser.get_batch_args(html_list, self.num_workers["parser"])
+            indices[platform] = [
+                parse_queue.add(platform, (type(parser),) + args, cost=len(args[0]))
+                for args in batch_args[platform]
+            ]
+
+        start_time = time.time()
+        results = self.run_pools([("parser", parse_queue, parse_worker, (), None)])
+
+        for platform, parser in parsers.items():
+            result = []
+            for index, args in zip(indices[platform], batch_args[platform]):
+                batch_result = results["parser"][index]
+                if batch_result is None:
+                    # the worker died on this batch
+                    batch_result = (pd.DataFrame({
+                        "html": [parser.get_html_name(p) for p in args[0]],
+                        "parse_success": False,
+                        "parse_error": "worker_died",
+                    }), [])
+                result.append(batch_result)
+
+            result_df = parser.normalize(parser.merge_batches(html_lists[platform], result))
+            parser.purge_cache()
+            parser.save_result(result_df, f"output_{util.get_jst_time_str()}")
+            summary = parser.finish_parser(result_df)
+            self.report.add(summary, parse_queue.finished_at.get(platform, start_time) - start_time)
+
+
+    def run_pools(self, pools):
+        """
+        Runs the pools [(name, queue, worker_func, worker_args, error_result), ...] side by side
+        and returns {name: results}
+        """
+        results = {}
+        errors = []
+
+        def run_pool(name, task_queue, worker_func, worker_args, error_result):
+            try:
+                self.controllers[name] = self.get_controller(name)
+                workers = TunedWorkers(self.mp_context, worker_func, worker_args, self.controllers[name])
+                results[name] = workers.run(task_queue, error_result=error_result)
+            except Exception as e:
+                errors.append(e)
+
+        threads = []
+        for pool in pools:
+            name, task_queue = pool[0], pool[1]
+            if len(task_queue) == 0:
+                results[name] = []
+                continue
+
+            self.logger.info(f"Start the {name} pool: {len(task_queue)} tasks, {self.num_workers[name]} workers.")
+            thread = threading.Thread(target=run_pool, args=pool, name=f"{name}_pool")
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+        return results
+
+
+def parse_platform_values(values, value_type=float):
+    """
+    ["mercari=2", ...] -> {"mercari": 2.0, ...}
+    """
+    parsed = {}
+    for value in values:
+        platform, _, v = value.partition("=")
+        parsed[platform] = value_type(v)
+
+    return parsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--platforms", nargs="+", default=None)
+    parser.add_argument("--items", nargs="*", default=[], help="platform=path of the crawler output")
+    parser.add_argument("--weight", nargs="*", default=[], help="platform=share of the pools")
+    parser.add_argument("--rate", nargs="*", default=[], help="platform=max pages per second")
+    parser.add_argument("--is_test", action="store_true")
+    parser.add_argument("--s3", action="store_true")
+    parser.add_argument("--start_method", default=None, choices=["fork", "spawn", "forkserver"])
+    parser.add_argument("--num_browsers", type=int, default=None)
+    parser.add_argument("--num_http_workers", type=int, default=None)
+    parser.add_argument("--num_parsers", type=int, default=None)
+    parser.add_argument("--budget", type=int, default=None)
+    parser.add_argument("--new_only", action="store_true")
+    parser.add_argument("--autotune", action="store_true")
+    parser.add_argument("--memory_limit_mb", type=float, default=None)
+    parser.add_argument("--profile", nargs="?", const="on", default=None, choices=["on", "signal"])
+    args, leftovers = parser.parse_known_args()
+
+    if args.profile is not None:
+        profiler.setup(
+            PlatformScheduler.log_dir,
+            signal_only=(args.profile == "signal")
+        )
+
+    scheduler = PlatformScheduler(
+        platforms=args.platforms,
+        is_test=args.is_test,
+        save_to_s3=args.s3,
+        num_browsers=args.num_browsers,
+        num_http_workers=args.num_http_workers,
+        num_parsers=args.num_parsers,
+        weights=parse_platform_values(args.weight),
+        rate_limits=parse_platform_values(args.rate),
+        start_method=args.start_method,
+        autotune=args.autotune,
+        memory_limit_mb=args.memory_limit_mb
+    )
+    scheduler.run(
+        items=parse_platform_values(args.items, str),
+        new_only=args.new_only,
+        budget=args.budget
+    )
+    profiler.finish()
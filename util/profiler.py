@@ -0,0 +1,330 @@
+import os
+import sys
+import time
+import signal
+import pathlib
+import threading
+import collections
+import multiprocessing as mp
+import multiprocessing.util
+import util
+
+
+logger = util.logger
+# (output_dir, interval, signal_only) of this run, passed on to the pool workers
+_config = None
+_profiler = None
+# merges the profiles once the workers have flushed them after a SIGUSR1 stop
+_merge_thread = None
+# how long the parent waits for the workers to flush their profiles
+flush_wait_sec = 10.0
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of all the threads every interval seconds from a background thread.
+    Stacks are counted by thread name and code objects and only turned into names when
+    dumped, so a sample costs one frame walk per thread. The counts are flushed to flush_path every
+    flush_interval seconds, so that workers killed by Pool.terminate() still leave a profile.
+
+    """
+    def __init__(self, interval=0.005, flush_path=None, flush_interval=5.0):
+        self.interval = interval
+        self.flush_path = flush_path
+        self.flush_interval = flush_interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    @property
+    def is_running(self):
+        return self._thread is not None
+
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="SamplingProfiler", daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        if self.flush_path is not None:
+            self.dump(self.flush_path)
+
+
+    def _run(self):
+        num_samples_per_flush = max(1, int(self.flush_interval / self.interval))
+        i = 0
+        while not self._stop.wait(self.interval):
+            self.sample()
+            i += 1
+            if self.flush_path is not None and i % num_samples_per_flush == 0:
+                self.dump(self.flush_path)
+
+
+    def sample(self):
+        sampler_id = threading.get_ident()
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+
+            if len(stack) > 0:
+                self.counts[(thread_names.get(thread_id, str(thread_id)), tuple(stack))] += 1
+
+
+    @staticmethod
+    def get_frame_name(code):
+        return f"{pathlib.Path(code.co_filename).stem}:{code.co_name}"
+
+
+    def get_collapsed(self, root=None):
+        """
+        Returns {"root;thread;caller;...;callee": count} in the collapsed-stack format of flamegraph.pl
+        """
+        collapsed = collections.Counter()
+        for (thread_name, stack), count in list(self.counts.items()):
+            names = [thread_name] + [self.get_frame_name(c) for c in reversed(stack)]
+            if root is not None:
+                names.insert(0, root)
+            collapsed[";".join(names)] += count
+
+        return collapsed
+
+
+    def dump(self, path):
+        path = pathlib.Path(path)
+        temp_path = path.with_suffix(".tmp")
+        write_collapsed(self.get_collapsed(root=get_role()), temp_path)
+        os.replace(temp_path, path)
+
+
+def get_role():
+    return "worker" if mp.parent_process() is not None else "main"
+
+
+def write_collapsed(collapsed, path):
+    with open(path, "w", encoding="UTF-8") as f:
+        for stack, count in sorted(collapsed.items()):
+            f.write(f"{stack} {count}\n")
+
+
+def read_collapsed(path):
+    collapsed = collections.Counter()
+    with open(path, encoding="UTF-8") as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if len(stack) > 0:
+                collapsed[stack] += int(count)
+
+    return collapsed
+
+
+def summarize(collapsed, top=50):
+    """
+    Returns the per-function table: total (inclusive) and self samples
+    """
+    num_samples = sum(collapsed.values())
+    total = collections.Counter()
+    own = collections.Counter()
+    for stack, count in collapsed.items():
+        frames = stack.split(";")
+        own[frames[-1]] += count
+        # recursive functions are counted once per sample
+        for name in set(frames):
+            total[name] += count
+
+    lines = [
+        f"samples: {num_samples}",
+        f"{'total %':>8} {'self %':>8}  function",
+    ]
+    for name, count in total.most_common(top):
+        lines.append(
+            f"{100 * count / num_samples:8.1f} {100 * own[name] / num_samples:8.1f}  {name}"
+        )
+
+    return "\n".join(lines) + "\n"
+
+
+def merge_profiles(output_dir):
+    """
+    Merges the per-process profiles into profile.collapsed and summary.txt
+    """
+    output_dir = pathlib.Path(output_dir)
+    collapsed = collections.Counter()
+    for path in output_dir.glob("*_*.collapsed"):
+        collapsed.update(read_collapsed(path))
+
+    if len(collapsed) == 0:
+        return None
+
+    write_collapsed(collapsed, output_dir / "profile.collapsed")
+    with open(output_dir / "summary.txt", "w", encoding="UTF-8") as f:
+        f.write(summarize(collapsed))
+
+    return output_dir / "profile.collapsed"
+
+
+def start_process_profiler():
+    global _profiler
+    output_dir, interval, _ = _config
+    if _profiler is None:
+        _profiler = SamplingProfiler(
+            interval=interval,
+            flush_path=pathlib.Path(output_dir) / f"{get_role()}_{os.getpid()}.collapsed"
+        )
+        # runs when the process exits normally, including pool workers after close/join
+        multiprocessing.util.Finalize(None, _profiler.stop, exitpriority=100)
+
+    _profiler.start()
+
+
+def get_worker_profile_path(pid):
+    return pathlib.Path(_config[0]) / f"worker_{pid}.collapsed"
+
+
+def get_mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def forward_signal():
+    """
+    Sends SIGUSR1 to the child processes and returns {pid: mtime of its profile before}
+    """
+    previous = {}
+    for child in mp.active_children():
+        previous[child.pid] = get_mtime_ns(get_worker_profile_path(child.pid))
+        os.kill(child.pid, signal.SIGUSR1)
+
+    return previous
+
+
+def merge_after_flush(previous, timeout=None):
+    """
+    Waits until every worker has rewritten its profile, or timeout, and merges the profiles
+    """
+    timeout = flush_wait_sec if timeout is None else timeout
+    deadline = time.time() + timeout
+    pending = dict(previous)
+    while True:
+        for pid, mtime in list(pending.items()):
+            if get_mtime_ns(get_worker_profile_path(pid)) != mtime:
+                pending.pop(pid)
+
+        if len(pending) == 0 or time.time() > deadline:
+            break
+        time.sleep(0.05)
+
+    if len(pending) > 0:
+        logger.warning(f"Profiles of workers {sorted(pending)} were not flushed in {timeout} seconds.")
+
+    merge_profiles(_config[0])
+    logger.info(f"Profiling stopped: '{_config[0]}'")
+
+
+def toggle(signum=None, frame=None):
+    """
+    SIGUSR1 handler: starts the profiler, or stops it and writes the profile.
+    The parent forwards the signal to its pool workers, and on stop merges the
+    profiles in the background once the workers have flushed theirs.
+    """
+    global _merge_thread
+    if _profiler is not None and _profiler.is_running:
+        _profiler.stop()
+        if get_role() == "main":
+            _merge_thread = threading.Thread(
+                target=merge_after_flush, args=(forward_signal(),), name="ProfileMerge", daemon=True
+            )
+            _merge_thread.start()
+    else:
+        start_process_profiler()
+        if get_role() == "main":
+            forward_signal()
+            logger.info("Profiling started.")
+
+
+def install_signal_handler():
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, toggle)
+
+
+def setup(log_dir, interval=0.005, signal_only=False):
+    """
+    Profiles this process and the pool workers created with get_pool_kwargs().
+    With signal_only, profiling only runs between two SIGUSR1s sent to the parent.
+    Returns the directory the profiles are written to.
+    """
+    global _config
+    output_dir = pathlib.Path(log_dir) / f"profile_{util.get_jst_time_str()}"
+    output_dir.mkdir(exist_ok=True, parents=True)
+    _config = (str(output_dir), interval, signal_only)
+
+    install_signal_handler()
+    if not signal_only:
+        start_process_profiler()
+
+    logger.info(f"Profiling to '{output_dir}' (pid {os.getpid()}, signal_only={signal_only}).")
+    return output_dir
+
+
+def init_worker(config, log_queue=None):
+    global _config, _profiler
+    util.Logger.attach_queue(log_queue)
+    if config is None:
+        return
+
+    _config = config
+    # a forked worker must not keep the parent's profiler
+    _profiler = None
+    install_signal_handler()
+    if not config[2]:
+        start_process_profiler()
+
+
+def get_pool_kwargs():
+    """
+    Keyword arguments for Pool() that set up the workers: their log records go to
+    the main process, and the profiler starts in them if profiling
+    """
+    return {"initializer": init_worker, "initargs": (_config, util.Logger.get_queue())}
+
+
+def finish():
+    """
+    Stops profiling and merges the profiles of all processes
+    """
+    if _config is None:
+        return None
+
+    if _profiler is not None:
+        _profiler.stop()
+    if _merge_thread is not None:
+        _merge_thread.join()
+
+    output_path = merge_profiles(_config[0])
+    if output_path is not None:
+        logger.info(f"Profile written: '{output_path}'")
+
+    return output_path
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,262 @@
+import os
+import shutil
+import pathlib
+import tempfile
+import traceback
+import weakref
+from collections import Counter
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import util
+
+
+outcome_schema = pa.schema([
+    ("item_id", pa.string()),
+    ("success", pa.bool_()),
+    ("reason", pa.string()),
+])
+
+
+def outcomes_to_df(table):
+    df = table.to_pandas()
+    df["item_id"] = df["item_id"].astype("string")
+    df["success"] = df["success"].astype("bool")
+    df["reason"] = df["reason"].astype("category")
+    return df
+
+
+class RunSummary(object):
+    """
+    Aggregates per-item outcomes of a run incrementally.
+    Only counts, a failure-reason histogram and a sample of failed ids are kept
+    in memory; the per-item outcomes are spooled to parquet parts of chunk_rows
+    rows and combined into one file by save.
+
+    """
+    chunk_rows = 100000
+
+
+    def __init__(self, platform, stage, num_samples=20):
+        self.platform = platform
+        self.stage = stage
+        self.num_samples = num_samples
+        self.num_items = 0
+        self.num_success = 0
+        self.failure_reasons = Counter()
+        self.failed_samples = []
+        # random keys of the sampled failures, the smallest num_samples keys are kept
+        self.sample_keys = np.empty(0)
+        self.pending = []
+        self.num_pending = 0
+        self.spool_dir = None
+        self.part_paths = []
+        # set once save has combined the parts into one file
+        self.output_path = None
+
+
+    @property
+    def num_failure(self):
+        return self.num_items - self.num_success
+
+
+    def add(self, item_id, success, reason=None):
+        self.extend([item_id], [success], [reason])
+
+
+    def extend(self, item_ids, successes, reasons=None):
+        item_ids = np.asarray(item_ids).astype(str).astype(object)
+        successes = np.asarray(successes, dtype=bool)
+        if reasons is None:
+            reasons = np.where(successes, None, "failed").astype(object)
+        else:
+            reasons = np.array(reasons, dtype=object)
+            reasons[successes] = None
+            reasons[~successes & pd.isna(reasons)] = "failed"
+
+        if len(item_ids) == 0:
+            return
+
+        failed = ~successes
+        self.num_items += len(item_ids)
+        self.num_success += int(successes.sum())
+        self.failure_reasons.update(pd.Series(reasons[failed]).astype(str).value_counts().to_dict())
+        self.add_samples(item_ids[failed])
+
+        self.pending.append(pa.table(
+            {"item_id": item_ids, "success": successes, "reason": reasons}, schema=outcome_schema
+        ))
+        self.num_pending += len(item_ids)
+        if self.num_pending >= self.chunk_rows:
+            self.flush()
+
+
+    def add_samples(self, failed_ids):
+        # bottom-k sampling: an unbiased sample of all failures without storing them
+        if len(failed_ids) == 0:
+            return
+
+        keys = np.concatenate([self.sample_keys, np.random.random(len(failed_ids))])
+        ids = np.concatenate([np.asarray(self.failed_samples, dtype=object), failed_ids])
+        keep = np.argsort(keys, kind="stable")[:self.num_samples]
+        self.sample_keys = keys[keep]
+        self.failed_samples = ids[keep].tolist()
+
+
+    def flush(self):
+        if self.num_pending == 0:
+            return
+
+        if self.spool_dir is None:
+            self.spool_dir = tempfile.mkdtemp(prefix=f"{self.stage}_outcomes_")
+            # the parts are removed with the summary if it is never saved
+            weakref.finalize(self, shutil.rmtree, self.spool_dir, ignore_errors=True)
+
+        part_path = pathlib.Path(self.spool_dir) / f"part_{len(self.part_paths):05d}.parquet"
+        pq.write_table(pa.concat_tables(self.pending), part_path)
+        self.part_paths.append(part_path)
+        self.pending = []
+        self.num_pending = 0
+
+
+    def iter_batches(self):
+        """
+        Yields the per-item outcomes as pyarrow record batches, a part at a time
+        """
+        self.flush()
+        paths = [self.output_path] if self.output_path is not None else self.part_paths
+        for path in paths:
+            yield from pq.ParquetFile(path).iter_batches(batch_size=self.chunk_rows)
+
+
+    def to_text(self):
+        lines = [
+            f"platform: {self.platform}, stage: {self.stage}",
+            f"items: {self.num_items}, success: {self.num_success}, failure: {self.num_failure}",
+        ]
+
+        if len(self.failure_reasons) > 0:
+            lines.append("failure reasons:")
+            for reason, count in self.failure_reasons.most_common():
+                lines.append(f"  {reason}: {count}")
+
+        if len(self.failed_samples) > 0:
+            lines.append(f"failed samples: {', '.join(self.failed_samples)}")
+
+        return "\n".join(lines)
+
+
+    def to_df(self):
+        batches = list(self.iter_batches())
+        return outcomes_to_df(pa.Table.from_batches(batches, schema=outcome_schema))
+
+
+    def save(self, output_dir):
+        """
+        Writes the per-item outcomes as parquet and returns the path, or None on failure
+        """
+        output_dir = pathlib.Path(output_dir)
+        output_dir.mkdir(exist_ok=True, parents=True)
+        output_path = output_dir / f"{self.stage}_outcomes_{util.get_jst_time_str()}.parquet"
+        temp_path = output_path.with_name(output_path.name + ".part")
+
+        try:
+            with pq.ParquetWriter(temp_path, outcome_schema) as writer:
+                for batch in self.iter_batches():
+                    writer.write_batch(batch)
+            os.replace(temp_path, output_path)
+
+        except Exception as e:
+            temp_path.unlink(missing_ok=True)
+            util.logger.error(
+                f"Failed to save the run outcomes: '{output_path}'\n{traceback.format_exc()}"
+            )
+            return None
+
+        self.output_path = output_path
+        if self.spool_dir is not None:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+        self.part_paths = []
+        return output_path
+
+
+class RunReport(object):
+    """
+    One report over the RunSummary of every platform and stage of a run
+    """
+    def __init__(self):
+        self.summaries = []
+        self.elapsed = []
+
+
+    def add(self, summary, elapsed_sec=None):
+        self.summaries.append(summary)
+        self.elapsed.append(elapsed_sec)
+
+
+    def to_text(self):
+        lines = [
+            f"{'platform':<16} {'stage':<12} {'items':>8} {'success':>8} {'failure':>8} {'items/sec':>10}",
+        ]
+        for summary, elapsed_sec in zip(self.summaries, self.elapsed):
+            rate = "-" if not elapsed_sec else f"{summary.num_items / elapsed_sec:.2f}"
+            lines.append(
+                f"{str(summary.platform):<16} {summary.stage:<12} {summary.num_items:>8} "
+                f"{summary.num_success:>8} {summary.num_failure:>8} {rate:>10}"
+            )
+
+        details = [s.to_text() for s in self.summaries if s.num_failure > 0]
+        return "\n".join(lines + details)
+
+
+    schema = pa.schema([("platform", pa.string()), ("stage", pa.string())] + list(outcome_schema))
+
+
+    def iter_batches(self):
+        for summary in self.summaries:
+            for batch in summary.iter_batches():
+                yield pa.RecordBatch.from_arrays(
+                    [
+                        pa.array([summary.platform] * batch.num_rows, pa.string()),
+                        pa.array([summary.stage] * batch.num_rows, pa.string()),
+                    ] + batch.columns,
+                    schema=self.schema
+                )
+
+
+    def to_df(self):
+        df = outcomes_to_df(pa.Table.from_batches(list(self.iter_batches()), schema=self.schema))
+        for column in ["platform", "stage"]:
+            df[column] = df[column].astype("category")
+
+        return df
+
+
+    def save(self, output_dir):
+        """
+        Writes the per-item outcomes of all the summaries as one parquet and returns the path, or None on failure
+        """
+        output_dir = pathlib.Path(output_dir)
+        output_dir.mkdir(exist_ok=True, parents=True)
+        output_path = output_dir / f"run_outcomes_{util.get_jst_time_str()}.parquet"
+        temp_path = output_path.with_name(output_path.name + ".part")
+
+        try:
+            with pq.ParquetWriter(temp_path, self.schema) as writer:
+                for batch in self.iter_batches():
+                    writer.write_batch(batch)
+            os.replace(temp_path, output_path)
+
+        except Exception as e:
+            temp_path.unlink(missing_ok=True)
+            util.logger.error(
+                f"Failed to save the run report: '{output_path}'\n{traceback.format_exc()}"
+            )
+            return None
+
+        return output_path
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,341 @@
+import re
+import queue
+import sqlite3
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import util
+
+
+logger = util.logger
+# partitions written by columnar.write_parquet
+date_partition_pattern = re.compile(r"(?:^|/)date=(\d{4}-\d{2}-\d{2})/$")
+# split points are built from printable ASCII characters only
+min_char, max_char = 0x20, 0x7e
+
+
+def is_closed_date_partition(partition_prefix):
+    """
+    A 'date=YYYY-MM-DD/' partition no longer gets new keys once the day is over (JST)
+    """
+    m = date_partition_pattern.search(partition_prefix)
+    if m is None:
+        return False
+
+    return m.group(1) < util.get_jst_time().strftime("%Y-%m-%d")
+
+
+def get_split_point(start_after, upto, prefix):
+    """
+    Returns a key roughly halfway between start_after and upto (None = end of the prefix),
+    or None if there is no room between them.
+    """
+    lower = start_after.encode("utf-8")
+    upper = (upto if upto is not None else prefix + chr(max_char)).encode("utf-8")
+    if lower >= upper:
+        return None
+
+    # midpoint of the two keys read as base-95 numbers
+    width = max(len(lower), len(upper)) + 2
+    base = max_char - min_char + 1
+    def to_number(key):
+        digits = [min(max(b, min_char), max_char) - min_char for b in key]
+        digits += [0] * (width - len(digits))
+        return sum(d * base ** (width - 1 - i) for i, d in enumerate(digits))
+
+    number = (to_number(lower) + to_number(upper)) // 2
+    mid = [(number // base ** (width - 1 - i)) % base for i in range(width)]
+    split_point = bytes(d + min_char for d in mid).rstrip(bytes([min_char]))
+    if not lower < split_point < upper:
+        return None
+
+    return split_point.decode("ascii")
+
+
+class ListingManifest(object):
+    """
+    Keys already listed under each root prefix, and the partitions that will
+    not get new keys, so that later runs only list what may have changed.
+
+    """
+    chunk_size = 900
+
+
+    def __init__(self, db_path):
+        self.db_path = pathlib.Path(db_path)
+        self.db_path.parent.mkdir(exist_ok=True, parents=True)
+        self.conn = sqlite3.connect(str(self.db_path), timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS listed_key ("
+            "root TEXT NOT NULL, "
+            "key TEXT NOT NULL, "
+            "PRIMARY KEY (root, key));"
+            "CREATE TABLE IF NOT EXISTS closed_partition ("
+            "root TEXT NOT NULL, "
+            "partition TEXT NOT NULL, "
+            "PRIMARY KEY (root, partition));"
+        )
+        self.conn.commit()
+
+
+    def close(self):
+        self.conn.close()
+
+
+    def get_closed_partitions(self, root):
+        rows = self.conn.execute("SELECT partition FROM closed_partition WHERE root = ?", (root,))
+        return {r[0] for r in rows}
+
+
+    def close_partitions(self, root, partitions):
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO closed_partition (root, partition) VALUES (?, ?)",
+            [(root, p) for p in partitions]
+        )
+        self.conn.commit()
+
+
+    def iter_partition_keys(self, root, partition):
+        rows = self.conn.execute(
+            "SELECT key FROM listed_key WHERE root = ? AND key >= ? AND key < ?",
+            (root, partition, partition + chr(0x10ffff))
+        )
+        for r in rows:
+            yield r[0]
+
+
+    def get_new_keys(self, root, keys):
+        """
+        Returns the keys that were not recorded before
+        """
+        new_keys = []
+        for i in range(0, len(keys), self.chunk_size):
+            chunk = keys[i:i+self.chunk_size]
+            placeholders = ",".join("?" * len(chunk))
+            known = {r[0] for r in self.conn.execute(
+                f"SELECT key FROM listed_key WHERE root = ? AND key IN ({placeholders})",
+                [root] + chunk
+            )}
+            new_keys.extend(k for k in chunk if k not in known)
+
+        return new_keys
+
+
+    def add_keys(self, root, keys):
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO listed_key (root, key) VALUES (?, ?)",
+            [(root, k) for k in keys]
+        )
+        self.conn.commit()
+
+
+class S3Lister(object):
+    """
+    Lists the keys under a prefix with concurrent list_objects_v2 calls.
+    Each task lists one page of a key range and, while there are idle threads,
+    splits the rest of its range in two, so the listing spreads over the threads
+    whatever the key layout is. Keys are yielded as the pages arrive, unordered.
+
+    With a manifest, the new keys are only recorded by commit_keys, once the caller
+    is done with them, so that keys that were listed but not processed, e.g. because
+    the caller stopped early or failed, are listed as new again by the next run.
+
+    """
+    page_size = 1000
+
+
+    def __init__(self, s3_bucket, num_threads=16, manifest_path=None, is_closed=is_closed_date_partition):
+        self.s3_bucket = s3_bucket
+        self.client = s3_bucket.meta.client
+        self.num_threads = num_threads
+        self.manifest_path = manifest_path
+        self.is_closed = is_closed
+        # new keys yielded but not committed yet, and the partitions to close once they are
+        self.pending_keys = {}
+        self.closable_partitions = {}
+
+
+    def list_page(self, prefix, start_after=None, delimiter=None, continuation_token=None):
+        kwargs = {"Bucket": self.s3_bucket.name, "Prefix": prefix, "MaxKeys": self.page_size}
+        if start_after is not None:
+            kwargs["StartAfter"] = start_after
+        if delimiter is not None:
+            kwargs["Delimiter"] = delimiter
+        if continuation_token is not None:
+            kwargs["ContinuationToken"] = continuation_token
+
+        return self.client.list_objects_v2(**kwargs)
+
+
+    def list_partitions(self, prefix):
+        """
+        Returns the keys directly under the prefix and its sub-prefixes ("directories"),
+        or None if the prefix is flat and holds more than one page of keys.
+        """
+        keys, partitions = [], []
+        token = None
+        while True:
+            page = self.list_page(prefix, delimiter="/", continuation_token=token)
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+            partitions.extend(p["Prefix"] for p in page.get("CommonPrefixes", []))
+            if not page.get("IsTruncated"):
+                return keys, partitions
+
+            if len(partitions) == 0:
+                return None
+
+            token = page["NextContinuationToken"]
+
+
+    def iter_ranges(self, prefixes):
+        """
+        Yields lists of keys under each of the prefixes, listing them concurrently
+        """
+        results = queue.Queue()
+        stop = threading.Event()
+        lock = threading.Lock()
+        state = {"pending": 0}
+        done = object()
+        executor = ThreadPoolExecutor(self.num_threads)
+
+        def submit(prefix, start_after, upto):
+            with lock:
+                state["pending"] += 1
+            executor.submit(list_range, prefix, start_after, upto)
+
+        def list_range(prefix, start_after, upto):
+            # lists the keys k with start_after < k <= upto (upto None = no upper bound)
+            try:
+                if stop.is_set():
+                    return
+
+                page = self.list_page(prefix, start_after=start_after)
+                page_keys = [obj["Key"] for obj in page.get("Contents", [])]
+                keys = page_keys if upto is None else [k for k in page_keys if k <= upto]
+
+                results.put(keys)
+                # the range is done once the page ends or reaches beyond upto
+                if page.get("IsTruncated") and len(keys) == len(page_keys) and keys[-1] != upto:
+                    last_key = keys[-1]
+                    with lock:
+                        has_idle = state["pending"] < self.num_threads
+                    split_point = get_split_point(last_key, upto, prefix) if has_idle else None
+
+                    if split_point is None:
+                        submit(prefix, last_key, upto)
+                    else:
+                        submit(prefix, last_key, split_point)
+                        submit(prefix, split_point, upto)
+
+            except Exception as e:
+                results.put(e)
+
+            finally:
+                with lock:
+                    state["pending"] -= 1
+                    if state["pending"] == 0:
+                        results.put(done)
+
+        try:
+            if len(prefixes) == 0:
+                return
+
+            for prefix in prefixes:
+                submit(prefix, None, None)
+
+            while True:
+                item = results.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+        finally:
+            # the caller may stop early, e.g. when enough keys were listed
+            stop.set()
+            executor.shutdown(wait=False)
+
+
+    def iter_keys(self, prefix, new_only=False):
+        """
+        Yields the keys under the prefix in batches. With a manifest, closed partitions
+        are read from the manifest instead of S3, and new_only skips the keys listed before.
+        """
+        prefix = str(prefix)
+        if self.manifest_path is None:
+            if new_only:
+                raise ValueError("new_only requires a manifest")
+
+            yield from self.iter_ranges([prefix])
+            return
+
+        manifest = ListingManifest(self.manifest_path)
+        pending = self.pending_keys.setdefault(prefix, set())
+        def select(keys):
+            new_keys = manifest.get_new_keys(prefix, keys)
+            pending.update(new_keys)
+            return new_keys if new_only else keys
+
+        try:
+            listing = self.list_partitions(prefix)
+            if listing is None:
+                # flat layout: nothing to skip, but the listing is still split over the threads
+                for keys in self.iter_ranges([prefix]):
+                    yield select(keys)
+                return
+
+            keys, partitions = listing
+            closed = manifest.get_closed_partitions(prefix)
+            open_partitions = [p for p in partitions if p not in closed]
+            logger.debug(
+                f"Listing '{prefix}': {len(open_partitions)} open and "
+                f"{len(partitions) - len(open_partitions)} closed partitions."
+            )
+
+            yield select(keys)
+
+            if not new_only:
+                for partition in partitions:
+                    if partition in closed:
+                        yield list(manifest.iter_partition_keys(prefix, partition))
+
+            for keys in self.iter_ranges(open_partitions):
+                yield select(keys)
+
+            # only partitions that were listed to the end are closed, by commit_keys
+            self.closable_partitions[prefix] = [p for p in open_partitions if self.is_closed(p)]
+
+        finally:
+            manifest.close()
+
+
+    def commit_keys(self, keys):
+        """
+        Records the keys yielded by iter_keys as listed, and closes the partitions
+        whose new keys are all recorded
+        """
+        if self.manifest_path is None:
+            return
+
+        keys = set(keys)
+        manifest = ListingManifest(self.manifest_path)
+        try:
+            for root, pending in self.pending_keys.items():
+                done = pending & keys
+                manifest.add_keys(root, sorted(done))
+                pending -= done
+
+                # the partition of a key is its first "directory" below the root
+                pending_partitions = {k[:k.find("/", len(root)) + 1] for k in pending}
+                closable = self.closable_partitions.get(root, [])
+                manifest.close_partitions(root, [p for p in closable if p not in pending_partitions])
+                self.closable_partitions[root] = [p for p in closable if p in pending_partitions]
+
+        finally:
+            manifest.close()
+
+
+if __name__ == "__main__":
+    pass
@@ -3,21 +3,19 @@ import os
 import time
 import datetime
 import traceback
-import boto3
 import pathlib
-import numpy as np
-import pandas as pd
-from bs4 import BeautifulSoup
-import requests
+import gzip
+import json
+import atexit
+import threading
 import logging
+import logging.handlers
 import multiprocessing as mp
-import slackweb
 from dotenv import load_dotenv
 
 
 current_dir = pathlib.Path(__file__).parent
 temp_dir = current_dir / "../temp"
-temp_dir.mkdir(exist_ok=True, parents=True)
 user_agent = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "\
     + "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.0.0 Safari/537.36"
 headers = {
@@ -25,6 +23,12 @@ headers = {
 }
 load_dotenv(current_dir / "../.env")
 JST = datetime.timezone(datetime.timedelta(hours=+9), "JST")
+http_config = {
+    "http2": os.environ.get("HTTP2", "0") == "1",
+    "timeout": float(os.environ.get("HTTP_TIMEOUT", 30.0)),
+    "pool_maxsize": 8,
+}
+_sessions = {}
 
 
 def get_jst_time():
@@ -35,46 +39,274 @@ def get_jst_time_str():
     return get_jst_time().strftime("%Y-%m-%d-%H-%M-%S")
 
 
+def get_temp_dir():
+    temp_dir.mkdir(exist_ok=True, parents=True)
+    return temp_dir
+
+
+def get_mp_context(start_method=None, preload=None):
+    """
+    Returns a multiprocessing context. With "forkserver", the modules in preload
+    are imported once in the server process instead of in every worker.
+    """
+    ctx = mp.get_context(start_method)
+    if start_method == "forkserver" and preload:
+        ctx.set_forkserver_preload(list(preload))
+
+    return ctx
+
+
+def get_s3_bucket(bucket_name=None, profile_name="crawling"):
+    # boto3 is only imported by the runs that actually use S3
+    import boto3
+
+    if bucket_name is None:
+        bucket_name = os.environ.get("BUCKET_NAME", None)
+
+    s3_session = boto3.Session(profile_name=profile_name)
+    return s3_session.resource("s3").Bucket(bucket_name)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        log = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "process": record.processName,
+            "logger": record.name,
+            "file": record.filename,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            log["exc_info"] = self.formatException(record.exc_info)
+
+        return json.dumps(log, ensure_ascii=False)
+
+
+class _LogDispatcher(logging.Handler):
+    """
+    Writes the records of all the processes, in the main process only. Handlers are
+    created on the first record of each logger and log_dir, from the route on the record.
+    """
+    def __init__(self, file_buffer_size):
+        super().__init__()
+        self.file_buffer_size = file_buffer_size
+        # logger name -> stream handler, (logger name, log_dir) -> file handler
+        self.stream_handlers = {}
+        self.file_handlers = {}
+
+
+    def emit(self, record):
+        level, log_dirs, json_format = record.log_route
+        for handler in self.get_handlers(record.name, level, log_dirs, json_format):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+    def get_handlers(self, logger_name, level, log_dirs, json_format):
+        if logger_name not in self.stream_handlers:
+            sh = logging.StreamHandler()
+            sh.setLevel(level)
+            sh.setFormatter(Logger.get_formatter(json_format))
+            self.stream_handlers[logger_name] = sh
+
+        handlers = [self.stream_handlers[logger_name]]
+        for log_dir in log_dirs:
+            key = (logger_name, log_dir)
+            if key not in self.file_handlers:
+                self.file_handlers[key] = self.create_file_handler(log_dir, json_format)
+            handlers.append(self.file_handlers[key])
+
+        return handlers
+
+
+    def create_file_handler(self, log_dir, json_format):
+        log_dir = pathlib.Path(log_dir)
+        log_dir.mkdir(exist_ok=True, parents=True)
+        fh = logging.FileHandler(log_dir / f"{get_jst_time_str()}.log", encoding="UTF-8")
+        fh.setLevel(logging.DEBUG)
+        fh.setFormatter(Logger.get_formatter(json_format))
+
+        # write the file in batches, but flush warnings and errors right away
+        mh = logging.handlers.MemoryHandler(
+            self.file_buffer_size,
+            flushLevel=logging.WARNING,
+            target=fh
+        )
+        mh.setLevel(logging.DEBUG)
+        return mh
+
+
+    def flush(self):
+        for handler in list(self.stream_handlers.values()) + list(self.file_handlers.values()):
+            handler.flush()
+
+
+    def close(self):
+        for handler in list(self.stream_handlers.values()) + list(self.file_handlers.values()):
+            # closing a MemoryHandler flushes it and lets go of its target
+            target = getattr(handler, "target", None)
+            handler.close()
+            if target is not None:
+                target.close()
+
+        super().close()
+
+
+class _RouteHandler(logging.Handler):
+    """
+    The only handler of the loggers: attaches the route of the logger to the record
+    and passes it to Logger.dispatch
+    """
+    def emit(self, record):
+        route = Logger._routes[record.name]
+        record.log_route = (route["level"], tuple(route["log_dirs"]), route["json_format"])
+        Logger.dispatch(record)
+
+
 class Logger(object):
-    @staticmethod
+    """
+    All the records are written by the main process. Its own records go straight to
+    the handlers; the records of worker processes come over a multiprocessing queue,
+    read by a listener thread that only starts once a pool asks for the queue
+    (profiler.get_pool_kwargs). A worker's logger can name its own log_dir: the route travels
+    with the record and the main process opens the file.
+
+    """
+    log_format = "%(asctime)s[%(levelname)s/%(processName)s]%(filename)s(%(lineno)d): %(message)s"
+    file_buffer_size = 64
+    _queue = None
+    _sender = None
+    _listener = None
+    _dispatcher = None
+    _fallback = None
+    _owner_pid = None
+    # pools may be started from several threads, e.g. by the platform scheduler
+    _lock = threading.Lock()
+    # logger name -> {"level", "log_dirs", "json_format"}
+    _routes = {}
+
+
+    @classmethod
     def setup_logger(
+        cls,
         logger_name="default",
         level=logging.INFO,
-        log_dir=None
+        log_dir=None,
+        json_format=None
         ):
-        logging.basicConfig(stream=sys.stderr)
-        logger = logging.getLogger(logger_name)
-        logger.setLevel(level)
+        if json_format is None:
+            json_format = os.environ.get("LOG_FORMAT", "") == "json"
 
-        sh = logging.StreamHandler()
-        sh.setLevel(level)
-        formatter = logging.Formatter(
-            "%(asctime)s[%(levelname)s/%(processName)s]%(filename)s(%(lineno)d): %(message)s"
-        )
-        sh.setFormatter(formatter)
-        logger.addHandler(sh)
+        logger = logging.getLogger(logger_name)
+        logger.setLevel(min(level, logger.level or level))
         logger.propagate = False
 
+        # calling setup_logger again for the same logger does not stack handlers
+        if logger.name not in cls._routes:
+            cls._routes[logger.name] = {"level": level, "log_dirs": [], "json_format": json_format}
+            logger.addHandler(_RouteHandler())
+
         if log_dir is not None:
-            pathlib.Path(log_dir).mkdir(exist_ok=True, parents=True)
-            logger = Logger.add_file_handler(logger, log_dir)
+            log_dir = str(pathlib.Path(log_dir).resolve())
+            if log_dir not in cls._routes[logger.name]["log_dirs"]:
+                cls._routes[logger.name]["log_dirs"].append(log_dir)
 
         return logger
 
 
-    @staticmethod
-    def add_file_handler(logger, log_dir, level=logging.DEBUG):
-        log_file_name = f"{get_jst_time_str()}.log"
-        log_file_path = pathlib.Path(log_dir) / log_file_name
-        fh = logging.FileHandler(log_file_path)
-        fh.setLevel(level)
-        fh_formatter = logging.Formatter(
-            "%(asctime)s[%(levelname)s/%(processName)s]%(filename)s(%(lineno)d): %(message)s"
-        )
-        fh.setFormatter(fh_formatter)
-        logger.addHandler(fh)
+    @classmethod
+    def get_formatter(cls, json_format=False):
+        if json_format:
+            return JsonFormatter()
+
+        return logging.Formatter(cls.log_format)
 
-        return logger
+
+    @classmethod
+    def is_owner(cls):
+        # the first process that logs without a multiprocessing parent writes the logs
+        if cls._owner_pid is None and mp.parent_process() is None:
+            cls._owner_pid = os.getpid()
+            cls._dispatcher = _LogDispatcher(cls.file_buffer_size)
+            atexit.register(cls.stop_listener)
+
+        return cls._owner_pid == os.getpid()
+
+
+    @classmethod
+    def dispatch(cls, record):
+        if cls.is_owner():
+            cls._dispatcher.handle(record)
+        elif cls._queue is not None:
+            if cls._sender is None:
+                cls._sender = logging.handlers.QueueHandler(cls._queue)
+            cls._sender.handle(record)
+        else:
+            # a worker that was not given the queue only has stderr
+            if cls._fallback is None:
+                cls._fallback = logging.StreamHandler()
+                cls._fallback.setFormatter(cls.get_formatter(record.log_route[2]))
+            cls._fallback.handle(record)
+
+
+    @classmethod
+    def get_queue(cls):
+        """
+        The queue for the records of worker processes. In the main process,
+        the listener thread is started on the first call.
+        """
+        if not cls.is_owner():
+            return cls._queue
+
+        with cls._lock:
+            if cls._listener is None:
+                # a queue of the spawn context can be handed to workers of any start method
+                cls._queue = mp.get_context("spawn").Queue(-1)
+                cls._listener = logging.handlers.QueueListener(cls._queue, cls._dispatcher)
+                cls._listener.start()
+        return cls._queue
+
+
+    @classmethod
+    def attach_queue(cls, queue):
+        """
+        Sends the records of this worker process to the main process
+        """
+        if queue is None or cls.is_owner():
+            return
+
+        cls._queue = queue
+        cls._sender = None
+
+
+    @classmethod
+    def flush(cls):
+        """
+        Writes out the records the workers have sent so far
+        """
+        if not cls.is_owner():
+            return
+
+        with cls._lock:
+            if cls._listener is not None:
+                # stop() returns once the queue is drained
+                cls._listener.stop()
+                cls._listener.start()
+        cls._dispatcher.flush()
+
+
+    @classmethod
+    def stop_listener(cls):
+        if cls._owner_pid != os.getpid():
+            return
+
+        if cls._listener is not None:
+            # stop() writes out the records still in the queue
+            cls._listener.stop()
+            cls._listener = None
+        cls._dispatcher.close()
 
 
     @staticmethod
@@ -96,6 +328,7 @@ def post_msg_to_slack(text="", attachments=[]):
         logger.error("Failed to get SLACK_WEBHOOK_URL from .env")
         return False
 
+    import slackweb
     slack = slackweb.Slack(url=url)
 
     if len(text) > 0:
@@ -135,13 +368,77 @@ def interval(interval_sec):
     return __interval
 
 
-def get_url(url, headers=None, num_retry=2, retry_interval=5):
+def get_default_headers():
+    default_headers = dict(headers)
+    try:
+        # both requests (urllib3) and httpx decode brotli when it is installed
+        import brotli
+        default_headers["Accept-Encoding"] = "gzip, deflate, br"
+    except ImportError:
+        default_headers["Accept-Encoding"] = "gzip, deflate"
+
+    return default_headers
+
+
+def get_session(http2=None):
+    """
+    Returns the HTTP session of the current process, so that the requests
+    in a worker reuse warm connections. With http2, an httpx client is used.
+    """
+    if http2 is None:
+        http2 = http_config["http2"]
+
+    # forked workers must not share the sockets of the parent
+    key = (os.getpid(), http2)
+    if key in _sessions:
+        return _sessions[key]
+
+    session = None
+    if http2:
+        # httpx is optional, and http2=True also needs h2 (pip install "httpx[http2]")
+        try:
+            import httpx
+            session = httpx.Client(
+                http2=True,
+                headers=get_default_headers(),
+                timeout=http_config["timeout"],
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=http_config["pool_maxsize"]),
+            )
+        except ImportError as e:
+            logger.warning(f"HTTP/2 is not available ({e}). Falling back to requests.")
+
+    if session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        session.headers.update(get_default_headers())
+        adapter = HTTPAdapter(pool_maxsize=http_config["pool_maxsize"])
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+    _sessions[key] = session
+    return session
+
+
+def get_url(url, headers=None, num_retry=2, retry_interval=5, timeout=None, stream=False):
+    if timeout is None:
+        timeout = http_config["timeout"]
+
+    session = get_session()
+    # httpx reads the body in get(); only requests can defer it
+    kwargs = {"stream": stream} if hasattr(session, "mount") else {}
     for i in range(num_retry+1):
         if i > 0:
             time.sleep(retry_interval)
             logger.info("Retrying...")
 
-        response = requests.get(url, headers=headers)
+        try:
+            response = session.get(str(url), headers=headers, timeout=timeout, **kwargs)
+
+        except Exception as e:
+            logger.warning(f"An error occurred while accessing the page: '{url}'. {e}")
+            continue
 
         if response.status_code == 200:
             return response
@@ -153,6 +450,9 @@ def get_url(url, headers=None, num_retry=2, retry_interval=5):
             logger.warning(
                 f"The page returns response code {response.status_code}: '{url}'"
             )
+
+        # a streamed response holds its connection until closed
+        response.close()
  
     logger.error(
         f"Failed to access the page in {num_retry+1} times: '{url}'"
@@ -161,14 +461,57 @@ def get_url(url, headers=None, num_retry=2, retry_interval=5):
     return None
 
 
-def download_file(url, output_path, **kwargs):
-    response = get_url(url, **kwargs)
+def iter_response_bytes(response, chunk_size):
+    if hasattr(response, "iter_content"):
+        return response.iter_content(chunk_size=chunk_size)
+
+    return response.iter_bytes(chunk_size=chunk_size)
+
+
+def get_declared_encoding(response):
+    """
+    Returns the charset declared in the Content-Type header, or None
+    """
+    content_type = response.headers.get("Content-Type", "")
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "charset" and len(value) > 0:
+            return value.strip("\"' ")
+
+    return None
+
+
+def is_utf8(encoding):
+    return encoding is None or encoding.lower().replace("_", "-") in ("utf-8", "utf8")
+
+
+def download_file(url, output_path, compress=False, chunk_size=64 * 1024, **kwargs):
+    """
+    Streams the raw response body to output_path without decoding it.
+    With compress, the body is gzipped on the fly to '{output_path}.gz'.
+    A declared charset other than UTF-8 is kept in '{output_path}.encoding'.
+    The body is written to a '.part' file first, so a failed download leaves nothing behind.
+    """
+    response = get_url(url, stream=True, **kwargs)
     download_success = False
 
     if response is not None:
+        output_path = pathlib.Path(output_path)
+        if compress:
+            output_path = output_path.with_name(output_path.name + ".gz")
+
+        part_path = output_path.with_name(output_path.name + ".part")
+        encoding_path = output_path.with_name(output_path.name + ".encoding")
         try:
-            with open(output_path, "w") as f:
-                f.write(response.text)
+            opener = gzip.open if compress else open
+            with opener(part_path, "wb") as f:
+                for chunk in iter_response_bytes(response, chunk_size):
+                    f.write(chunk)
+
+            encoding = get_declared_encoding(response)
+            if not is_utf8(encoding):
+                encoding_path.write_text(encoding)
+            os.replace(part_path, output_path)
 
             logger.info(f"Successfully downloaded: '{url}'")
             download_success = True
@@ -178,6 +521,13 @@ def download_file(url, output_path, **kwargs):
                 f"An error occurred while saving: '{url}'.\n"\
                 + f"{traceback.format_exc()}" 
             )
+            # a truncated file would count as downloaded
+            for path in (part_path, encoding_path):
+                if path.exists():
+                    path.unlink()
+
+        finally:
+            response.close()
     
     else:
         logger.error(f"Failed to download: '{url}'")
@@ -205,17 +555,25 @@ def s3_upload_file(s3_bucket, local_path, s3_path):
 
 
 def s3_save_file(url, s3_bucket, s3_path, **kwargs):
-    temp_path = temp_dir / f"{get_jst_time()}_s3_save_file"
+    temp_path = get_temp_dir() / f"{get_jst_time()}_s3_save_file"
     download_success = download_file(url, temp_path, **kwargs)
     if not download_success:
         return False
 
+    if kwargs.get("compress"):
+        temp_path = temp_path.with_name(temp_path.name + ".gz")
+    encoding_path = temp_path.with_name(temp_path.name + ".encoding")
+
     upload_success = s3_upload_file(s3_bucket, temp_path, s3_path)
-    temp_path.unlink()
-    if not upload_success:
-        return False
+    if upload_success and encoding_path.exists():
+        # next to the key, where read_declared_encoding finds it after s3_download_files
+        upload_success = s3_upload_file(s3_bucket, encoding_path, f"{s3_path}.encoding")
 
-    return True
+    for path in (temp_path, encoding_path):
+        if path.exists():
+            path.unlink()
+
+    return upload_success
 
 
 def s3_download_file(s3_bucket, s3_path, local_path=None):
@@ -224,7 +582,7 @@ def s3_download_file(s3_bucket, s3_path, local_path=None):
     logger.debug("Downloading file from s3: '{}'".format(s3_path))
 
     if local_path is None:
-        local_path = str(temp_dir / f"temp_{get_jst_time_str()}")
+        local_path = str(get_temp_dir() / f"temp_{get_jst_time_str()}")
     else:
         local_path = str(local_path)
 
@@ -250,8 +608,11 @@ def s3_download_files(s3_bucket, s3_paths, local_dir):
 
         return download_success
     
-    with mp.Pool(mp.cpu_count()) as p:
+    import profiler
+    with mp.Pool(mp.cpu_count(), **profiler.get_pool_kwargs()) as p:
         result = p.map(_s3_download_file, s3_paths)
+        p.close()
+        p.join()
 
     return result
 
@@ -291,12 +652,15 @@ def list_all_files(directory, extension=None, size=None, sort=False):
     return path_list
 
 
-def s3_list_all_files(s3_bucket, prefix="", extension=None, size=None, sort=False, filter_func=None):
-    prefix = str(prefix)
-
-    if size is None:
-        size = float("inf")
+def s3_iter_files(s3_bucket, prefix="", extension=None, filter_func=None, num_threads=16, manifest_path=None, new_only=False, lister=None):
+    """
+    Yields the keys under the prefix as they are listed, in no particular order.
+    See s3_listing.S3Lister for the manifest and new_only; with a manifest, pass a lister
+    and call lister.commit_keys with the keys once they are processed.
+    """
+    from s3_listing import S3Lister
 
+    prefix = str(prefix)
     if extension is not None and extension[0] != ".":
         extension = "." + extension
 
@@ -307,17 +671,32 @@ def s3_list_all_files(s3_bucket, prefix="", extension=None, size=None, sort=Fals
         logger.debug(
             "Listing all files with prefix: '{}' and extension: '{}'".format(prefix, extension))
 
-    path_list = []
-    objects = s3_bucket.objects.filter(Prefix=prefix)
+    if lister is None:
+        lister = S3Lister(s3_bucket, num_threads=num_threads, manifest_path=manifest_path)
+    for keys in lister.iter_keys(prefix, new_only=new_only):
+        skipped = []
+        for key in keys:
+            path = pathlib.Path(key)
+            if extension is None or path.suffix == extension:
+                if filter_func is None or filter_func(path):
+                    yield key
+                    continue
+            skipped.append(key)
 
-    for i, obj in enumerate(objects):
-        if len(path_list) >= size:
-            break
-        
-        path = pathlib.Path(obj.key)
-        if extension is None or path.suffix == extension:
-            if filter_func is None or filter_func(path):
-                path_list.append(obj.key)
+        # the keys filtered out are done with as well
+        lister.commit_keys(skipped)
+
+
+def s3_list_all_files(s3_bucket, prefix="", extension=None, size=None, sort=False, filter_func=None, **kwargs):
+    if size is None:
+        size = float("inf")
+
+    path_list = []
+    if size > 0:
+        for key in s3_iter_files(s3_bucket, prefix, extension=extension, filter_func=filter_func, **kwargs):
+            path_list.append(key)
+            if len(path_list) >= size:
+                break
 
     if sort:
         path_list.sort()
@@ -341,9 +720,95 @@ def read_html(html_path):
     return None
 
 
+def read_declared_encoding(html_path):
+    html_path = pathlib.Path(html_path)
+    encoding_path = html_path.with_name(html_path.name + ".encoding")
+    if encoding_path.exists():
+        return encoding_path.read_text().strip()
+
+    return None
+
+
+def read_html_bytes(html_path):
+    """
+    Returns (raw bytes, declared encoding or None) of a downloaded html,
+    which may be gzipped ('.gz') and may have an '.encoding' side file
+    """
+    html_path = pathlib.Path(html_path)
+    try:
+        opener = gzip.open if html_path.suffix == ".gz" else open
+        with opener(html_path, "rb") as f:
+            content = f.read()
+
+        return content, read_declared_encoding(html_path)
+    
+    except Exception as e:
+        logger.error(
+            f"An error occurred while reading: '{html_path}'.\n"\
+            + f"{traceback.format_exc()}" 
+        )
+
+    return None, None
+
+
+def decode_html(content, encoding=None):
+    """
+    Decodes the bytes or memoryview of a downloaded html into str in one pass,
+    with its declared encoding, or UTF-8 if it is missing or unknown
+    """
+    try:
+        return str(content, "utf-8" if encoding is None else encoding, errors="replace")
+    except LookupError:
+        return str(content, "utf-8", errors="replace")
+
+
+class ReusableReader(object):
+    """
+    Reads files into one growing buffer instead of allocating a new bytes
+    object per file. The returned memoryview is only valid until the next read.
+
+    """
+    def __init__(self, initial_size=1024 * 1024):
+        self.buffer = bytearray(initial_size)
+
+
+    def read(self, path):
+        """
+        Returns (memoryview of the content, declared encoding or None)
+        """
+        path = pathlib.Path(path)
+        if path.suffix == ".gz":
+            content, encoding = read_html_bytes(path)
+            return (None if content is None else memoryview(content)), encoding
+
+        try:
+            with open(path, "rb", buffering=0) as f:
+                size = os.fstat(f.fileno()).st_size
+                if len(self.buffer) < size:
+                    self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+
+                view = memoryview(self.buffer)
+                num_read = 0
+                while num_read < size:
+                    n = f.readinto(view[num_read:size])
+                    if n == 0:
+                        break
+                    num_read += n
+
+            return view[:num_read], read_declared_encoding(path)
+
+        except Exception as e:
+            logger.error(
+                f"An error occurred while reading: '{path}'.\n"\
+                + f"{traceback.format_exc()}" 
+            )
+
+        return None, None
+
+
 def s3_read_html(s3_bucket, s3_html_path):
     s3_html_path = pathlib.Path(s3_html_path)
-    temp_path = temp_dir / f"{get_jst_time()}_{s3_html_path.stem}.html"
+    temp_path = get_temp_dir() / f"{get_jst_time()}_{s3_html_path.stem}.html"
     download_success, local_path = s3_download_file(s3_bucket, s3_html_path, temp_path)
     content = None
 